@@ -25,6 +25,10 @@
 
 #
 # Changelog:
+# 3.11:
+#   * Cache the sort key of each buffer until the buffer changes.
+#   * Only move the buffers that are out of place when sorting.
+#   * Show statistics of the last sort in `/autosort debug`.
 # 3.10:
 #   * Fix exception in `/autosort helpers swap`.
 # 3.9:
@@ -80,6 +84,7 @@
 #
 
 
+import bisect
 import json
 import math
 import re
@@ -89,7 +94,7 @@ import weechat
 
 SCRIPT_NAME     = 'autosort'
 SCRIPT_AUTHOR   = 'Maarten de Vries <maarten@de-vri.es>'
-SCRIPT_VERSION  = '3.10'
+SCRIPT_VERSION  = '3.11'
 SCRIPT_LICENSE  = 'GPL3'
 SCRIPT_DESC     = 'Flexible automatic (or manual) buffer sorting based on eval expressions.'
 
@@ -99,6 +104,19 @@ hooks              = []
 signal_delay_timer = None
 sort_limit_timer   = None
 sort_queued        = False
+sort_keys          = {}
+sort_stats         = None
+
+# Signals that change the sort key of the buffer in the signal data.
+buffer_signals = [
+	'buffer_opened',
+	'buffer_closed',
+	'buffer_renamed',
+	'buffer_type_changed',
+	'buffer_localvar_added',
+	'buffer_localvar_changed',
+	'buffer_localvar_removed',
+]
 
 
 # Make sure that unicode, bytes and str are always available in python2 and 3.
@@ -397,12 +415,9 @@ def merge_buffer_list(buffers):
 		result[number].append(buffer)
 	return result.values()
 
-def sort_buffers(hdata, buffers, rules, helpers, case_sensitive):
-	for merged in buffers:
-		for buffer in merged:
-			name = weechat.hdata_string(hdata, buffer, 'name')
-
-	return sorted(buffers, key=merged_sort_key(rules, helpers, case_sensitive))
+def sort_buffers(buffers, rules, helpers, case_sensitive, stats):
+	buffer_key = cached_sort_key(rules, helpers, case_sensitive, stats)
+	return sorted(buffers, key=merged_sort_key(buffer_key))
 
 def buffer_sort_key(rules, helpers, case_sensitive):
 	''' Create a sort key function for a list of lists of merged buffers. '''
@@ -419,8 +434,29 @@ def buffer_sort_key(rules, helpers, case_sensitive):
 
 	return key
 
-def merged_sort_key(rules, helpers, case_sensitive):
+def cached_sort_key(rules, helpers, case_sensitive, stats):
+	'''
+	Create a sort key function for buffers that remembers the keys in sort_keys.
+	Keys are only evaluated again after the buffer changed, see invalidate_sort_key().
+	'''
 	buffer_key = buffer_sort_key(rules, helpers, case_sensitive)
+	def key(buffer):
+		result = sort_keys.get(buffer)
+		if result is None:
+			result = sort_keys[buffer] = buffer_key(buffer)
+			stats['evaluated'] += 1
+		return result
+
+	return key
+
+def invalidate_sort_key(buffer = None):
+	''' Forget the sort key of a buffer, or of all buffers. '''
+	if buffer is None:
+		sort_keys.clear()
+	else:
+		sort_keys.pop(buffer, None)
+
+def merged_sort_key(buffer_key):
 	def key(merged):
 		best = None
 		for buffer in merged:
@@ -429,10 +465,60 @@ def merged_sort_key(rules, helpers, case_sensitive):
 		return best
 	return key
 
-def apply_buffer_order(buffers):
-	''' Sort the buffers in weechat according to the given order. '''
-	for i, buffer in enumerate(buffers):
-		weechat.buffer_set(buffer[0], "number", str(i + 1))
+def longest_increasing_subsequence(values):
+	''' Get the indices of a longest strictly increasing subsequence of a list. '''
+	tails    = [] # Smallest last value of an increasing subsequence of each length.
+	ends     = [] # Index of that last value.
+	previous = [None] * len(values)
+
+	for i, value in enumerate(values):
+		length = bisect.bisect_left(tails, value)
+		if length == len(tails):
+			tails.append(value)
+			ends.append(i)
+		else:
+			tails[length] = value
+			ends[length]  = i
+		if length > 0: previous[i] = ends[length - 1]
+
+	result = []
+	i = ends[-1] if ends else None
+	while i is not None:
+		result.append(i)
+		i = previous[i]
+	result.reverse()
+	return result
+
+def buffer_moves(buffers, order):
+	'''
+	Compute the moves to get from the current order of the buffers to the given order.
+	The buffers forming the longest increasing subsequence of the current order stay
+	where they are, the others are moved next to their predecessor in the new order.
+	The result is a list of (merged buffers, number) to be applied in sequence.
+	'''
+	# With buffer_auto_renumber disabled numbers can have gaps, renumber everything then.
+	if [merged.number for merged in buffers] != list(range(1, len(buffers) + 1)):
+		return [(merged, i + 1) for i, merged in enumerate(order)]
+
+	position = dict((id(merged), i) for i, merged in enumerate(order))
+	current  = [position[id(merged)] for merged in buffers]
+	keep     = set(current[i] for i in longest_increasing_subsequence(current))
+
+	moves = []
+	for i in range(len(order)):
+		if i in keep: continue
+		current.remove(i)
+		index = current.index(i - 1) + 1 if i > 0 else 0
+		current.insert(index, i)
+		moves.append((order[i], index + 1))
+	return moves
+
+def apply_buffer_order(buffers, order):
+	''' Sort the buffers in weechat according to the given order, returns the number of moves. '''
+	moves = buffer_moves(buffers, order)
+	for merged, number in moves:
+		weechat.buffer_set(merged[0], "number", str(number))
+	return len(moves)
 
 def split_args(args, expected, optional = 0):
 	''' Split an argument string in the desired number of arguments. '''
@@ -442,21 +528,27 @@ def split_args(args, expected, optional = 0):
 	return split[:-1] + pad(split[-1].split(' ', optional), optional + 1, '')
 
 def do_sort(verbose = False):
+	global sort_stats
 	start = perf_counter()
+	stats = {'evaluated': 0}
 
 	hdata, buffers = get_buffers()
-	buffers = merge_buffer_list(buffers)
-	buffers = sort_buffers(hdata, buffers, config.rules, config.helpers, config.case_sensitive)
-	apply_buffer_order(buffers)
-
-	elapsed = perf_counter() - start
+	buffers = sorted(merge_buffer_list(buffers), key=lambda merged: merged.number)
+	order   = sort_buffers(buffers, config.rules, config.helpers, config.case_sensitive, stats)
+	stats['moves']   = apply_buffer_order(buffers, order)
+	stats['buffers'] = sum(len(merged) for merged in buffers)
+	stats['elapsed'] = perf_counter() - start
+	sort_stats = stats
+
+	message = "Finished sorting buffers in {elapsed:.4f} seconds: {evaluated} of {buffers} sort keys evaluated, {moves} buffers moved.".format(**stats)
 	if verbose:
-		log("Finished sorting buffers in {0:.4f} seconds.".format(elapsed))
+		log(message)
 	else:
-		debug("Finished sorting buffers in {0:.4f} seconds.".format(elapsed))
+		debug(message)
 
 def command_sort(buffer, command, args):
 	''' Sort the buffers and print a confirmation. '''
+	invalidate_sort_key()
 	do_sort(True)
 	return weechat.WEECHAT_RC_OK
 
@@ -481,6 +573,10 @@ def command_debug(buffer, command, args):
 		log('{0}: {1}'.format(fullname, result))
 	log('Computing evaluation results took {0:.4f} seconds.'.format(elapsed))
 
+	if sort_stats is not None:
+		log('Last sort: {evaluated} of {buffers} sort keys evaluated, {moves} buffers moved, took {elapsed:.4f} seconds.'.format(**sort_stats))
+	log('{0} sort keys cached.'.format(len(sort_keys)))
+
 	return weechat.WEECHAT_RC_OK
 
 def command_rule_list(buffer, command, args):
@@ -640,10 +736,23 @@ def call_command(buffer, command, args, subcommands):
 	log('{0}: command not found'.format(' '.join(command)))
 	return weechat.WEECHAT_RC_ERROR
 
+def on_buffer_changed(data, signal, signal_data):
+	''' Called when a buffer changed in a way that can change its sort key. '''
+	invalidate_sort_key(signal_data)
+	return weechat.WEECHAT_RC_OK
+
 def on_signal(data, signal, signal_data):
 	global signal_delay_timer
 	global sort_queued
 
+	# Forget the sort key of the buffer in the signal data.
+	# If the signal isn't about a buffer, any sort key may have changed.
+	hdata = weechat.hdata_get('buffer')
+	if signal in buffer_signals or signal_data in sort_keys or weechat.hdata_check_pointer(hdata, weechat.hdata_get_list(hdata, 'gui_buffers'), signal_data):
+		invalidate_sort_key(signal_data)
+	else:
+		invalidate_sort_key()
+
 	# If the sort limit timeout is started, we're in the hold-off time after sorting, just queue a sort.
 	if sort_limit_timer is not None:
 		if sort_queued:
@@ -713,6 +822,9 @@ def on_sort_limit_timeout(pointer, remainin_calls):
 
 
 def apply_config():
+	# Rules or helpers may have changed.
+	invalidate_sort_key()
+
 	# Unhook all signals and hook the new ones.
 	for hook in hooks:
 		weechat.unhook(hook)
@@ -887,7 +999,8 @@ command_description = r'''{*white}# General commands{reset}
 Manually trigger the buffer sorting.
 
 {*white}/autosort {brown}debug{reset}
-Show the evaluation results of the sort rules for each buffer.
+Show the evaluation results of the sort rules for each buffer,
+and how many sort keys were evaluated and buffers moved by the last sort.
 
 
 {*white}# Sorting rule commands{reset}
@@ -996,6 +1109,11 @@ almost all situations. However, you may wish to change the list of signals that
 cause your buffer list to be sorted. Simply edit the `{cyan}autosort.sorting.signals{reset}`
 option to add or remove any signal you like.
 
+The result of the sort rules is remembered for each buffer, and only evaluated
+again when the buffer is opened, renamed, its local variables change, or it is
+the buffer of a signal that causes a sort. A signal that isn't about a buffer
+causes all rules to be evaluated again, as does `{*default}/autosort sort{reset}`.
+
 If you remove all signals you can still sort your buffers manually with the
 `{*default}/autosort sort{reset}` command. To prevent all automatic sorting, the option
 `{cyan}autosort.sorting.sort_on_config_change{reset}` should also be disabled.
@@ -1073,4 +1191,7 @@ if weechat.register(SCRIPT_NAME, SCRIPT_AUTHOR, SCRIPT_VERSION, SCRIPT_LICENSE,
 	weechat.hook_info('autosort_replace', info_replace_description, info_replace_arguments, 'on_info_replace', '')
 	weechat.hook_info('autosort_order',   info_order_description,   info_order_arguments,   'on_info_order',   '')
 
+	for signal in buffer_signals:
+		weechat.hook_signal(signal, 'on_buffer_changed', '')
+
 	apply_config()
@@ -118,6 +118,21 @@
 #     point out clones in the channel.
 #     Valid values: 'on', 'off' Default: 'off'
 #
+#   * plugins.var.python.chanop.flood_burst:
+#     Number of commands that can be sent at once to a server, commands
+#     beyond that are sent one every flood_delay seconds.
+#     Default: 5
+#
+#   * plugins.var.python.chanop.flood_delay:
+#     Seconds between commands once flood_burst commands were sent. Using zero
+#     sends all commands at once.
+#     Default: 2
+#
+#   * plugins.var.python.chanop.max_queued_commands:
+#     If a command like /obankick needs to send more commands than this, it's
+#     aborted. Mode changes count as one command for each /mode sent.
+#     Default: 20
+#
 #
 #   The following configs are global and can't be defined per server or channel.
 #
@@ -196,6 +211,37 @@
 #   History:
 #
 #
+#   2026-10-18
+#   version 0.3.9: faster user cache
+#   * nicks are kept IRC lowercased, lookups don't build a key object.
+#   * expired users are found through a time ordered list instead of checking
+#     every user that parted.
+#   * joins and parts update the cache of any channel chanop has a cache for,
+#     not only channels in the watchlist.
+#   * the cache of a watched channel is built when we join it.
+#
+#   2026-10-18
+#   version 0.3.8: pace and pack queued commands
+#   * mode changes are packed in as few /mode commands as the server allows.
+#   * commands are sent in bursts limited by flood_burst and flood_delay
+#     options, the bar shows how many are left while sending.
+#   * new option max_queued_commands, replaces the fixed limit of 10.
+#
+#   2026-10-18
+#   version 0.3.7: keep channel masks in a SQLite database
+#   * masks are written as they change and each channel's list is read when
+#     first needed, instead of loading and saving the whole cache at once.
+#   * the cache moved to chanop_mode_cache.db, masks from the old
+#     chanop_mode_cache.dat are fetched again from the server.
+#
+#   2026-10-18
+#   version 0.3.6: faster ban lookups
+#   * match a hostmask against a channel's masks through an index of their
+#     literal prefix/suffix instead of trying every mask.
+#   * find the users affected by a mask through an index of their hostmasks.
+#   * limit the size of the regexp cache.
+#   * run "python chanop.py --benchmark" for timing mask lookups.
+#
 #   2023-02-05
 #   version 0.3.5: replace command /VERSION by /version
 #                  (compatibility with WeeChat 3.9)
@@ -296,7 +342,7 @@ WEECHAT_VERSION = (0x30200, '0.3.2')
 
 SCRIPT_NAME    = "chanop"
 SCRIPT_AUTHOR  = "Elián Hanisch <lambdae2@gmail.com>"
-SCRIPT_VERSION = "0.3.5"
+SCRIPT_VERSION = "0.3.9"
 SCRIPT_LICENSE = "GPL3"
 SCRIPT_DESC    = "Helper script for IRC Channel Operators"
 
@@ -311,6 +357,9 @@ settings = {
 'enable_multi_kick'     :'off',
 'display_affected'      :'on',
 'enable_bar'            :'on',
+'flood_burst'           :'5',
+'flood_delay'           :'2',
+'max_queued_commands'   :'20',
 }
 
 try:
@@ -322,12 +371,14 @@ except ImportError:
     print("Get WeeChat now at: http://www.weechat.org/")
     import_ok = False
 
+import os
 import re
+import sys
 import time
 import string
 import getopt
-from collections import defaultdict
-from shelve import DbfilenameShelf as Shelf
+import sqlite3
+from collections import defaultdict, OrderedDict
 
 chars = str.maketrans('', '')
 
@@ -476,30 +527,38 @@ def is_ip(s):
     except socket.error:
         return False
 
-_reCache = {}
+def compilePattern(pattern):
+    """Compile an IRC pattern into a case insensible regexp."""
+    s = '^'
+    for c in pattern:
+        if c == '*':
+            s += '.*'
+        elif c == '?':
+            s += '.'
+        elif c in '[{':
+            s += r'[\[{]'
+        elif c in ']}':
+            s += r'[\]}]'
+        elif c in '|\\':
+            s += r'[|\\]'
+        else:
+            s += re.escape(c)
+    s += '$'
+    return re.compile(s, re.I)
+
+_reCache = OrderedDict()
+_reCacheSize = 1000
 def cachedPattern(f):
     """Use cached regexp object or compile a new one from pattern."""
     def getRegexp(pattern, *arg):
         try:
             regexp = _reCache[pattern]
+            _reCache.move_to_end(pattern)
         except KeyError:
-            s = '^'
-            for c in pattern:
-                if c == '*':
-                    s += '.*'
-                elif c == '?':
-                    s += '.'
-                elif c in '[{':
-                    s += r'[\[{]'
-                elif c in ']}':
-                    s += r'[\]}]'
-                elif c in '|\\':
-                    s += r'[|\\]'
-                else:
-                    s += re.escape(c)
-            s += '$'
-            regexp = re.compile(s, re.I)
-            _reCache[pattern] = regexp
+            regexp = _reCache[pattern] = compilePattern(pattern)
+            if len(_reCache) > _reCacheSize:
+                # forget the least recently used pattern
+                _reCache.popitem(last=False)
         return f(regexp, *arg)
     return getRegexp
 
@@ -1036,12 +1095,32 @@ class IrcCommands(ChanopBuffers):
 
     class ModeMessage(Message):
         command = 'mode'
+        # keep the line well below the 512 bytes IRC limit
+        maxArgsLength = 400
         def __init__(self, char=None, args=None, **kwargs):
             self.chars = [ char ]
             self.charargs = [ args ]
             self.args = (char, args)
             Message.__init__(self, **kwargs)
 
+        def argsLength(self):
+            return sum([ len(a) + 1 for a in self.charargs if isinstance(a, str) ])
+
+        def canMerge(self, message, maxModes):
+            if len(self.chars) >= maxModes:
+                return False
+            args = message.charargs[0]
+            if isinstance(args, str):
+                return self.argsLength() + len(args) + 1 <= self.maxArgsLength
+            return True
+
+        def merge(self, message):
+            self.chars.append(message.chars[0])
+            self.charargs.append(message.charargs[0])
+
+        def __contains__(self, message):
+            return (message.chars[0], message.charargs[0]) in zip(self.chars, self.charargs)
+
         def payload(self):
             args = []
             modeChar = []
@@ -1073,6 +1152,9 @@ class IrcCommands(ChanopBuffers):
         self.interrupt = False
         self.commands = []
         self.buffer = buffer
+        self.sendTimer = None
+        self.sent = 0
+        self.paced = False
 
     def checkOp(self):
         infolist = nick_infolist(self.server, self.channel)
@@ -1120,16 +1202,30 @@ class IrcCommands(ChanopBuffers):
         msg = self.UserhostMessage('USERHOST', (nick, ))
         self.queue(msg, insert=True) # USERHOST should be sent first
 
+    def modeMessages(self):
+        """Returns the queued /mode messages that later modes can join."""
+        L = []
+        for msg in self.commands:
+            if isinstance(msg, self.DeopMessage):
+                # modes queued after our deop can't be sent before it
+                L = []
+            elif isinstance(msg, self.ModeMessage):
+                L.append(msg)
+        return L
+
     def queue(self, message, insert=False):
         debug('queuing: %s', message)
-        # merge /modes
-        if self.commands and message.command == 'mode':
+        # merge /modes, sending them before other commands (like kicks) is fine
+        if self.commands and type(message) is self.ModeMessage and not insert:
             max_modes = supported_maxmodes(self.server)
-            msg = self.commands[-1]
-            if msg.command == 'mode' and len(msg.chars) < max_modes:
-                msg.chars.append(message.chars[0])
-                msg.charargs.append(message.charargs[0])
+            modes = self.modeMessages()
+            if any([ message in msg for msg in modes ]):
+                # already queued
                 return
+            for msg in modes:
+                if msg.canMerge(message, max_modes):
+                    msg.merge(message)
+                    return
         if insert:
             self.commands.insert(0, message)
         else:
@@ -1138,8 +1234,9 @@ class IrcCommands(ChanopBuffers):
     # it happened once and it wasn't pretty
     def safe_check(f):
         def abort_if_too_many_commands(self):
-            if len(self.commands) > 10:
-                error("Limit of 10 commands in queue reached, aborting.")
+            limit = self.get_config_int('max_queued_commands')
+            if len(self.commands) > limit:
+                error("Limit of %s commands in queue reached, aborting." % limit)
                 self.clear()
             else:
                 f(self)
@@ -1147,21 +1244,103 @@ class IrcCommands(ChanopBuffers):
 
     @safe_check
     def run(self):
+        if self.sendTimer:
+            # waiting for the server's flood limit, the timer will resume
+            return
+        bucket = sendBuckets[self.server]
+        burst = self.get_config_int('flood_burst')
+        delay = self.get_config_int('flood_delay')
         while self.commands and not self.interrupt:
+            wait = bucket.take(burst, delay)
+            if wait:
+                self.sendTimer = weechat.hook_timer(int(wait * 1000) + 1, 0, 1,
+                        callback(send_queue_cb), self.buffer)
+                break
             msg = self.commands.pop(0)
             msg.register(self.buffer)
             msg()
+            self.sent += 1
             if self.interrupt:
                 #debug("Interrupting queue")
                 break
+        self.updateStatus(bucket, burst, delay)
+
+    def updateStatus(self, bucket, burst, delay):
+        """Report the queue state while commands are paced."""
+        global chanop_bar_status
+        if self.sendTimer:
+            status = '%s: %s commands sent, %s queued, about %s left' \
+                    % (self.channel, self.sent, len(self.commands),
+                       time_elapsed(bucket.drainTime(len(self.commands), burst, delay)))
+            if not self.paced and not chanop_bar:
+                # no bar for following the progress, tell it once
+                say(status, self.buffer)
+            self.paced = True
+        elif self.paced and not self.commands:
+            status = '%s: all %s commands sent.' % (self.channel, self.sent)
+            self.paced = False
+        else:
+            status = None
+        if not self.commands:
+            self.sent = 0
+        if status and chanop_bar:
+            chanop_bar_status = status
+            weechat.bar_item_update('chanop_status')
+            chanop_bar.popup()
 
     def clear(self):
         debug('clear queue (%s messages)', len(self.commands))
         self.commands = []
+        self.sent = 0
+        self.paced = False
+        if self.sendTimer:
+            weechat.unhook(self.sendTimer)
+            self.sendTimer = None
 
     def __repr__(self):
         return '<IrcCommands(%s)>' % ', '.join(map(repr, self.commands))
 
+class TokenBucket(object):
+    """Flood limit of a server: allows sending 'burst' commands at once, then
+    one every 'delay' seconds."""
+    def __init__(self):
+        self.tokens = None
+        self.time = 0
+
+    def refill(self, burst, delay):
+        t = time.time()
+        if self.tokens is None or delay <= 0:
+            self.tokens = burst
+        else:
+            self.tokens = min(burst, self.tokens + (t - self.time) / delay)
+        self.time = t
+
+    def take(self, burst, delay):
+        """Takes a token, returns 0 if there was one or the seconds to wait
+        for one otherwise."""
+        self.refill(burst, delay)
+        if delay <= 0:
+            return 0
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) * delay
+
+    def drainTime(self, count, burst, delay):
+        """Seconds needed for sending count commands."""
+        if delay <= 0:
+            return 0
+        return int(max(0, count - int(self.tokens)) * delay)
+
+# WeeChat server name => TokenBucket
+sendBuckets = defaultdict(TokenBucket)
+
+def send_queue_cb(buffer, count):
+    irc = ChanopBuffers._buffer[buffer].irc
+    irc.sendTimer = None
+    irc.run()
+    return WEECHAT_RC_OK
+
 # -----------------------------------------------------------------------------
 # User/Mask classes
 
@@ -1263,7 +1442,7 @@ class ServerChannelDict(CaseInsensibleDict):
             return [ chan for serv, chan in self if serv == server ]
 
     def purge(self):
-        for key in list(self.keys()):
+        for key in list(self):
             if key not in chanopChannels:
                 debug('removing %s mask list, not in watchlist.', key)
                 del self[key]
@@ -1321,18 +1500,240 @@ class MaskObject(object):
     def __repr__(self):
         return "<MaskObject(%s)>" % self.mask
 
+class MaskMatcher(object):
+    """Index of masks for finding the ones that match a hostmask.
+
+    Masks are kept in buckets by the last (or first) characters of their
+    literal suffix (or prefix), or by their user when it is literal, so only a
+    few of them are tried against a hostmask. Other masks are always tried."""
+    keyLength = 8
+    _userRe = re.compile(r'^[^!@]*![^!@*?]+@[^!@]*$')
+
+    def __init__(self, masks):
+        self.suffixes = defaultdict(list)
+        self.prefixes = defaultdict(list)
+        self.users = defaultdict(list)
+        self.others = []
+        self.masks = []
+        for mask in masks:
+            if not is_hostmask(mask):
+                # extbans and such never match a hostmask
+                continue
+            self.masks.append(mask)
+            # nick!user@host$#channel
+            pattern = mask.partition('$')[0]
+            item = (len(self.masks), mask, compilePattern(pattern))
+            head, tail = self.literals(pattern)
+            if tail and len(tail) >= len(head) and tail.isascii():
+                self.suffixes[tail[-self.keyLength:]].append(item)
+            elif head and head.isascii():
+                self.prefixes[head[:self.keyLength]].append(item)
+            elif self._userRe.match(pattern) and pattern.isascii():
+                # like *!user@*
+                self.users[IRClower(pattern[pattern.find('!') + 1:pattern.find('@')])].append(item)
+            else:
+                self.others.append(item)
+
+    @staticmethod
+    def literals(pattern):
+        """Returns the literal prefix and suffix of pattern, IRC lowercased."""
+        head = re.split(r'[*?]', pattern, 1)[0]
+        if len(head) == len(pattern):
+            tail = head
+        else:
+            tail = re.split(r'[*?]', pattern)[-1]
+        return IRClower(head), IRClower(tail)
+
+    def candidates(self, hostmask):
+        s = IRClower(hostmask)
+        L = list(self.others)
+        L.extend(self.users.get(s[s.find('!') + 1:s.find('@')], ()))
+        for n in range(1, self.keyLength + 1):
+            if n > len(s):
+                break
+            L.extend(self.suffixes.get(s[-n:], ()))
+            L.extend(self.prefixes.get(s[:n], ()))
+        return L
+
+    def search(self, hostmask):
+        """Returns the masks that match hostmask, in the order they were given."""
+        if not is_hostmask(hostmask):
+            return []
+        if not hostmask.isascii() or '$' in hostmask \
+                or hostmask.count('!') != 1 or hostmask.count('@') != 1:
+            # unicode case folding, a ban forward or an odd hostmask could
+            # make a mask match without its literal part, try them all
+            return [ mask for mask in self.masks if hostmask_match(mask, hostmask) ]
+        L = [ (n, mask) for n, mask, regexp in self.candidates(hostmask)
+              if regexp.match(hostmask) ]
+        L.sort()
+        return [ mask for n, mask in L ]
+
+class HostmaskIndex(object):
+    """Index of the hostmasks of a server's users for finding the ones a mask
+    matches, the other way around of MaskMatcher.
+
+    Hostmasks are kept in buckets by their first and last characters (a few
+    and more of them), by the first characters of their host and by their
+    user, a mask only tries the hostmasks in the smallest bucket its literal
+    prefix, suffix, host or user points to. Odd hostmasks are always tried."""
+    keyLengths = (4, 12)
+
+    def __init__(self):
+        # hostmask => users with it
+        self.owners = {}
+        self.prefixes = defaultdict(set)
+        self.suffixes = defaultdict(set)
+        self.hosts = defaultdict(set)
+        self.users = defaultdict(set)
+        self.others = set()
+
+    def buckets(self, hostmask):
+        if not hostmask.isascii() or '$' in hostmask \
+                or hostmask.count('!') != 1 or hostmask.count('@') != 1:
+            # see MaskMatcher.search
+            return ((self.others, None), )
+        s = IRClower(hostmask)
+        host = s[s.find('@') + 1:]
+        L = [ (self.users, s[s.find('!') + 1:s.find('@')]) ]
+        for n in self.keyLengths:
+            if n <= len(s):
+                L.append((self.prefixes, s[:n]))
+                L.append((self.suffixes, s[-n:]))
+            if n <= len(host):
+                L.append((self.hosts, host[:n]))
+        return L
+
+    def add(self, hostmask, user):
+        if not is_hostmask(hostmask):
+            return
+        try:
+            self.owners[hostmask].add(user)
+        except KeyError:
+            self.owners[hostmask] = set([ user ])
+            for bucket, key in self.buckets(hostmask):
+                if key is None:
+                    bucket.add(hostmask)
+                else:
+                    bucket[key].add(hostmask)
+
+    def remove(self, user):
+        for hostmask in user._hostmask:
+            owners = self.owners.get(hostmask)
+            if not owners:
+                continue
+            owners.discard(user)
+            if owners:
+                continue
+            del self.owners[hostmask]
+            for bucket, key in self.buckets(hostmask):
+                if key is None:
+                    bucket.discard(hostmask)
+                else:
+                    bucket[key].discard(hostmask)
+                    if not bucket[key]:
+                        del bucket[key]
+
+    def candidates(self, pattern):
+        if not pattern.isascii():
+            return list(self.owners)
+        head, tail = MaskMatcher.literals(pattern)
+        literals = [ (self.prefixes, head), (self.suffixes, tail) ]
+        if pattern.count('@') == 1:
+            # indexed hostmasks have a single @, the mask's one matches it
+            host = MaskMatcher.literals(pattern[pattern.find('@') + 1:])[0]
+            literals.append((self.hosts, host))
+        buckets = []
+        for bucket, literal in literals:
+            # the longest key the literal has
+            for n in reversed(self.keyLengths):
+                if len(literal) >= n:
+                    key = literal[-n:] if bucket is self.suffixes else literal[:n]
+                    buckets.append(bucket.get(key, ()))
+                    break
+        if MaskMatcher._userRe.match(pattern):
+            buckets.append(self.users.get(
+                IRClower(pattern[pattern.find('!') + 1:pattern.find('@')]), ()))
+        if not buckets:
+            # like *!*@*, try them all
+            return list(self.owners)
+        L = list(min(buckets, key=len))
+        L.extend(self.others)
+        return L
+
+    def search(self, mask, users, all=False):
+        """Returns the hostmasks in users that mask matches, only the current
+        hostmask of each user unless all is True."""
+        if not is_hostmask(mask):
+            return []
+        # nick!user@host$#channel
+        pattern = mask.partition('$')[0]
+        L = pattern_match_list(pattern, self.candidates(pattern))
+        # masks with a channel forward, like hostmask_match_list
+        L.extend(pattern_match_list(pattern + '$*',
+                                    [ s for s in self.others if '$' in s ]))
+        found = []
+        for hostmask in set(L):
+            for user in self.owners[hostmask]:
+                if dict.get(users, IRClower(user.nick)) is user \
+                        and (all or user.hostmask == hostmask):
+                    found.append(hostmask)
+                    break
+        found.sort()
+        return found
+
 class MaskList(CaseInsensibleDict):
     """Single list of masks"""
+    _matcher = None
+    # masks are written to the store as they change, once MaskCache attaches it
+    store = None
+
     def __init__(self, server, channel):
+        self.server = server
+        self.channel = channel
         self.synced = 0
 
+    def attach(self, store, mode):
+        self.store = store
+        self.mode = mode
+
+    def save(self, ban):
+        if self.store is not None:
+            self.store.save(self.mode, self.server, self.channel, ban)
+
+    def __setitem__(self, k, v):
+        self._matcher = None
+        CaseInsensibleDict.__setitem__(self, k, v)
+        self.save(v)
+
+    def __delitem__(self, k):
+        self._matcher = None
+        CaseInsensibleDict.__delitem__(self, k)
+        if self.store is not None:
+            self.store.delete(self.mode, self.server, self.channel, k)
+
+    def pop(self, k):
+        v = self[k]
+        del self[k]
+        return v
+
+    @property
+    def matcher(self):
+        if self._matcher is None:
+            self._matcher = MaskMatcher(list(self.keys()))
+        return self._matcher
+
     def add(self, mask, **kwargs):
         if mask in self:
             # mask exists, update it
             ban = self[mask]
+            updated = False
             for attr, value in list(kwargs.items()):
                 if value and not getattr(ban, attr):
                     setattr(ban, attr, value)
+                    updated = True
+            if updated:
+                self.save(ban)
         else:
             ban = self[mask] = MaskObject(mask, **kwargs)
         return ban
@@ -1346,7 +1747,7 @@ class MaskList(CaseInsensibleDict):
 
     def search(self, pattern, reverseMatch=False):
         if reverseMatch:
-            L = [ mask for mask in self if hostmask_match(mask, pattern) ]
+            L = self.matcher.search(pattern)
         else:
             L = pattern_match_list(pattern, list(self.keys()))
         return L
@@ -1355,7 +1756,53 @@ class MaskList(CaseInsensibleDict):
         pass
 
 class MaskCache(ServerChannelDict):
-    """Keeps a cache of masks for different channels."""
+    """Keeps a cache of masks for different channels.
+
+    Lists saved in the store are only read when first used."""
+    def __init__(self, mode, store):
+        self.mode = mode
+        self.store = store
+        self.unloaded = CaseInsensibleSet(store.channels(mode))
+
+    def load(self, key):
+        key = self.key(key)
+        if key not in self.unloaded:
+            return
+        self.unloaded.remove(key)
+        masklist = MaskList(*key)
+        for ban in self.store.load(self.mode, *key):
+            CaseInsensibleDict.__setitem__(masklist, ban.mask, ban)
+        masklist.attach(self.store, self.mode)
+        ServerChannelDict.__setitem__(self, key, masklist)
+
+    def __getitem__(self, key):
+        self.load(key)
+        return ServerChannelDict.__getitem__(self, key)
+
+    def __setitem__(self, key, masklist):
+        if key in self:
+            del self[key]
+        masklist.attach(self.store, self.mode)
+        for ban in list(masklist.values()):
+            masklist.save(ban)
+        ServerChannelDict.__setitem__(self, key, masklist)
+
+    def __delitem__(self, key):
+        if key in self.unloaded:
+            self.unloaded.remove(key)
+        else:
+            ServerChannelDict.__delitem__(self, key)
+        self.store.delete(self.mode, *key)
+
+    def __contains__(self, key):
+        return key in self.unloaded or ServerChannelDict.__contains__(self, key)
+
+    def __iter__(self):
+        for key in list(self.keys()):
+            yield key
+        for key in list(self.unloaded):
+            yield key
+
     def add(self, server, channel, mask, **kwargs):
         """Adds a ban to (server, channel) banlist."""
         key = (server, channel)
@@ -1375,29 +1822,91 @@ class MaskCache(ServerChannelDict):
         except KeyError:
             pass
 
-class ChanopCache(Shelf):
+class ModeStore(object):
+    """SQLite database of channel masks, one row for each mask."""
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        try:
+            # fails with "file is not a database" if it isn't one
+            self.db.execute('PRAGMA schema_version')
+            # commits don't need to wait for the disk
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS masks ('
+                            'mode TEXT, server TEXT, channel TEXT, key TEXT, mask TEXT, '
+                            'operator TEXT, date INTEGER, expires INTEGER, hostmask TEXT, '
+                            'PRIMARY KEY (mode, server, channel, key))')
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.close()
+            raise
+
+    def channels(self, mode):
+        return self.db.execute('SELECT DISTINCT server, channel FROM masks WHERE mode = ?',
+                               (mode, )).fetchall()
+
+    def load(self, mode, server, channel):
+        rows = self.db.execute('SELECT mask, operator, date, expires, hostmask FROM masks '
+                               'WHERE mode = ? AND server = ? AND channel = ? ORDER BY rowid',
+                               (mode, IRClower(server), IRClower(channel)))
+        L = []
+        for mask, operator, date, expires, hostmask in rows:
+            hostmask = hostmask and hostmask.split(',') or []
+            L.append(MaskObject(mask, hostmask, operator, date, expires))
+        return L
+
+    def save(self, mode, server, channel, ban):
+        self.db.execute('INSERT OR REPLACE INTO masks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (mode, IRClower(server), IRClower(channel), IRClower(ban.mask),
+                         ban.mask, ban.operator or '', ban.date, ban.expires,
+                         ','.join(ban.hostmask)))
+
+    def delete(self, mode, server, channel, mask=None):
+        if mask is None:
+            self.db.execute('DELETE FROM masks WHERE mode = ? AND server = ? AND channel = ?',
+                            (mode, IRClower(server), IRClower(channel)))
+        else:
+            self.db.execute('DELETE FROM masks WHERE mode = ? AND server = ? AND channel = ? '
+                            'AND key = ?', (mode, IRClower(server), IRClower(channel),
+                                            IRClower(mask)))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+class ModeCache(dict):
+    """class for store channel modes lists."""
     def __init__(self, filename):
         options = {
             'directory': 'data',
         }
         path = weechat.string_eval_path_home('%%h/%s' % filename, {}, {}, options)
-        Shelf.__init__(self, path, writeback=True)
-
-class ModeCache(ChanopCache):
-    """class for store channel modes lists."""
-    def __init__(self, filename):
-        ChanopCache.__init__(self, filename)
+        try:
+            self.store = ModeStore(path)
+        except sqlite3.DatabaseError as e:
+            if 'not a database' in str(e):
+                # not a database we can use, start a new one
+                error('Mode cache %s is unreadable (%s), creating a new one.' % (path, e))
+                for suffix in ('', '-wal', '-shm'):
+                    try:
+                        os.remove(path + suffix)
+                    except OSError:
+                        pass
+                self.store = ModeStore(path)
+            else:
+                # maybe locked by another WeeChat using the same home, leave it alone
+                error('Mode cache %s can\'t be opened (%s), masks will be forgotten when '
+                      'the script is unloaded.' % (path, e))
+                self.store = ModeStore(':memory:')
         self.modes = set()
         self.map = CaseInsensibleDict()
 
-        # reset all sync timers
-        for cache in list(self.values()):
-            for masklist in list(cache.values()):
-                masklist.synced = 0
-
     def registerMode(self, mode, *args):
         if mode not in self:
-            cache = MaskCache()
+            cache = MaskCache(mode, self.store)
             self[mode] = cache
 
         if mode not in self.modes:
@@ -1409,9 +1918,9 @@ class ModeCache(ChanopCache):
 
     def __getitem__(self, mode):
         try:
-            return ChanopCache.__getitem__(self, mode)
+            return dict.__getitem__(self, mode)
         except KeyError:
-            return ChanopCache.__getitem__(self, self.map[mode])
+            return dict.__getitem__(self, self.map[mode])
 
     def add(self, server, channel, mode, mask, **kwargs):
         assert mode in self.modes
@@ -1424,6 +1933,13 @@ class ModeCache(ChanopCache):
         for cache in list(self.values()):
             cache.purge()
 
+    def commit(self):
+        """Write the changes done since last commit."""
+        self.store.commit()
+
+    def close(self):
+        self.store.close()
+
 class MaskSync(object):
     """Class for fetch and sync bans of any channel and mode."""
     __name__ = ''
@@ -1561,6 +2077,7 @@ class MaskSync(object):
         except KeyError:
             maskList = maskCache[server, channel] = MaskList(server, channel)
         maskList.synced = now()
+        modeCache.commit()
 
         # run hooked functions if any
         if (server, channel) in self._callback:
@@ -1613,11 +2130,30 @@ class UserObject(object):
         return '<UserObject(%s)>' %(self.hostmask or self.nick)
 
 class ServerUserList(CaseInsensibleDict):
+    # nicks are kept IRC lowercased
+    key = staticmethod(IRClower)
+
     def __init__(self, server):
         self.server = server
         buffer = weechat.buffer_search('irc', 'server.%s' %server)
         self.irc = IrcCommands(buffer)
         self._purge_time = 3600*4 # 4 hours
+        # users not in any channel, in the order they left: nick => (time, user)
+        self._purge_list = OrderedDict()
+        self.index = HostmaskIndex()
+
+    def __setitem__(self, nick, user):
+        CaseInsensibleDict.__setitem__(self, nick, user)
+        for hostmask in user._hostmask:
+            self.index.add(hostmask, user)
+        if user._channels < 1:
+            self.left(user)
+
+    def left(self, user):
+        """user isn't in any channel now."""
+        key = IRClower(user.nick)
+        self._purge_list.pop(key, None)
+        self._purge_list[key] = (now(), user)
 
     def getHostmask(self, nick):
         user = self[nick]
@@ -1626,35 +2162,57 @@ class ServerUserList(CaseInsensibleDict):
     def purge(self):
         """Purge old nicks"""
         n = now()
-        for nick, user in list(self.items()):
-            if user._channels < 1 and (n - user.seen) > self._purge_time:
+        while self._purge_list:
+            nick, (t, user) = next(iter(self._purge_list.items()))
+            if (n - t) <= self._purge_time:
+                # the rest left later
+                break
+            del self._purge_list[nick]
+            if user._channels > 0 or dict.get(self, nick) is not user:
+                # joined a channel since or was replaced
+                continue
+            if (n - user.seen) > self._purge_time:
                 #debug('purging old user: %s' % nick)
+                self.index.remove(user)
                 del self[nick]
+            else:
+                # seen since, check again later
+                self._purge_list[nick] = (user.seen, user)
 
 class UserList(ServerUserList):
     def __init__(self, server, channel):
         self.server = server
         self.channel = channel
-        self._purge_list = CaseInsensibleDict()
+        # users that parted, in the order they did: nick => (time, user)
+        self._purge_list = OrderedDict()
         self._purge_time = 3600*2 # 2 hours
 
     def __setitem__(self, nick, user):
         #debug('%s %s: join, %s', self.server, self.channel, nick)
-        if nick not in self:
+        nick = IRClower(nick)
+        if not dict.__contains__(self, nick):
             user._channels += 1
         if nick in self._purge_list:
             #debug(' - removed from purge list')
             del self._purge_list[nick]
-        ServerUserList.__setitem__(self, nick, user)
+        dict.__setitem__(self, nick, user)
 
     def part(self, nick):
+        nick = IRClower(nick)
         try:
             #debug('%s %s: part, %s', self.server, self.channel, nick)
-            user = self[nick]
-            self._purge_list[nick] = user
+            user = dict.__getitem__(self, nick)
+            self._purge_list.pop(nick, None)
+            self._purge_list[nick] = (now(), user)
         except KeyError:
             pass
 
+    def forget(self, user):
+        """user is no longer in this channel."""
+        user._channels -= 1
+        if user._channels < 1:
+            userCache[self.server].left(user)
+
     def values(self):
         if not all(ServerUserList.values(self)):
             userCache.who(self.server, self.channel)
@@ -1672,12 +2230,18 @@ class UserList(ServerUserList):
             # only current hostmasks
             return [ user.hostmask for user in users if user._hostmask ]
 
+    def searchHostmasks(self, mask, all=False):
+        """Returns the hostmasks of the channel's users that mask matches, like
+        hostmask_match_list(mask, self.hostmasks(all=all)) but through the
+        server's index."""
+        return userCache[self.server].index.search(mask, self, all)
+
     def nicks(self, *args, **kwargs):
 #        if not all(self.itervalues()):
 #            userCache.who(self.server, self.channel)
-        L = list(self.items())
-        L.sort(key=lambda x:x[1].seen)
-        return reversed([x[0] for x in L])
+        L = list(ServerUserList.values(self))
+        L.sort(key=lambda x:x.seen)
+        return reversed([x.nick for x in L])
 
     def getHostmask(self, nick):
         try:
@@ -1689,15 +2253,20 @@ class UserList(ServerUserList):
     def purge(self):
         """Purge old nicks"""
         n = now()
-        for nick, user in list(self._purge_list.items()):
+        while self._purge_list:
+            nick, (t, user) = next(iter(self._purge_list.items()))
+            if (n - t) <= self._purge_time:
+                # the rest parted later
+                break
+            del self._purge_list[nick]
             if (n - user.seen) > self._purge_time:
                 #debug('%s %s: forgeting about %s', self.server, self.channel, nick)
-                user._channels -= 1
-                try:
-                    del self._purge_list[nick]
-                    del self[nick]
-                except KeyError:
-                    pass
+                if dict.get(self, nick) is user:
+                    dict.__delitem__(self, nick)
+                    self.forget(user)
+            else:
+                # seen since, check again later
+                self._purge_list[nick] = (user.seen, user)
 
 class UserCache(ServerChannelDict):
     __name__ = ''
@@ -1732,8 +2301,11 @@ class UserCache(ServerChannelDict):
         cache = self[server]
         try:
             user = cache[nick]
+            # keep the nick as last seen
+            user.nick = nick
             if hostmask:
                 user.update(hostmask)
+                cache.index.add(hostmask, user)
         except KeyError:
             #debug("%s: new user %s %s", server, nick, hostmask)
             user = UserObject(nick, hostmask)
@@ -1757,8 +2329,9 @@ class UserCache(ServerChannelDict):
         # when we delete a channel, we need to reduce user._channels count
         # so they can be purged later.
         #debug('forgeting about %s', k)
-        for user in list(self[k].values()):
-            user._channels -= 1
+        users = ServerChannelDict.__getitem__(self, k)
+        for user in list(dict.values(users)):
+            users.forget(user)
         ServerChannelDict.__delitem__(self, k)
 
     def getHostmask(self, nick, server, channel=None):
@@ -2498,8 +3071,9 @@ def signal_parse(f):
         channel = signal_data.split()[2]
         if channel[0] == ':':
             channel = channel[1:]
-        if (server, channel) not in chanopChannels:
-            # signals only processed for channels in watchlist
+        if (server, channel) not in chanopChannels and (server, channel) not in userCache:
+            # signals only processed for channels in watchlist or with a
+            # user cache that must be kept updated
             return WEECHAT_RC_OK
         nick = get_nick(signal_data)
         hostmask = signal_data[1:signal_data.find(' ')]
@@ -2667,7 +3241,7 @@ def mode_cb(server, channel, nick, opHostmask, signal_data):
     for action, mode, mask in chanmode_list:
         debug('MODE: %s%s %s %s', action, mode, mask, opHostmask)
         if action == '+':
-            hostmask = hostmask_match_list(mask, userCache[key].hostmasks())
+            hostmask = userCache[key].searchHostmasks(mask)
             if hostmask:
                 affected_users.extend(hostmask)
             if mask != '*!*@*':
@@ -2679,6 +3253,7 @@ def mode_cb(server, channel, nick, opHostmask, signal_data):
             modeCache.add(server, channel, mode, mask, operator=opHostmask, hostmask=hostmask)
         elif action == '-':
             modeCache.remove(server, channel, mode, mask)
+    modeCache.commit()
 
     if affected_users and get_config_boolean('display_affected',
             get_function=get_config_specific, server=server, channel=channel):
@@ -2701,6 +3276,16 @@ def join_cb(server, channel, nick, hostmask, signal_data):
     userCache[server, channel][nick] = user
     return WEECHAT_RC_OK
 
+@catchExceptions
+def names_end_cb(data, signal, signal_data):
+    """Build the user cache of a watched channel once we have its nicklist."""
+    # :server 366 nick #channel :End of /NAMES list.
+    server = signal[:signal.find(',')]
+    channel = signal_data.split()[3]
+    if (server, channel) in chanopChannels and (server, channel) not in userCache:
+        userCache.generateCache(server, channel)
+    return WEECHAT_RC_OK
+
 @signal_parse
 def part_cb(server, channel, nick, hostmask, signal_data):
     userCache.remember(server, nick, hostmask)
@@ -2732,6 +3317,7 @@ def garbage_collector_cb(data, counter):
     """
     debug('* flushing caches')
     modeCache.purge()
+    modeCache.commit()
     userCache.purge()
 
     if weechat.config_get_plugin('debug'):
@@ -3046,10 +3632,9 @@ def item_ban_matches_cb(data, item, window):
     #debug('ban matches item: %s', masks)
 
     affected = []
-    hostmasks = users.hostmasks(all=True)
     for mask in masks:
         if is_hostmask(mask):
-            affected.extend(hostmask_match_list(mask, hostmasks))
+            affected.extend(users.searchHostmasks(mask, all=True))
         elif mask in users:
             affected.append(mask)
     #debug('ban matches item: %s', affected)
@@ -3099,10 +3684,108 @@ def input_content_cb(data, modifier, modifier_data, string):
         chanop_bar.hide()
     return string
 
+# -----------------------------------------------------------------------------
+# Benchmark
+
+def benchmark_mask_matching(masks=500, users=5000):
+    """Time looking up the bans of every user in a channel, by trying each mask
+    and with MaskMatcher, and the users affected by each ban, by trying each
+    hostmask and with HostmaskIndex. Doesn't need WeeChat:
+    python chanop.py --benchmark"""
+    import random
+    rand = random.Random(0)
+
+    domains = [ 'isp%s.example.net' % i for i in range(40) ] \
+            + [ 'users.example%s.org' % i for i in range(20) ]
+    def random_host():
+        r = rand.random()
+        if r < 0.4:
+            return '.'.join([ str(rand.randint(1, 254)) for i in range(4) ])
+        elif r < 0.8:
+            return 'host-%s.%s' % (rand.randint(1, 9999), rand.choice(domains))
+        return 'unaffiliated/user%s' % rand.randint(1, 9999)
+
+    hostmasks = [ 'Nick%s!~ident%s@%s' % (i, rand.randint(1, 999), random_host())
+                  for i in range(users) ]
+
+    # ban list made of the usual kind of masks, for users of the channel
+    banlist = MaskList('server', '#channel')
+    while len(banlist) < masks:
+        hostmask = rand.choice(hostmasks)
+        nick, user, host = hostmask.partition('!')[0], get_user(hostmask), get_host(hostmask)
+        r = rand.random()
+        if r < 0.5:
+            mask = '*!*@%s' % host
+        elif r < 0.65 and '.' in host:
+            mask = '*!*@*.%s' % host.partition('.')[2]
+        elif r < 0.75:
+            mask = '%s!*@*' % nick
+        elif r < 0.85:
+            mask = '*!%s@*' % user
+        elif r < 0.9:
+            mask = '*!*@%s*' % host[:len(host) // 2]
+        elif r < 0.95:
+            mask = '$a:account%s' % rand.randint(1, 9999)
+        else:
+            mask = '*!*@*%s*' % host[1:len(host) // 2]
+        banlist.add(mask)
+
+    start = time.time()
+    expected = [ [ mask for mask in banlist if hostmask_match(mask, hostmask) ]
+                 for hostmask in hostmasks ]
+    linear = time.time() - start
+
+    start = time.time()
+    banlist.matcher
+    build = time.time() - start
+
+    start = time.time()
+    found = [ banlist.search(hostmask, reverseMatch=True) for hostmask in hostmasks ]
+    indexed = time.time() - start
+
+    assert found == expected, "MaskMatcher results differ from trying each mask"
+    print('%s masks, %s users, %s matches' % (len(banlist), len(hostmasks),
+                                              sum(map(len, found))))
+    print('  each mask:   %.3f s (%.1f us per user)' % (linear, linear * 1e6 / users))
+    print('  MaskMatcher: %.3f s (%.1f us per user), index built in %.3f s' \
+          % (indexed, indexed * 1e6 / users, build))
+
+    # the users each mask affects, as when a ban is set or previewed
+    channel_users = UserList('server', '#channel')
+    index = HostmaskIndex()
+    start = time.time()
+    for i, hostmask in enumerate(hostmasks):
+        user = UserObject(hostmask.partition('!')[0], hostmask)
+        if i % 10 == 0:
+            # reconnected from somewhere else
+            user.update('%s!%s@%s' % (user.nick, get_user(hostmask), random_host()))
+        channel_users[user.nick] = user
+        for s in user._hostmask:
+            index.add(s, user)
+    build = time.time() - start
+
+    for all in (False, True):
+        start = time.time()
+        hostmask_list = channel_users.hostmasks(all=all)
+        expected = [ sorted(hostmask_match_list(mask, hostmask_list)) for mask in banlist ]
+        linear = time.time() - start
+
+        start = time.time()
+        found = [ index.search(mask, channel_users, all) for mask in banlist ]
+        indexed = time.time() - start
+
+        assert found == expected, "HostmaskIndex results differ from trying each hostmask"
+        print('%s masks, %s %shostmasks, %s affected' % (len(banlist), len(hostmask_list),
+              all and 'current and old ' or '', sum(map(len, found))))
+        print('  each hostmask: %.3f s (%.1f us per mask)' % (linear, linear * 1e6 / len(banlist)))
+        print('  HostmaskIndex: %.3f s (%.1f us per mask), index built in %.3f s' \
+              % (indexed, indexed * 1e6 / len(banlist), build))
+
 # -----------------------------------------------------------------------------
 # Main
 
 def unload_chanop():
+    modeCache.close()
     if chanop_bar:
         # we don't remove it, so custom options configs aren't lost
         chanop_bar.hide()
@@ -3163,12 +3846,12 @@ if __name__ == '__main__' and import_ok and \
         if not weechat.config_is_set_plugin(opt):
             weechat.config_set_plugin(opt, val)
 
-    modeCache = ModeCache('chanop_mode_cache.dat')
+    modeCache = ModeCache('chanop_mode_cache.db')
     modeCache.registerMode('b', 'ban', 'bans')
     modeCache.registerMode('q', 'quiet', 'quiets')
 
     # -------------------------------------------------------------------------
-    # remove old chanmask config and save them in shelf
+    # remove old chanmask config and save them in the mode cache
 
     prefix = 'python.%s.chanmask' % SCRIPT_NAME
     infolist = Infolist('option', 'plugins.var.%s.*' % prefix)
@@ -3183,13 +3866,15 @@ if __name__ == '__main__' and import_ok and \
             else:
                 masklist = cache[server, channel] = MaskList(server, channel)
         if mask in masklist:
-            masklist[mask].deserialize(infolist['value'])
+            obj = masklist[mask]
         else:
-            obj = masklist[mask] = MaskObject(mask)
-            obj.deserialize(infolist['value'])
+            obj = MaskObject(mask)
+        obj.deserialize(infolist['value'])
+        masklist[mask] = obj
         weechat.config_unset_plugin('chanmask.%s.%s.%s.%s' \
                 % (server, channel, mode, mask))
     del infolist
+    modeCache.commit()
 
     # hook /oop /odeop
     Op().hook()
@@ -3234,6 +3919,7 @@ if __name__ == '__main__' and import_ok and \
     weechat.hook_completion('chanop_hosts', 'hostnames in cache', 'hosts_cmpl', '')
 
     weechat.hook_signal('*,irc_in_join', 'join_cb', '')
+    weechat.hook_signal('*,irc_in2_366', 'names_end_cb', '')
     weechat.hook_signal('*,irc_in_part', 'part_cb', '')
     weechat.hook_signal('*,irc_in_quit', 'quit_cb', '')
     weechat.hook_signal('*,irc_in_nick', 'nick_cb', '')
@@ -3259,5 +3945,7 @@ if __name__ == '__main__' and import_ok and \
             "Test if pattern matches text, is case insensible with IRC case rules.",
             "pattern,text", "info_pattern_match", "")
 
+elif __name__ == '__main__' and '--benchmark' in sys.argv[1:]:
+    benchmark_mask_matching()
 
 # vim:set shiftwidth=4 tabstop=4 softtabstop=4 expandtab textwidth=100:
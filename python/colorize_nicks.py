@@ -25,6 +25,16 @@
 #   https://github.com/ryoskzypu/weechat_scripts
 #
 # History:
+# 2026-10-18: ryoskzypu <ryoskzypu@proton.me>
+#   version 36: get the nicks of a buffer on its first line to colorize instead
+#               of all buffers at load, share nick colors between buffers
+# 2026-10-18: ryoskzypu <ryoskzypu@proton.me>
+#   version 35: cache options and buffer local variables instead of reading
+#               them from weechat on every line, add info colorize_nicks_stats
+# 2026-10-18: ryoskzypu <ryoskzypu@proton.me>
+#   version 34: find nicks in a single pass over the line, without compiling
+#               regexes for every word, time it with
+#               "python colorize_nicks.py --benchmark"
 # 2025-05-08: ryoskzypu <ryoskzypu@proton.me>
 #   version 33: add many improvements, features, and fixes
 # 2023-10-30: Sébastien Helleu <flashcode@flashtux.org>
@@ -97,8 +107,18 @@
 # 2010-02-03, xt
 #   version 0.1: initial (based on ruby script by dominikh)
 
-import weechat
+try:
+    import weechat
+    import_ok = True
+except ImportError:
+    print('This script must be run under WeeChat.')
+    print('Get WeeChat now at: https://weechat.org/')
+    weechat   = None
+    import_ok = False
+
 import re
+import sys
+from collections import OrderedDict
 
 # Debug data structures.
 #from pprint import PrettyPrinter
@@ -108,7 +128,7 @@ w = weechat
 
 SCRIPT_NAME    = 'colorize_nicks'
 SCRIPT_AUTHOR  = 'xt <xt@bash.no>'
-SCRIPT_VERSION = '33'
+SCRIPT_VERSION = '36'
 SCRIPT_LICENSE = 'GPL'
 SCRIPT_DESC    = 'Use the weechat nick colors in the chat area'
 
@@ -118,9 +138,30 @@ config_option   = {}
 ignore_channels = []  # ignore_channels
 ignore_nicks    = []  # ignore_nicks
 
+# Snapshot of the script options, refreshed on changes by config_cache_cb().
+options = {}
+
+# Dict with the local variables of buffers, forgotten on changes by buffer_vars_cb().
+buffer_vars = {}
+
+# WeeChat version number.
+weechat_version = 0
+
 # Dict with every nick on every channel, with its color and prefix as lookup values.
+# Channels are added the first time they have a line to colorize.
 colored_nicks = {}
 
+# Nick colors from weechat, shared by all buffers and with the least recently
+# used removed first.
+nick_colors      = OrderedDict()
+nick_colors_size = 10000
+
+# Number of colorized lines and of weechat API calls done for them.
+stats = {
+        'lines':     0,
+        'api_calls': 0,
+}
+
 # Regexes
 
 colors_rgx = r'''
@@ -159,6 +200,7 @@ split_rgx  = rf'''
                  |
                                                 # Chars
              '''
+word_rgx   = r'[^ ]+'
 has_colors_rgx  = rf'{colors_rgx} | {attr_rgx}'
 is_color_rgx    = rf'\A(?: {has_colors_rgx})\Z'
 exact_color_rgx = rf'\A{colors_rgx}\Z'
@@ -168,6 +210,7 @@ regex = {
         'colors':      colors_rgx,
         'attr':        attr_rgx,
         'reset':       reset_rgx,
+        'word':        word_rgx,
         'split':       split_rgx,
         'has_colors':  has_colors_rgx,
         'is_color':    is_color_rgx,
@@ -175,7 +218,7 @@ regex = {
 }
 
 # Reset color code
-reset = w.color('reset')
+reset = w.color('reset') if import_ok else '\034'
 
 # Space hex code
 space = '\x20'
@@ -380,137 +423,145 @@ def debug_str(var, string):
     w.command('', f'/debug unicode {string}')
     w.prnt('', '')
 
+def get_buffer_vars(buffer):
+    ''' Returns the local variables of a buffer, they are only read from weechat
+    the first time or after a change. '''
+
+    if (bufvars := buffer_vars.get(buffer)) is None:
+        bufvars = buffer_vars[buffer] = {
+                var: w.buffer_get_string(buffer, f'localvar_{var}')
+                for var in ('plugin', 'type', 'channel', 'nick', 'server')
+        }
+        stats['api_calls'] += len(bufvars)
+
+    return bufvars
+
 def get_nick_color(buffer, nick, my_nick):
     ''' Retrieves nick color code from weechat. '''
 
     if nick == my_nick:
-        return w.color(w.config_string(w.config_get('weechat.color.chat_nick_self')))
+        key = ('chat_nick_self', '')
     else:
-        version = int(w.info_get('version_number', '') or 0)
+        bufvars = get_buffer_vars(buffer)
 
         # 'irc_nick_color' (deprecated since version 1.5, replaced by 'nick_color')
-        if w.buffer_get_string(buffer, 'plugin') == 'irc' and version == 0x4010000:
-            server = w.buffer_get_string(buffer, 'localvar_server')
-            return w.info_get('irc_nick_color', f'{server},{nick}')
+        if bufvars['plugin'] == 'irc' and weechat_version == 0x4010000:
+            key = ('irc_nick_color', f"{bufvars['server']},{nick}")
+        else:
+            key = ('nick_color', nick)
+
+    # Colors only depend on the nick and weechat options, so they are kept
+    # until an option changes.
+    if (nick_color := nick_colors.get(key)) is not None:
+        nick_colors.move_to_end(key)
+        return nick_color
+
+    if nick == my_nick:
+        nick_color = w.color(w.config_string(w.config_get('weechat.color.chat_nick_self')))
+        stats['api_calls'] += 3
+    else:
+        nick_color = w.info_get(*key)
+        stats['api_calls'] += 1
+
+    nick_colors[key] = nick_color
+    if len(nick_colors) > nick_colors_size:
+        nick_colors.popitem(last=False)
 
-        return w.info_get('nick_color', nick)
+    return nick_color
 
 def colorize_priv_nicks(buffer):
     ''' Colorizes nicks on IRC private buffers. '''
 
-    # Reset the buffer dict to update nicks changes, since there is no nicklist
-    # in private buffers.
+    # There is no nicklist in private buffers, so the buffer dict is made from
+    # its local variables, and is removed when they change.
     colored_nicks[buffer] = {}
 
-    my_nick   = w.buffer_get_string(buffer, 'localvar_nick')
-    priv_nick = w.buffer_get_string(buffer, 'localvar_channel')
+    bufvars   = get_buffer_vars(buffer)
+    my_nick   = bufvars['nick']
+    priv_nick = bufvars['channel']
 
     for nick in my_nick, priv_nick:
         nick_color = get_nick_color(buffer, nick, my_nick)
 
         colored_nicks[buffer][nick] = {
-                'color':  nick_color,
-                'prefix': '',
+                'color':       nick_color,
+                'prefix':      '',
+                'prefix_char': '',
         }
 
 def colorize_nicks(buffer, min_len, prefixes, suffixes, has_colors, line):
     ''' Finds every nick from the dict of colored nicks, in the line and colorizes
     them. '''
 
-    chop_line            = line
-    chop_match           = ''
-    chop_match_after     = ''
-    color_match          = ''
-    colorized_nicks_line = ''
+    nicks                = colored_nicks[buffer]
+    colorized_nicks_line = []
+    last                 = 0
     nick_end             = reset
 
     # Mark the nick's end with a unique escape to identify its position on preserve_colors().
     if has_colors is not None:
         nick_end = uniq_esc_nick
 
-    # Split words on spaces, since it is the most common word divider and is not
-    # valid in 'nicks' on popular protocols like IRC and matrix; thus protocols
+    # Words are split on spaces, since it is the most common word divider and is
+    # not valid in 'nicks' on popular protocols like IRC and matrix; thus protocols
     # that allow spaces in 'nicks' are limited here.
-    for word in re.split(f'{space}+', line.strip(f'{space}')):
-        nick_prefix = ''  # Reset nick prefix.
-
-        if word == '':
-            continue
-
-        # Get possible nick from word.
-        nicks_rgx = rf'''
-                        [{prefixes}]?     # Optional prefix char
-                        (?P<nick> [^ ]+)
-                     '''
-        if (nick := re.search(nicks_rgx, word, flags=re.VERBOSE)) is not None:
-            nick = re.escape(nick.group('nick'))
+    # A nick is a whole word with an optional prefix and suffix char, so every
+    # word is looked up once in the buffer dict, in a single pass on the line.
+    for word_match in regex['word'].finditer(line):
+        word  = word_match.group()
+        start = word_match.start()
+        pref  = ''
+
+        # Get possible nick from word, without its optional prefix char.
+        if len(word) > 1 and word[0] in prefixes:
+            pref = word[0]
+            nick = word[1:]
+        else:
+            nick = word
 
         # If the word is not a known nick and its last character is an option
         # suffix (e.g. colon ':' or comma ','), try to match the word without it.
         # This is necessary as 'foo:' is a valid nick, which could be addressed
         # as 'foo::'.
-        if nick not in colored_nicks[buffer]:
-            if (suffix := re.search(rf'[{suffixes}]$', nick)) is not None:
-                nick = nick[:-1]
+        if nick not in nicks and nick[-1] in suffixes:
+            nick = nick[:-1]
 
         # Nick exists on buffer.
-        if nick in colored_nicks[buffer]:
-            if nick in ignore_nicks or len(nick) < min_len:
-                continue
-
-            # Get its color.
-            nick_color = colored_nicks[buffer][nick]['color']
-
-            # Find nick in the line.
-            line_rgx = rf'''
-                           (?: \A | [ ])             # Boundary
-                           (?P<pref> [{prefixes}])?  # Optional prefix char
-                           (?P<nick> {nick})
-                           [{suffixes}]?             # "        suffix char
-                           (?: \Z | [ ])             # Boundary
-                       '''
-
-            # Nick is found in the line.
-            if (line_match := re.search(line_rgx, chop_line, flags=re.VERBOSE)) is not None:
-                # In order to prevent the regex engine to needless find the nicks
-                # at previous match positions, preserve the state by chopping the
-                # line at the start and end positions of matches.
-
-                # Start position of nick match.
-                start = line_match.start('nick')
-
-                # Get the real nick prefix from nicklist.
-                if (pref_match := line_match.group('pref')) is not None:
-                    nick_prefix = colored_nicks[buffer][nick]['prefix']
-
-                    # If it exists, update the start position match.
-                    if pref_match == w.string_remove_color(nick_prefix, ''):
-                        start = line_match.start('pref')
+        if nick not in nicks or nick in ignore_nicks or len(nick) < min_len:
+            continue
 
-                        # Mark the prefix with a unique escape to idenfity its
-                        # position on preserve_colors().
-                        if has_colors is not None:
-                            nick_prefix = f'{uniq_esc_pref}{nick_prefix}'
-                    else:
-                        nick_prefix = ''
+        # Get its color.
+        nick_color  = nicks[nick]['color']
+        nick_prefix = ''
+
+        # Get the real nick prefix from nicklist.
+        if pref:
+            nick_prefix = nicks[nick]['prefix']
+
+            # If it exists, colorize it along with the nick.
+            if pref == nicks[nick]['prefix_char']:
+                # Mark the prefix with a unique escape to idenfity its
+                # position on preserve_colors().
+                if has_colors is not None:
+                    nick_prefix = f'{uniq_esc_pref}{nick_prefix}'
+            else:
+                nick_prefix = ''
+                start      += 1
 
-                # End position of nick match.
-                end = line_match.end('nick')
+        # End position of nick match.
+        end = word_match.start() + len(pref) + len(nick)
 
-                # Chop
-                chop_till_match  = chop_line[:end]
-                chop_after_match = chop_line[end:]
+        # Append the line up to the match, while colorizing the nick.
+        colorized_nicks_line.append(line[last:start])
+        colorized_nicks_line.append(f'{nick_prefix}{nick_color}{nick}{nick_end}')
+        last = end
 
-                # Concat the chopped strings while colorizing the nick, then update
-                # the chopped line.
-                nick_str     = f'{nick_prefix}{nick_color}{nick}{nick_end}'
-                color_match += f'{chop_till_match[:start]}{nick_str}{chop_till_match[end:]}'
-                chop_line    = chop_after_match
+    if not colorized_nicks_line:
+        return ''
 
-    if color_match:
-        colorized_nicks_line = f'{color_match}{chop_after_match}'
+    colorized_nicks_line.append(line[last:])
 
-    return colorized_nicks_line
+    return ''.join(colorized_nicks_line)
 
 def preserve_colors(line, colorized_nicks_line):
     '''
@@ -622,15 +673,17 @@ def init_colorize(buffer, message):
     new_msg             = ''
 
     # Get options.
-    min_len      = w.config_integer(config_option['min_nick_length'])
-    pref_charset = re.escape(w.config_string(config_option['nick_prefixes']))
-    suff_charset = re.escape(w.config_string(config_option['nick_suffixes']))
+    min_len      = options['min_nick_length']
+    pref_charset = options['nick_prefixes']
+    suff_charset = options['nick_suffixes']
 
     # Check if message has color codes.
     has_colors = regex['has_colors'].search(message)
 
     # Remove any color codes from message in order to match and colorize the strings correctly.
     msg_nocolor = w.string_remove_color(message, '')
+    stats['lines']     += 1
+    stats['api_calls'] += 1
 
     # Find and colorize the nicks.
     colorized_nicks_msg = colorize_nicks(buffer, min_len, pref_charset, suff_charset, has_colors, msg_nocolor)
@@ -681,12 +734,12 @@ def colorize_cb(data, hashtable):
     displayed = hashtable['displayed']
     message   = hashtable['message']
 
-    plugin  = w.buffer_get_string(buffer, 'localvar_plugin')
-    bufname = w.buffer_get_string(buffer, 'localvar_name')
-    buftype = w.buffer_get_string(buffer, 'localvar_type')
-    channel = w.buffer_get_string(buffer, 'localvar_channel')
+    bufvars = get_buffer_vars(buffer)
+    plugin  = bufvars['plugin']
+    buftype = bufvars['type']
+    channel = bufvars['channel']
 
-    irc_only = w.config_boolean(config_option['irc_only'])
+    irc_only = options['irc_only']
 
     # Colorize only IRC user messages.
     if plugin == 'irc' or irc_only and plugin != 'irc':
@@ -696,26 +749,22 @@ def colorize_cb(data, hashtable):
         if buftype != 'channel' and buftype != 'private' or tags[0] != 'irc_privmsg' and tags[0] != 'irc_notice':
             return hashtable
 
-    # Colorize nicks on IRC private buffers.
-    if plugin == 'irc' and buftype == 'private':
-        colorize_priv_nicks(buffer)
-
-    # Check if buffer has colorized nicks.
-    if not colored_nicks.get(buffer):
-        return hashtable
-
     # Check if channel is ignored.
     if channel and channel in ignore_channels:
         return hashtable
 
     # Do not colorize if an ignored tag is present in message.
-    tag_ignores = w.config_string(config_option['ignore_tags']).split(',')
+    tag_ignores = options['ignore_tags']
     for tag in tags:
         if tag in tag_ignores:
             return hashtable
 
     # Do not colorize if message is filtered.
-    if displayed == '0' and not w.config_boolean(config_option['colorize_filter']):
+    if displayed == '0' and not options['colorize_filter']:
+        return hashtable
+
+    # Check if buffer has colorized nicks.
+    if not get_colored_nicks(buffer, bufvars):
         return hashtable
 
     # Init colorizing process.
@@ -732,15 +781,16 @@ def colorize_cb(data, hashtable):
 def colorize_input_cb(data, modifier, modifier_data, line):
     ''' Callback that does the colorizing of nicks from weechat's input. '''
 
-    if not w.config_boolean(config_option['colorize_input']):
+    if not options['colorize_input']:
         return line
 
     buffer  = w.current_buffer()
-    plugin  = w.buffer_get_string(buffer, 'localvar_plugin')
-    buftype = w.buffer_get_string(buffer, 'localvar_type')
-    channel = w.buffer_get_string(buffer, 'localvar_channel')
+    bufvars = get_buffer_vars(buffer)
+    plugin  = bufvars['plugin']
+    buftype = bufvars['type']
+    channel = bufvars['channel']
 
-    irc_only = w.config_boolean(config_option['irc_only'])
+    irc_only = options['irc_only']
 
     # Colorize only IRC user messages.
     if plugin == 'irc' or irc_only and plugin != 'irc':
@@ -748,82 +798,97 @@ def colorize_input_cb(data, modifier, modifier_data, line):
         if buftype != 'channel' and buftype != 'private':
             return line
 
-    # Check if current buffer has colorized nicks.
-    if not colored_nicks.get(buffer):
-        return line
-
     # Check if current channel is ignored.
     if channel and channel in ignore_channels:
         return line
 
+    # Check if current buffer has colorized nicks.
+    if not get_colored_nicks(buffer, bufvars):
+        return line
+
     # Decode IRC colors from input.
     if plugin == 'irc':
         line = w.hook_modifier_exec('irc_color_decode', '1', line)
+        stats['api_calls'] += 1
+
+    stats['api_calls'] += 1
 
     # Init colorizing process.
     line = init_colorize(buffer, line)
 
     return line
 
-def populate_nicks_cb(*args):
-    ''' Callback that fills the colored nicks dict with all nicks weechat can see,
-    and what color and prefix it has assigned to it. '''
+def get_colored_nicks(buffer, bufvars):
+    ''' Returns the dict of colored nicks of a buffer, filling it the first time. '''
+
+    if (nicks := colored_nicks.get(buffer)) is None:
+        # Colorize nicks on IRC private buffers.
+        if bufvars['plugin'] == 'irc' and bufvars['type'] == 'private':
+            colorize_priv_nicks(buffer)
+        else:
+            populate_nicks(buffer, bufvars)
+
+        nicks = colored_nicks[buffer]
+
+    return nicks
+
+def populate_nicks(buffer, bufvars):
+    ''' Fills the colored nicks dict of a buffer with all nicks in its nicklist,
+    and what color and prefix weechat has assigned to them. '''
 
-    bufname      = ''
     prefix_color = ''
     nick_prefix  = ''
-    irc_only     = w.config_boolean(config_option['irc_only'])
+    prefix_char  = ''
 
-    # Get nicks only in IRC buffers.
-    if irc_only:
-        bufname = 'irc.*'
+    colored_nicks[buffer] = {}
 
-    # Get list of buffers.
-    if not (buffers := w.infolist_get('buffer', '', bufname)):
-        w.prnt('', f'{SCRIPT_NAME}\tfailed to get list of buffers')
-        return w.WEECHAT_RC_ERROR
+    # Get nicks only in IRC channel buffers.
+    if options['irc_only'] and (bufvars['plugin'] != 'irc' or bufvars['type'] != 'channel'):
+        return
 
-    while w.infolist_next(buffers):
-        buffer_ptr = w.infolist_pointer(buffers, 'pointer')
-        channel    = w.buffer_get_string(buffer_ptr, 'localvar_channel')
+    my_nick = bufvars['nick']
 
-        # Skip non-IRC channel buffers.
-        if irc_only and not w.info_get('irc_is_channel', channel):
-            continue
+    if (nicklist := w.infolist_get('nicklist', buffer, '')):
+        while w.infolist_next(nicklist):
+            stats['api_calls'] += 2
 
-        my_nick = w.buffer_get_string(buffer_ptr, 'localvar_nick')
+            # Skip nick groups.
+            if w.infolist_string(nicklist, 'type') != 'nick':
+                continue
 
-        if (nicklist := w.infolist_get('nicklist', buffer_ptr, '')):
-            while w.infolist_next(nicklist):
-                if buffer_ptr not in colored_nicks:
-                    colored_nicks[buffer_ptr] = {}
+            # Get nicks colors.
+            nick       = w.infolist_string(nicklist, 'name')
+            nick_color = get_nick_color(buffer, nick, my_nick)
 
-                # Skip nick groups.
-                if w.infolist_string(nicklist, 'type') != 'nick':
-                    continue
+            # Get nicks prefixes.
+            prefix = w.infolist_string(nicklist, 'prefix')
+            stats['api_calls'] += 2
+            if prefix != space:
+                prefix_color = w.color(w.infolist_string(nicklist, 'prefix_color'))
+                nick_prefix  = f'{prefix_color}{prefix}'
+                prefix_char  = prefix
+                stats['api_calls'] += 2
+
+            # Populate
+            colored_nicks[buffer][nick] = {
+                    'color':       nick_color,
+                    'prefix':      nick_prefix,
+                    'prefix_char': prefix_char,
+            }
+            nick_prefix = ''
+            prefix_char = ''
 
-                # Get nicks colors.
-                nick       = w.infolist_string(nicklist, 'name')
-                nick_color = get_nick_color(buffer_ptr, nick, my_nick)
-
-                # Get nicks prefixes.
-                prefix = w.infolist_string(nicklist, 'prefix')
-                if prefix != space:
-                    prefix_color = w.color(w.infolist_string(nicklist, 'prefix_color'))
-                    nick_prefix  = f'{prefix_color}{prefix}'
-
-                # Populate
-                colored_nicks[buffer_ptr][nick] = {
-                        'color':  nick_color,
-                        'prefix': nick_prefix,
-                }
-                nick_prefix = ''
+    w.infolist_free(nicklist)
+    stats['api_calls'] += 2
 
-        w.infolist_free(nicklist)
+    #w.prnt('', 'colored_nicks:\n' + pp.pformat(colored_nicks))
 
-    w.infolist_free(buffers)
+def reset_nicks_cb(*args):
+    ''' Callback that empties the colored nicks dicts and nick colors, when weechat's
+    colors options change; buffers fill them again on their next line. '''
 
-    #w.prnt('', 'colored_nicks:\n' + pp.pformat(colored_nicks))
+    colored_nicks.clear()
+    nick_colors.clear()
 
     return w.WEECHAT_RC_OK
 
@@ -834,15 +899,17 @@ def add_nick_cb(data, signal, signal_data):
     # Nicks can have ',' in them in some protocols.
     buffer, nick = signal_data.split(',', maxsplit=1)
 
+    # Buffer nicks are not filled yet, the nick will be there when they are.
     if buffer not in colored_nicks:
-        colored_nicks[buffer] = {}
+        return w.WEECHAT_RC_OK
 
     # Get nick color.
-    my_nick    = w.buffer_get_string(buffer, 'localvar_nick')
+    my_nick    = get_buffer_vars(buffer)['nick']
     nick_color = get_nick_color(buffer, nick, my_nick)
 
     # Get nick prefix.
     nick_prefix = ''
+    prefix_char = ''
     if (nicklist := w.infolist_get('nicklist', buffer, f'nick_{nick}')):
         while w.infolist_next(nicklist):
             prefix = w.infolist_string(nicklist, 'prefix')
@@ -850,11 +917,13 @@ def add_nick_cb(data, signal, signal_data):
             if prefix != space:
                 prefix_color = w.color(w.infolist_string(nicklist, 'prefix_color'))
                 nick_prefix  = f'{prefix_color}{prefix}'
+                prefix_char  = prefix
 
     # Update
     colored_nicks[buffer][nick] = {
-            'color':  nick_color,
-            'prefix': nick_prefix,
+            'color':       nick_color,
+            'prefix':      nick_prefix,
+            'prefix_char': prefix_char,
     }
 
     w.infolist_free(nicklist)
@@ -885,16 +954,54 @@ def remove_priv_buffer_cb(data, signal, buffer):
     # For some reason, weechat crashes if the hook signal is set to 'buffer_closed'
     # while trying to get the 'localvar_*' strings.
     # Perhaps the buffer pointer is not valid anymore because it was closed?
-    plugin  = w.buffer_get_string(buffer, 'localvar_plugin')
-    buftype = w.buffer_get_string(buffer, 'localvar_type')
+    bufvars = get_buffer_vars(buffer)
 
-    if plugin == 'irc' and buftype == 'private' and buffer in colored_nicks:
+    if bufvars['plugin'] == 'irc' and bufvars['type'] == 'private' and buffer in colored_nicks:
         del colored_nicks[buffer]
 
     #w.prnt('', 'colored_nicks:\n' + pp.pformat(colored_nicks))
 
     return w.WEECHAT_RC_OK
 
+def buffer_vars_cb(data, signal, buffer):
+    ''' Callback that forgets the local variables of a buffer, when they are changed
+    or the buffer is closed. '''
+
+    if (bufvars := buffer_vars.pop(buffer, None)) is not None:
+        # Nicks of private buffers are from its local variables.
+        if bufvars['type'] == 'private' or signal == 'buffer_closed':
+            colored_nicks.pop(buffer, None)
+
+    return w.WEECHAT_RC_OK
+
+def config_cache_cb(*args):
+    ''' Callback that takes a snapshot of the script options, so the line callbacks
+    do not read them from weechat every time. '''
+
+    options['irc_only']        = w.config_boolean(config_option['irc_only'])
+    options['colorize_filter'] = w.config_boolean(config_option['colorize_filter'])
+    options['colorize_input']  = w.config_boolean(config_option['colorize_input'])
+    options['min_nick_length'] = w.config_integer(config_option['min_nick_length'])
+    options['nick_prefixes']   = w.config_string(config_option['nick_prefixes'])
+    options['nick_suffixes']   = w.config_string(config_option['nick_suffixes'])
+    options['ignore_tags']     = set(w.config_string(config_option['ignore_tags']).split(','))
+
+    return w.WEECHAT_RC_OK
+
+def stats_info_cb(data, info_name, arguments):
+    ''' Callback that returns the number of colorized lines and of weechat API calls
+    done for them; the counters are reset if arguments is 'reset'. '''
+
+    lines     = stats['lines']
+    api_calls = stats['api_calls']
+    per_line  = api_calls / lines if lines else 0
+
+    if arguments == 'reset':
+        stats['lines']     = 0
+        stats['api_calls'] = 0
+
+    return f'lines={lines} api_calls={api_calls} api_calls_per_line={per_line:.2f}'
+
 def update_blacklist_cb(*args):
     ''' Callback that sets the blacklist for channels and nicks. '''
 
@@ -905,7 +1012,124 @@ def update_blacklist_cb(*args):
 
     return w.WEECHAT_RC_OK
 
-if __name__ == '__main__':
+def benchmark_colorize(nick_count=2000, line_count=5000):
+    ''' Times finding and colorizing nicks in lines, with colorize_nicks() and with
+    the regexes of version 33, and checks that both give the same lines. Does not
+    need WeeChat:
+      python colorize_nicks.py --benchmark '''
+
+    import random
+    import time
+
+    rand = random.Random(0)
+
+    min_len  = 1
+    prefixes = '~&@%+'
+    suffixes = ':,'
+    buffer   = 'benchmark'
+
+    def colorize_nicks_regex(line):
+        ''' Version 33 of colorize_nicks(), that compiled two regexes for each word
+        and searched the rest of the line for each nick found. '''
+
+        nicks            = colored_nicks[buffer]
+        chop_line        = line
+        chop_after_match = ''
+        color_match      = ''
+
+        for word in re.split(f'{space}+', line.strip(space)):
+            if word == '':
+                continue
+
+            nicks_rgx = rf'[{prefixes}]? (?P<nick> [^ ]+)'
+            if (nick := re.search(nicks_rgx, word, flags=re.VERBOSE)) is not None:
+                nick = re.escape(nick.group('nick'))
+
+            if nick not in nicks and re.search(rf'[{suffixes}]$', nick) is not None:
+                nick = nick[:-1]
+
+            if nick not in nicks or nick in ignore_nicks or len(nick) < min_len:
+                continue
+
+            line_rgx = rf'''
+                           (?: \A | [ ])
+                           (?P<pref> [{prefixes}])?
+                           (?P<nick> {nick})
+                           [{suffixes}]?
+                           (?: \Z | [ ])
+                       '''
+            if (line_match := re.search(line_rgx, chop_line, flags=re.VERBOSE)) is not None:
+                start       = line_match.start('nick')
+                nick_prefix = ''
+
+                if (pref_match := line_match.group('pref')) is not None:
+                    if pref_match == nicks[nick]['prefix_char']:
+                        nick_prefix = nicks[nick]['prefix']
+                        start       = line_match.start('pref')
+
+                end              = line_match.end('nick')
+                chop_till_match  = chop_line[:end]
+                chop_after_match = chop_line[end:]
+                nick_str         = f"{nick_prefix}{nicks[nick]['color']}{nick}{reset}"
+                color_match     += f'{chop_till_match[:start]}{nick_str}{chop_till_match[end:]}'
+                chop_line        = chop_after_match
+
+        if color_match:
+            return f'{color_match}{chop_after_match}'
+
+        return ''
+
+    # Nicks of a busy channel, some of them with a prefix in the nicklist.
+    chars = 'abcdefghijklmnopqrstuvwxyz0123456789_'
+    nicks = set()
+    while len(nicks) < nick_count:
+        nicks.add(rand.choice(chars[:26]) + ''.join(rand.choice(chars) for i in range(rand.randint(2, 12))))
+
+    colored_nicks[buffer] = {}
+    for i, nick in enumerate(sorted(nicks)):
+        prefix_char = rand.choice('@+') if i % 3 == 0 else ''
+        colored_nicks[buffer][nick] = {
+                'color':       f'\031F{i % 16:02d}',
+                'prefix':      f'\031F05{prefix_char}' if prefix_char else '',
+                'prefix_char': prefix_char,
+        }
+
+    # Lines where about a word out of four is a nick, addressed with or without
+    # a prefix and suffix.
+    words = ['hello', 'the', 'is', 'a', 'foo', 'bar::', '@', '+', ':', ',', 'and', 'x']
+    nick_list = sorted(nicks)
+
+    def random_word():
+        if rand.random() < 0.25:
+            return rand.choice(['', '', '@', '+', '%']) + rand.choice(nick_list) + rand.choice(['', '', ':', ',', '::'])
+
+        return rand.choice(words)
+
+    lines = [' '.join(random_word() for i in range(rand.randint(1, 20))) for i in range(line_count)]
+
+    compile_regexes()
+
+    try:
+        for line in lines:
+            assert colorize_nicks(buffer, min_len, prefixes, suffixes, None, line) == colorize_nicks_regex(line), line
+
+        print(f'{line_count} lines, {nick_count} nicks')
+
+        start = time.perf_counter()
+        for line in lines:
+            colorize_nicks_regex(line)
+        elapsed = time.perf_counter() - start
+        print(f'  regexes for each word (version 33): {elapsed:.3f} s ({line_count / elapsed:.0f} lines/s)')
+
+        start = time.perf_counter()
+        for line in lines:
+            colorize_nicks(buffer, min_len, prefixes, suffixes, None, line)
+        elapsed = time.perf_counter() - start
+        print(f'  single pass on the line:            {elapsed:.3f} s ({line_count / elapsed:.0f} lines/s)')
+    finally:
+        del colored_nicks[buffer]
+
+if __name__ == '__main__' and import_ok:
     if w.register(SCRIPT_NAME, SCRIPT_AUTHOR, SCRIPT_VERSION, SCRIPT_LICENSE, SCRIPT_DESC, '', ''):
         # Initialize config options and regexes.
         try:
@@ -919,9 +1143,11 @@ if __name__ == '__main__':
         config_read()
         compile_regexes()
 
+        weechat_version = int(w.info_get('version_number', '') or 0)
+
         # Run once to get data ready.
+        config_cache_cb()
         update_blacklist_cb()
-        populate_nicks_cb()
 
         # Hooks
 
@@ -934,10 +1160,24 @@ if __name__ == '__main__':
         w.hook_signal('nicklist_nick_removed', 'remove_nick_cb', '')
         w.hook_signal('buffer_closing', 'remove_priv_buffer_cb', '')
 
-        # Repopulate nicks on colors changes from weechat's options.
-        w.hook_config('weechat.color.chat_nick_colors', 'populate_nicks_cb', '')
-        w.hook_config('weechat.look.nick_color_hash', 'populate_nicks_cb', '')
-        w.hook_config('irc.color.nick_prefixes', 'populate_nicks_cb', '')
+        # Forget cached buffer local variables.
+        for signal in ('buffer_localvar_added', 'buffer_localvar_changed', 'buffer_localvar_removed',
+                       'buffer_renamed', 'buffer_closed'):
+            w.hook_signal(signal, 'buffer_vars_cb', '')
 
-        # Update blacklists.
+        # Forget nicks on colors changes from weechat's options.
+        w.hook_config('weechat.color.chat_nick_colors', 'reset_nicks_cb', '')
+        w.hook_config('weechat.color.chat_nick_self', 'reset_nicks_cb', '')
+        w.hook_config('weechat.look.nick_color_*', 'reset_nicks_cb', '')
+        w.hook_config('irc.color.nick_prefixes', 'reset_nicks_cb', '')
+
+        # Update blacklists and options snapshot.
         w.hook_config(f'{SCRIPT_NAME}.look.ignore_*', 'update_blacklist_cb', '')
+        w.hook_config(f'{SCRIPT_NAME}.look.*', 'config_cache_cb', '')
+
+        # Stats
+        w.hook_info('colorize_nicks_stats', 'number of colorized lines and weechat API calls done for them',
+                    'reset: reset counters (optional)', 'stats_info_cb', '')
+
+elif __name__ == '__main__' and '--benchmark' in sys.argv[1:]:
+    benchmark_colorize()
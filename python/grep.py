@@ -56,10 +56,32 @@
 #   * plugins.var.python.grep.timeout_secs:
 #     Timeout (in seconds) for background grepping.
 #
+#   * plugins.var.python.grep.buffer_time_slice:
+#     Buffers are searched in steps of this many milliseconds, so WeeChat isn't blocked while
+#     searching big buffers, and results are shown as soon as each buffer is done. '0' searches
+#     buffers in one go.
+#
+#   * plugins.var.python.grep.background_workers:
+#     Number of processes used for grepping logs in background, '0' uses one per CPU core. With
+#     more than one, results are shown as soon as each log is done, and --head stops the search
+#     when the number of matches is reached in all logs.
+#
 #   * plugins.var.python.grep.default_tail_head:
 #     Config option for define default number of lines returned when using --head or --tail options.
 #     Can be overriden in the command with --number option.
 #
+#   * plugins.var.python.grep.index:
+#     Keep an index of the logs for faster searches, it's updated in background. Searches
+#     that can't use the index (--invert, context options, patterns without literal text or logs
+#     changed since last update) search the whole log as usual. Valid values: on, off
+#
+#   * plugins.var.python.grep.index_interval:
+#     Interval (in seconds) between background updates of the log index, '0' disables them.
+#
+#
+#   Benchmarks:
+#     Run 'python3 grep.py benchmark [log file]' outside WeeChat.
+#
 #
 #   TODO:
 #   * try to figure out why hook_process chokes in long outputs (using a tempfile as a
@@ -69,6 +91,29 @@
 #
 #   History:
 #
+#   2026-10-18
+#   version 0.9.2: search plain strings and anchored patterns with string methods instead of
+#   regexps, cache compiled patterns between searches
+#
+#   2026-10-18
+#   version 0.9.1: search buffers walking lines with hdata instead of the buffer_lines infolist,
+#   in steps of buffer_time_slice milliseconds
+#
+#   2026-10-18
+#   version 0.9.0: send background results as line records decoded as they arrive, instead of
+#   a pickle; add benchmarks (python3 grep.py benchmark)
+#
+#   2026-10-18
+#   version 0.8.9: grep logs in background with several processes and show results while
+#   searching (background_workers option)
+#
+#   2026-10-18
+#   version 0.8.8: read logs backwards in blocks for --tail and keep only the context lines in
+#   memory for --before-context, instead of reading the whole log
+#
+#   2026-10-18
+#   version 0.8.7: add a persistent index of the logs (index and index_interval options)
+#
 #   2022-11-11, anonymous2ch
 #   version 0.8.6: ignore utf-8 decoding errors
 #
@@ -226,13 +271,18 @@
 ###
 
 from os import path
-import sys, getopt, time, os, re
+import sys, getopt, time, os, re, io, locale, collections
 
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
 try:
     import weechat
     from weechat import WEECHAT_RC_OK, prnt, prnt_date_tags
@@ -242,7 +292,7 @@ except ImportError:
 
 SCRIPT_NAME    = "grep"
 SCRIPT_AUTHOR  = "Elián Hanisch <lambdae2@gmail.com>"
-SCRIPT_VERSION = "0.8.6"
+SCRIPT_VERSION = "0.9.2"
 SCRIPT_LICENSE = "GPL3"
 SCRIPT_DESC    = "Search in buffers and logs"
 SCRIPT_COMMAND = "grep"
@@ -257,6 +307,10 @@ settings = {
     'size_limit'        : '2048',
     'default_tail_head' : '10',
     'timeout_secs'      : '300',
+    'index'             : 'off',
+    'index_interval'    : '600',
+    'background_workers': '0',
+    'buffer_time_slice' : '20',
 }
 
 ### Class definitions ###
@@ -373,6 +427,7 @@ class linesList(list):
 
 ### Misc functions ###
 now = time.time
+log_encoding = locale.getpreferredencoding(False)
 def get_size(f):
     try:
         return os.stat(f).st_size
@@ -664,9 +719,611 @@ def get_all_buffers():
         del buffers[buffers.index(grep_buffer)]
     return buffers
 
+### Log index ###
+# The index is a SQLite database mapping trigrams of the (ascii lowercased) log contents to the
+# blocks of each log where they appear. A block is a run of complete lines of roughly
+# index_block_size bytes. Searching only needs to run the regexp on the blocks that contain every
+# trigram required by the pattern, plus any data appended to the log since it was indexed.
+index_block_size = 64 * 1024
+index_batch_size = 64 * 1024 * 1024 # flush postings to the database every 64 MiB of indexed data
+index_head_size = 256 # bytes used for detecting logs that were replaced
+index_version = 1 # increase when the indexed trigrams change, older indexes are rebuilt
+# re.IGNORECASE matches these chars to ascii letters, so blocks are also indexed with them folded
+index_folds = [ (char.encode('utf-8'), letter) for char, letter in
+        ((u'\u212a', b'k'), (u'\u017f', b's'), (u'\u0130', b'i'), (u'\u0131', b'i')) ]
+hook_index = None
+
+def get_index_path():
+    options = {
+        'directory': 'cache',
+    }
+    return weechat.string_eval_path_home('%h/grep_index.db', {}, {}, options)
+
+def index_connect(readonly=False):
+    """Returns a connection to the index database or None."""
+    global index_path
+    if not sqlite3:
+        return None
+    try:
+        if readonly:
+            if not path.isfile(index_path):
+                return None
+            conn = sqlite3.connect('file:%s?mode=ro' % index_path, uri=True)
+            if conn.execute('PRAGMA user_version').fetchone()[0] != index_version:
+                # not usable until the next update rebuilds it
+                conn.close()
+                return None
+        else:
+            conn = sqlite3.connect(index_path)
+            conn.execute('PRAGMA journal_mode=WAL')
+            if conn.execute('PRAGMA user_version').fetchone()[0] != index_version:
+                conn.executescript("""
+                    DROP TABLE IF EXISTS files;
+                    DROP TABLE IF EXISTS blocks;
+                    DROP TABLE IF EXISTS postings;
+                    PRAGMA user_version = %d;
+                    """ % index_version)
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS files (
+                    id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, mtime REAL,
+                    head BLOB, blocks INTEGER);
+                CREATE TABLE IF NOT EXISTS blocks (
+                    file_id INTEGER, block INTEGER, start INTEGER, end INTEGER,
+                    PRIMARY KEY (file_id, block));
+                CREATE TABLE IF NOT EXISTS postings (
+                    trigram INTEGER, file_id INTEGER, blocks BLOB);
+                CREATE INDEX IF NOT EXISTS postings_idx ON postings (file_id, trigram);
+                """)
+        return conn
+    except sqlite3.Error:
+        return None
+
+def varint_encode(numbers):
+    """Encodes a sorted list of integers as delta varints."""
+    out = bytearray()
+    append = out.append
+    last = 0
+    for n in numbers:
+        n, last = n - last, n
+        while n > 0x7f:
+            append((n & 0x7f) | 0x80)
+            n >>= 7
+        append(n)
+    return bytes(out)
+
+def varint_decode(data):
+    """Decodes a list of integers encoded with varint_encode()."""
+    numbers = []
+    append = numbers.append
+    n = shift = last = 0
+    for byte in bytearray(data):
+        n |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            last += n
+            append(last)
+            n = shift = 0
+    return numbers
+
+def block_trigrams(data, fold=False):
+    """Returns the set of trigrams (as integers) in 'data'. With 'fold', the trigrams of 'data'
+    with index_folds applied are included too."""
+    data = data.lower()
+    trigrams = set(zip(data, data[1:], data[2:]))
+    if fold:
+        folded = data
+        for char, letter in index_folds:
+            folded = folded.replace(char, letter)
+        if folded != data:
+            trigrams.update(zip(folded, folded[1:], folded[2:]))
+    return [ (a << 16) | (b << 8) | c for a, b, c in trigrams ]
+
+def index_update_file(conn, file):
+    """Indexes the data appended to 'file' since last update. Returns indexed bytes."""
+    try:
+        stat = os.stat(file)
+        file_object = open(file, 'rb')
+    except (IOError, OSError):
+        return 0
+    try:
+        head = file_object.read(index_head_size)
+        row = conn.execute('SELECT id, size, head, blocks FROM files WHERE path = ?',
+                (file, )).fetchone()
+        if row:
+            file_id, start, old_head, block = row
+            if stat.st_size < start or head[:len(old_head)] != old_head:
+                # log was truncated or replaced, index it again
+                index_remove_file(conn, file_id)
+                row = None
+            elif stat.st_size == start:
+                return 0
+        if not row:
+            file_id = conn.execute('INSERT INTO files (path, size, mtime, head, blocks) '
+                    'VALUES (?, 0, 0, ?, 0)', (file, head)).lastrowid
+            start = block = 0
+
+        file_object.seek(start)
+        postings = {}
+        blocks = []
+        batch = total = 0
+        def flush():
+            conn.executemany('INSERT INTO postings VALUES (?, ?, ?)',
+                    [ (trigram, file_id, varint_encode(L)) for trigram, L in postings.items() ])
+            conn.executemany('INSERT INTO blocks VALUES (?, ?, ?, ?)', blocks)
+            conn.execute('UPDATE files SET size = ?, mtime = ?, head = ?, blocks = ? WHERE id = ?',
+                    (start, stat.st_mtime, head, block, file_id))
+            conn.commit()
+            postings.clear()
+            del blocks[:]
+
+        while True:
+            data = file_object.read(index_block_size)
+            if not data:
+                break
+            if data[-1:] != b'\n':
+                # complete the last line, incomplete lines are left for the next update
+                data += file_object.readline()
+                if data[-1:] != b'\n':
+                    data = data[:data.rfind(b'\n') + 1]
+                    if not data:
+                        break
+            for trigram in block_trigrams(data, fold=True):
+                try:
+                    postings[trigram].append(block)
+                except KeyError:
+                    postings[trigram] = [block]
+            blocks.append((file_id, block, start, start + len(data)))
+            start += len(data)
+            block += 1
+            batch += len(data)
+            total += len(data)
+            if batch >= index_batch_size:
+                flush()
+                batch = 0
+        flush()
+        return total
+    finally:
+        file_object.close()
+
+def index_remove_file(conn, file_id):
+    for table in ('postings', 'blocks'):
+        conn.execute('DELETE FROM %s WHERE file_id = ?' % table, (file_id, ))
+    conn.execute('DELETE FROM files WHERE id = ?', (file_id, ))
+    conn.commit()
+
+def index_update(files):
+    """Updates the index for 'files' and removes logs that don't exist anymore."""
+    conn = index_connect()
+    if not conn:
+        raise Exception("Couldn't open index database %s" % index_path)
+    try:
+        size = 0
+        for file in files:
+            size += index_update_file(conn, file)
+        for file_id, file in conn.execute('SELECT id, path FROM files').fetchall():
+            if not path.isfile(file):
+                index_remove_file(conn, file_id)
+        return size
+    finally:
+        conn.close()
+
+def index_process(*args):
+    try:
+        global index_files
+        return 'indexed %s' % human_readable_size(index_update(index_files))
+    except Exception as e:
+        return 'error %s' % e
+
+def index_process_cb(data, command, return_code, out, err):
+    global hook_index
+    if return_code == weechat.WEECHAT_HOOK_PROCESS_ERROR:
+        hook_index = None
+        error('Log indexing timed out')
+    elif return_code >= 0:
+        hook_index = None
+        if out.startswith('error '):
+            error(out[6:])
+        elif err:
+            error(err)
+        elif data:
+            say('Log index updated, %s.' % out, data)
+    return WEECHAT_RC_OK
+
+def index_start(buffer=''):
+    """Updates the index in background, if it isn't already running."""
+    global hook_index, index_files, cache_dir
+    if hook_index or not sqlite3:
+        return
+    home = get_home()
+    cache_dir.pop((home, False), None)
+    index_files = dir_list(home)
+    hook_index = weechat.hook_process('func:index_process', 0, 'index_process_cb', buffer)
+
+def index_timer_cb(data, remaining_calls):
+    if get_config_boolean('index'):
+        index_start()
+    return WEECHAT_RC_OK
+
+def index_timer_hook():
+    global hook_index_timer
+    if hook_index_timer:
+        weechat.unhook(hook_index_timer)
+        hook_index_timer = None
+    interval = get_config_int('index_interval')
+    if interval > 0 and get_config_boolean('index'):
+        hook_index_timer = weechat.hook_timer(interval * 1000, 0, 0, 'index_timer_cb', '')
+
+def index_config_cb(data, option, value):
+    index_timer_hook()
+    if get_config_boolean('index'):
+        index_start()
+    return WEECHAT_RC_OK
+
+def pattern_trigrams(pattern, matchcase=False):
+    """Returns the set of trigrams that any line matching regexp 'pattern' must contain, or None
+    if the pattern can't be used with the index."""
+    # we look for literal runs that every match must include, anything we don't understand ends
+    # the current run. Alternations make all runs optional, so we just give up.
+    runs = []
+    run = []
+    i, n = 0, len(pattern)
+    def skip_class(i):
+        # i points to '[', returns the index after the closing ']'
+        i += 1
+        if i < n and pattern[i] == '^':
+            i += 1
+        if i < n and pattern[i] == ']':
+            i += 1
+        while i < n and pattern[i] != ']':
+            if pattern[i] == '\\':
+                i += 1
+            i += 1
+        return i + 1
+    def end_run():
+        if run:
+            runs.append(''.join(run))
+            del run[:]
+    escapes = {'t': '\t', 'n': '\n', 'r': '\r', 'f': '\f', 'v': '\v', 'a': '\a'}
+    escape_args = {'x': 2, 'u': 4, 'U': 8}
+    if '(?' in pattern:
+        # inline flags could enable case insensitive matching
+        matchcase = False
+    while i < n:
+        c = pattern[i]
+        if c == '\\':
+            i += 1
+            if i >= n:
+                return None
+            c = pattern[i]
+            if c in escapes:
+                run.append(escapes[c])
+            elif c.isalnum():
+                # character classes, anchors, backreferences, etc
+                end_run()
+                if c in escape_args:
+                    i += escape_args[c]
+                elif c == 'N':
+                    i = pattern.find('}', i)
+                    if i < 0:
+                        return None
+                elif c.isdigit():
+                    while i + 1 < n and pattern[i + 1].isdigit():
+                        i += 1
+            else:
+                run.append(c)
+        elif c == '|':
+            return None
+        elif c == '[':
+            end_run()
+            i = skip_class(i)
+            continue
+        elif c == '(':
+            end_run()
+            depth = 0
+            while i < n:
+                c = pattern[i]
+                if c == '\\':
+                    i += 1
+                elif c == '[':
+                    i = skip_class(i)
+                    continue
+                elif c == '(':
+                    depth += 1
+                elif c == ')':
+                    depth -= 1
+                    if not depth:
+                        break
+                i += 1
+        elif c == ')':
+            return None
+        elif c in '*?':
+            # previous char is optional
+            if run:
+                run.pop()
+            end_run()
+        elif c == '{':
+            m = re.match(r'\{(\d*)(,\d*)?\}', pattern[i:])
+            if m:
+                if run and not int(m.group(1) or 0):
+                    run.pop()
+                end_run()
+                i += m.end()
+                continue
+            run.append(c)
+        elif c in '.^$+':
+            end_run()
+        else:
+            run.append(c)
+        i += 1
+    end_run()
+
+    trigrams = set()
+    for run in runs:
+        if not matchcase:
+            # the index is only lowercased for ascii, so with case insensitive search any other
+            # char could match something else
+            parts = re.split(r'[^\x00-\x7f]', run)
+        else:
+            parts = [run]
+        for part in parts:
+            data = part.encode('utf-8').lower()
+            trigrams.update(block_trigrams(data))
+    return trigrams or None
+
+def index_ranges(file, regexp, conn=None):
+    """Returns a list of (start, end) byte ranges of 'file' that may contain matches for 'regexp',
+    or None if the index can't be used and the whole file must be searched."""
+    if regexp is None:
+        return None
+    trigrams = pattern_trigrams(regexp.pattern, not (regexp.flags & re.IGNORECASE))
+    if not trigrams:
+        return None
+    close = not conn
+    if close:
+        conn = index_connect(readonly=True)
+        if not conn:
+            return None
+    try:
+        row = conn.execute('SELECT id, size, head FROM files WHERE path = ?', (file, )).fetchone()
+        if not row:
+            return None
+        file_id, indexed_size, head = row
+        try:
+            size = os.stat(file).st_size
+            with open(file, 'rb') as file_object:
+                if file_object.read(len(head)) != head:
+                    return None
+        except (IOError, OSError):
+            return None
+        if size < indexed_size:
+            # stale index
+            return None
+
+        candidates = None
+        trigrams = list(trigrams)
+        query = 'SELECT trigram, blocks FROM postings WHERE file_id = ? AND trigram IN (%s)' \
+                % ','.join('?' * len(trigrams))
+        postings = dict.fromkeys(trigrams)
+        for trigram, data in conn.execute(query, [file_id] + trigrams):
+            blocks = postings[trigram]
+            if blocks is None:
+                postings[trigram] = blocks = set()
+            blocks.update(varint_decode(data))
+        for blocks in sorted(postings.values(), key=lambda s: s and len(s) or 0):
+            if not blocks:
+                candidates = set()
+                break
+            if candidates is None:
+                candidates = blocks
+            else:
+                candidates &= blocks
+            if not candidates:
+                break
+
+        ranges = []
+        if candidates:
+            candidates = sorted(candidates)
+            query = 'SELECT start, end FROM blocks WHERE file_id = ? AND block IN (%s) ORDER BY block'
+            # sqlite has a limit on the number of parameters
+            for i in range(0, len(candidates), 500):
+                chunk = candidates[i:i+500]
+                ranges.extend(conn.execute(query % ','.join('?' * len(chunk)),
+                    [file_id] + chunk).fetchall())
+        if size > indexed_size:
+            # data logged after the last index update
+            ranges.append((indexed_size, size))
+        return ranges
+    except sqlite3.Error:
+        return None
+    finally:
+        if close:
+            conn.close()
+
+def index_status():
+    """Returns a dict with the indexed size of each log."""
+    conn = index_connect(readonly=True)
+    if not conn:
+        return {}
+    try:
+        return dict(conn.execute('SELECT path, size FROM files'))
+    except sqlite3.Error:
+        return {}
+    finally:
+        conn.close()
+
 ### Grep ###
+_literal_escapes = {'t': '\t', 'n': '\n', 'r': '\r', 'f': '\f', 'v': '\v', 'a': '\a'}
+def literal_pattern(pattern):
+    """Returns the string matched by regexp 'pattern' if it's a plain string, or None."""
+    chars = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '\\':
+            i += 1
+            if i == n:
+                return None
+            c = pattern[i]
+            if c.isalnum():
+                if c not in _literal_escapes:
+                    return None
+                c = _literal_escapes[c]
+        elif c in '.^$*+?{}[]()|':
+            return None
+        chars.append(c)
+        i += 1
+    return ''.join(chars)
+
+class patternMatcher(object):
+    """Compiled search pattern. It has the search() and findall() methods of a compiled regexp,
+    but uses string methods when the pattern is a plain string or is anchored to the start of
+    the line, which is a lot faster than a regexp."""
+    def __init__(self, pattern, matchcase=False):
+        self.pattern = pattern
+        self.flags = not matchcase and re.IGNORECASE or 0
+        self.regexp = re.compile(pattern, self.flags)
+        literal = literal_pattern(pattern)
+        if literal and matchcase:
+            self.kind = 'literal'
+            self.literal = literal
+            self.search = self._search_literal
+            self.findall = self._findall_literal
+        elif literal and literal.isascii():
+            # str.lower() and re.IGNORECASE only agree for ascii, so lines with other chars are
+            # still searched with the regexp
+            self.kind = 'literal_nocase'
+            self.literal = literal.lower()
+            self.search = self._search_literal_nocase
+            self.findall = self.regexp.findall
+        elif pattern[:1] == '^' and '|' not in pattern:
+            self.kind = 'anchored'
+            self.literal = literal_pattern(pattern[1:])
+            if self.literal and matchcase:
+                self.search = self._search_prefix
+            elif self.literal and self.literal.isascii():
+                self.literal = self.literal.lower()
+                self.search = self._search_prefix_nocase
+            else:
+                # match() only tries at the start of the line
+                self.search = self.match = re.compile(pattern[1:], self.flags).match
+            self.findall = self.regexp.findall
+        else:
+            self.kind = 'regexp'
+            self.search = self.regexp.search
+            self.findall = self.regexp.findall
+
+    def _search_literal(self, s):
+        return self.literal in s
+
+    def _findall_literal(self, s):
+        return [self.literal] * s.count(self.literal)
+
+    def _search_prefix(self, s):
+        return s.startswith(self.literal)
+
+    def _search_prefix_nocase(self, s):
+        prefix = s[:len(self.literal)]
+        if prefix.isascii():
+            return prefix.lower() == self.literal
+        return self.regexp.match(s)
+
+    def _search_literal_nocase(self, s):
+        if s.isascii():
+            return self.literal in s.lower()
+        return self.regexp.search(s)
+
+    def check_function(self, hilight='', exact=False, invert=False):
+        """Returns a function like make_check() does, specialized for this pattern."""
+        if self.kind == 'regexp':
+            # nothing to specialize, same as a compiled regexp
+            return make_check(self.regexp, hilight, exact, invert)
+        search = self.search
+        if self.kind == 'literal':
+            literal = self.literal
+            if exact:
+                return lambda s: literal in s and [literal] * s.count(literal) or None
+            elif invert:
+                return lambda s: literal not in s and s or None
+            elif hilight:
+                color_hilight, color_reset = hilight.split(',', 1)
+                colored = '%s%s%s' %(color_hilight, literal, color_reset)
+                return lambda s: literal in s and s.replace(literal, colored) or None
+            return lambda s: literal in s and s or None
+        elif self.kind == 'literal_nocase':
+            # avoid the method call in the most common case
+            literal = self.literal
+            regexp = self.regexp
+            regexp_search = regexp.search
+            if invert:
+                def check(s):
+                    if s.isascii():
+                        return literal not in s.lower() and s or None
+                    return not regexp_search(s) and s or None
+            elif hilight or exact:
+                def check(s):
+                    if s.isascii() and literal not in s.lower():
+                        return None
+                    return check_string(s, regexp, hilight, exact)
+            else:
+                def check(s):
+                    if s.isascii():
+                        return literal in s.lower() and s or None
+                    return regexp_search(s) and s or None
+            return check
+        elif invert:
+            return lambda s: not search(s) and s or None
+        elif (hilight or exact) and self.kind == 'anchored' and not self.regexp.groups:
+            # there's only one match, at the start of the line, so use it instead of searching
+            # the line again with findall()
+            prefix = self.prefix_function()
+            if exact:
+                def check(s):
+                    text = prefix(s)
+                    return text is not None and [text] or None
+            else:
+                color_hilight, color_reset = hilight.split(',', 1)
+                def check(s):
+                    text = prefix(s)
+                    if text is None:
+                        return None
+                    return s.replace(text, '%s%s%s' %(color_hilight, text, color_reset))
+            return check
+        elif hilight or exact:
+            # findall() alone tells if the line matches
+            regexp = self.regexp
+            return lambda s: check_string(s, regexp, hilight, exact)
+        return lambda s: search(s) and s or None
+
+    def prefix_function(self):
+        """For anchored patterns, returns a function that returns the text matched at the start
+        of a line, or None."""
+        literal = self.literal
+        if literal and self.search == self._search_prefix:
+            return lambda s: s.startswith(literal) and literal or None
+        elif literal:
+            n = len(literal)
+            match = self.regexp.match
+            def prefix(s):
+                text = s[:n]
+                if text.isascii():
+                    return text.lower() == literal and text or None
+                m = match(s)
+                return m.group() if m else None
+            return prefix
+        match = self.match
+        def prefix(s):
+            m = match(s)
+            return m.group() if m else None
+        return prefix
+
+    def __repr__(self):
+        return '<patternMatcher %s %r>' %(self.kind, self.pattern)
+
+matcher_cache = collections.OrderedDict()
+matcher_cache_size = 32
 def make_regexp(pattern, matchcase=False):
-    """Returns a compiled regexp."""
+    """Returns a compiled pattern (see patternMatcher), matchers are cached between searches."""
     if pattern in ('.', '.*', '.?', '.+'):
         # because I don't need to use a regexp if we're going to match all lines
         return None
@@ -675,17 +1332,23 @@ def make_regexp(pattern, matchcase=False):
         pattern = pattern[2:]
     if pattern[-2:] == '.*':
         pattern = pattern[:-2]
+    key = (pattern, bool(matchcase))
     try:
-        if not matchcase:
-            regexp = re.compile(pattern, re.IGNORECASE)
-        else:
-            regexp = re.compile(pattern)
+        matcher_cache.move_to_end(key)
+        return matcher_cache[key]
+    except KeyError:
+        pass
+    try:
+        matcher = patternMatcher(pattern, matchcase)
     except Exception as e:
         raise Exception('Bad pattern, %s' % e)
-    return regexp
+    matcher_cache[key] = matcher
+    if len(matcher_cache) > matcher_cache_size:
+        matcher_cache.popitem(last=False)
+    return matcher
 
 def check_string(s, regexp, hilight='', exact=False):
-    """Checks 's' with a regexp and returns it if is a match."""
+    """Checks 's' with a regexp (or patternMatcher) and returns it if is a match."""
     if not regexp:
         return s
 
@@ -714,186 +1377,167 @@ def check_string(s, regexp, hilight='', exact=False):
     elif regexp.search(s):
         return s
 
-def grep_file(file, head, tail, after_context, before_context, count, regexp, hilight, exact, invert):
-    """Return a list of lines that match 'regexp' in 'file', if no regexp returns all lines."""
-    if count:
-        tail = head = after_context = before_context = False
-        hilight = ''
-    elif exact:
-        before_context = after_context = False
-        hilight = ''
-    elif invert:
-        hilight = ''
-    #debug(' '.join(map(str, (file, head, tail, after_context, before_context))))
-
+def reverse_lines(file_object, block_size=64*1024):
+    """Yields the lines of 'file_object' (opened in binary mode) from the last one to the first
+    one, reading the file backwards in blocks of 'block_size' bytes."""
+    file_object.seek(0, os.SEEK_END)
+    position = file_object.tell()
+    encoding = log_encoding
+    buf = suffix = b''
+    while position > 0:
+        size = min(block_size, position)
+        position -= size
+        file_object.seek(position)
+        pieces = (file_object.read(size) + buf).split(b'\n')
+        # first piece may be an incomplete line, keep it for the next block
+        buf = pieces.pop(0)
+        for piece in reversed(pieces):
+            if piece or suffix:
+                if piece[-1:] == b'\r':
+                    piece = piece[:-1]
+                yield (piece + suffix).decode(encoding, 'ignore')
+            suffix = b'\n'
+    if buf or suffix:
+        if buf[-1:] == b'\r':
+            buf = buf[:-1]
+        yield (buf + suffix).decode(encoding, 'ignore')
+
+def grep_lines(file_lines, check, count, after_context, before_context, limit):
+    """Return a list of the lines from the iterable 'file_lines' that pass 'check', with context
+    lines. Only 'before_context' lines are kept in memory, so 'file_lines' can be a generator."""
     lines = linesList()
+    for step in grep_lines_steps(file_lines, lines, check, count, after_context, before_context,
+            limit):
+        pass
+    return lines
+
+def grep_lines_steps(file_lines, lines, check, count, after_context, before_context, limit):
+    """Generator that does the work of grep_lines(), appending to 'lines'. It yields whenever
+    'file_lines' yields None, so a long search can be split in several steps."""
     # define these locally as it makes the loop run slightly faster
     append = lines.append
     count_match = lines.count_match
     separator = lines.append_separator
-    if invert:
-        def check(s):
-            if check_string(s, regexp, hilight, exact):
-                return None
-            else:
-                return s
-    else:
-        check = lambda s: check_string(s, regexp, hilight, exact)
-
-    try:
-        file_object = open(file, 'r', errors='ignore')
-    except IOError:
-        # file doesn't exist
-        return lines
-    if tail or before_context:
-        # for these options, I need to seek in the file, but is slower and uses a good deal of
-        # memory if the log is too big, so we do this *only* for these options.
-        file_lines = file_object.readlines()
 
-        if tail:
-            # instead of searching in the whole file and later pick the last few lines, we
-            # reverse the log, search until count reached and reverse it again, that way is a lot
-            # faster
-            file_lines.reverse()
-            # don't invert context switches
-            before_context, after_context = after_context, before_context
-
-        if before_context:
-            before_context_range = list(range(1, before_context + 1))
-            before_context_range.reverse()
-
-        limit = tail or head
-
-        line_idx = 0
-        while line_idx < len(file_lines):
-            line = file_lines[line_idx]
-            line = check(line)
-            if line:
-                if before_context:
-                    separator()
-                    trimmed = False
-                    for id in before_context_range:
-                        try:
-                            context_line = file_lines[line_idx - id]
-                            if check(context_line):
-                                # match in before context, that means we appended these same lines in a
-                                # previous match, so we delete them merging both paragraphs
-                                if not trimmed:
-                                    del lines[id - before_context - 1:]
-                                    trimmed = True
-                            else:
-                                append(context_line)
-                        except IndexError:
-                            pass
-                append(line)
-                count_match(line)
-                if after_context:
-                    id, offset = 0, 0
-                    while id < after_context + offset:
-                        id += 1
-                        try:
-                            context_line = file_lines[line_idx + id]
-                            _context_line = check(context_line)
-                            if _context_line:
-                                offset = id
-                                context_line = _context_line # so match is hilighted with --hilight
-                                count_match()
-                            append(context_line)
-                        except IndexError:
-                            pass
-                    separator()
-                    line_idx += id
-                if limit and lines.matches_count >= limit:
-                    break
-            line_idx += 1
-
-        if tail:
-            lines.reverse()
-    else:
-        # do a normal grep
-        limit = head
-
-        for line in file_object:
+    if not (after_context or before_context):
+        for line in file_lines:
+            if line is None:
+                yield
+                continue
             line = check(line)
             if line:
                 count or append(line)
                 count_match(line)
-                if after_context:
-                    id, offset = 0, 0
-                    while id < after_context + offset:
-                        id += 1
-                        try:
-                            context_line = next(file_object)
-                            _context_line = check(context_line)
-                            if _context_line:
-                                offset = id
-                                context_line = _context_line
-                                count_match()
-                            count or append(context_line)
-                        except StopIteration:
-                            pass
-                    separator()
                 if limit and lines.matches_count >= limit:
                     break
+        return
+
+    # lines before the next match that may be printed as context
+    context = collections.deque(maxlen=before_context or 1)
+    after = 0 # context lines still to be printed after the last match
+    skipped = False # lines were skipped since the last printed line
+    for line in file_lines:
+        if line is None:
+            yield
+            continue
+        _line = check(line)
+        if _line:
+            if skipped:
+                separator()
+                skipped = False
+            if before_context:
+                for context_line in context:
+                    append(context_line)
+                context.clear()
+            append(_line)
+            count_match(_line)
+            after = after_context
+        elif after:
+            append(line)
+            after -= 1
+        else:
+            if limit and lines.matches_count >= limit:
+                break
+            if before_context:
+                if len(context) == before_context:
+                    skipped = True
+                context.append(line)
+            else:
+                skipped = True
+            continue
+        if limit and lines.matches_count >= limit and not after:
+            break
 
+def grep_ranges(file, ranges, head, tail, count, check):
+    """Return a list of lines that pass 'check' in the (start, end) byte ranges of 'file'."""
+    try:
+        file_object = open(file, 'rb')
+    except IOError:
+        return linesList()
+    def read_ranges():
+        for start, end in (tail and reversed(ranges) or ranges):
+            file_object.seek(start)
+            data = file_object.read(end - start)
+            # decode like a file opened with open(file, 'r', errors='ignore')
+            file_lines = io.TextIOWrapper(io.BytesIO(data), errors='ignore').readlines()
+            if tail:
+                file_lines.reverse()
+            for line in file_lines:
+                yield line
+    lines = grep_lines(read_ranges(), check, count, False, False, head or tail)
     file_object.close()
+
+    if tail:
+        lines.reverse()
     return lines
 
-def grep_buffer(buffer, head, tail, after_context, before_context, count, regexp, hilight, exact,
-        invert):
-    """Return a list of lines that match 'regexp' in 'buffer', if no regexp returns all lines."""
-    lines = linesList()
+def grep_file(file, head, tail, after_context, before_context, count, regexp, hilight, exact, invert,
+        index=False):
+    """Return a list of lines that match 'regexp' in 'file', if no regexp returns all lines."""
     if count:
         tail = head = after_context = before_context = False
         hilight = ''
     elif exact:
         before_context = after_context = False
-    #debug(' '.join(map(str, (tail, head, after_context, before_context, count, exact, hilight))))
+        hilight = ''
+    elif invert:
+        hilight = ''
+    #debug(' '.join(map(str, (file, head, tail, after_context, before_context))))
 
-    # Using /grep in grep's buffer can lead to some funny effects
-    # We should take measures if that's the case
-    def make_get_line_funcion():
-        """Returns a function for get lines from the infolist, depending if the buffer is grep's or
-        not."""
-        string_remove_color = weechat.string_remove_color
-        infolist_string = weechat.infolist_string
-        grep_buffer = weechat.buffer_search('python', SCRIPT_NAME)
-        if grep_buffer and buffer == grep_buffer:
-            def function(infolist):
-                prefix = infolist_string(infolist, 'prefix')
-                message = infolist_string(infolist, 'message')
-                if prefix: # only our messages have prefix, ignore it
-                    return None
-                return message
+    check = make_check(regexp, hilight, exact, invert)
+
+    if index and not (invert or after_context or before_context):
+        ranges = index_ranges(file, regexp)
+        if ranges is not None:
+            return grep_ranges(file, ranges, head, tail, count, check)
+
+    try:
+        if tail:
+            file_object = open(file, 'rb')
         else:
-            infolist_time = weechat.infolist_time
-            def function(infolist):
-                prefix = string_remove_color(infolist_string(infolist, 'prefix'), '')
-                message = string_remove_color(infolist_string(infolist, 'message'), '')
-                date = infolist_time(infolist, 'date')
-                # since WeeChat 2.2, infolist_time returns a long integer
-                # instead of a string
-                if not isinstance(date, str):
-                    date = time.strftime('%F %T', time.localtime(int(date)))
-                return '%s\t%s\t%s' %(date, prefix, message)
-        return function
-    get_line = make_get_line_funcion()
-
-    infolist = weechat.infolist_get('buffer_lines', buffer, '')
+            file_object = open(file, 'r', errors='ignore')
+    except IOError:
+        # file doesn't exist
+        return linesList()
     if tail:
-        # like with grep_file() if we need the last few matching lines, we move the cursor to
-        # the end and search backwards
-        infolist_next = weechat.infolist_prev
-        infolist_prev = weechat.infolist_next
+        # instead of searching in the whole file and later pick the last few lines, we read the
+        # log backwards and search until count is reached, that way we never read more than we
+        # need and memory use doesn't depend on the log size.
+        # don't invert context switches
+        lines = grep_lines(reverse_lines(file_object), check, count, before_context,
+                after_context, tail)
+        lines.reverse()
     else:
-        infolist_next = weechat.infolist_next
-        infolist_prev = weechat.infolist_prev
-    limit = head or tail
+        lines = grep_lines(file_object, check, count, after_context, before_context, head)
 
-    # define these locally as it makes the loop run slightly faster
-    append = lines.append
-    count_match = lines.count_match
-    separator = lines.append_separator
+    file_object.close()
+    return lines
+
+def make_check(regexp, hilight, exact, invert):
+    """Returns a function that returns the line, or the matches with 'exact', if it passes the
+    search."""
+    if isinstance(regexp, patternMatcher):
+        return regexp.check_function(hilight, exact, invert)
     if invert:
         def check(s):
             if check_string(s, regexp, hilight, exact):
@@ -902,59 +1546,193 @@ def grep_buffer(buffer, head, tail, after_context, before_context, count, regexp
                 return s
     else:
         check = lambda s: check_string(s, regexp, hilight, exact)
+    return check
+
+_color_re = re.compile('[\x19-\x1c]')
+def buffer_lines(buffer, reverse=False, step=0):
+    """Yields the lines of 'buffer' from first to last (or the other way with 'reverse') as tab
+    separated date, prefix and message, without colors. If 'step' is set, yields None every 'step'
+    lines, and stops if the buffer or the current line were freed meanwhile."""
+    hdata_buffer = weechat.hdata_get('buffer')
+    hdata_lines = weechat.hdata_get('lines')
+    hdata_line = weechat.hdata_get('line')
+    hdata_line_data = weechat.hdata_get('line_data')
+    # define these locally as it makes the loop run slightly faster
+    hdata_pointer = weechat.hdata_pointer
+    hdata_string = weechat.hdata_string
+    hdata_time = weechat.hdata_time
+    hdata_move = weechat.hdata_move
+    search_color = _color_re.search
+    string_remove_color = weechat.string_remove_color
+
+    own_lines = hdata_pointer(hdata_buffer, buffer, 'own_lines')
+    line = hdata_pointer(hdata_lines, own_lines, reverse and 'last_line' or 'first_line')
+    direction = reverse and -1 or 1
+    # Using /grep in grep's buffer can lead to some funny effects
+    # We should take measures if that's the case
+    grep_buffer = weechat.buffer_search('python', SCRIPT_NAME)
+    in_grep_buffer = grep_buffer and buffer == grep_buffer
+    last_date = date = None
+    n = 0
+    while line:
+        data = hdata_pointer(hdata_line, line, 'data')
+        prefix = hdata_string(hdata_line_data, data, 'prefix')
+        message = hdata_string(hdata_line_data, data, 'message')
+        if in_grep_buffer:
+            if not prefix: # only our messages have prefix, ignore them
+                yield message
+        else:
+            # most messages don't have colors
+            if search_color(prefix):
+                prefix = string_remove_color(prefix, '')
+            if search_color(message):
+                message = string_remove_color(message, '')
+            line_date = hdata_time(hdata_line_data, data, 'date')
+            if line_date != last_date:
+                last_date = line_date
+                date = time.strftime('%F %T', time.localtime(line_date))
+            yield '%s\t%s\t%s' %(date, prefix, message)
+        line = hdata_move(hdata_line, line, direction)
+        n += 1
+        if step and n % step == 0:
+            yield None
+            # WeeChat may have freed the buffer or the lines while we were waiting
+            if not weechat.hdata_check_pointer(hdata_buffer,
+                    weechat.hdata_get_list(hdata_buffer, 'gui_buffers'), buffer):
+                return
+            if line and not weechat.hdata_check_pointer(hdata_line,
+                    hdata_pointer(hdata_lines, own_lines, 'first_line'), line):
+                return
 
-    if before_context:
-        before_context_range = reversed(range(1, before_context + 1))
+def grep_buffer(buffer, head, tail, after_context, before_context, count, regexp, hilight, exact,
+        invert):
+    """Return a list of lines that match 'regexp' in 'buffer', if no regexp returns all lines."""
+    lines = linesList()
+    for step in grep_buffer_steps(lines, buffer, head, tail, after_context, before_context, count,
+            regexp, hilight, exact, invert):
+        pass
+    return lines
 
-    while infolist_next(infolist):
-        line = get_line(infolist)
-        if line is None: continue
-        line = check(line)
-        if line:
-            if before_context:
-                separator()
-                trimmed = False
-                for id in before_context_range:
-                    if not infolist_prev(infolist):
-                        trimmed = True
-                for id in before_context_range:
-                    context_line = get_line(infolist)
-                    if check(context_line):
-                        if not trimmed:
-                            del lines[id - before_context - 1:]
-                            trimmed = True
-                    else:
-                        append(context_line)
-                    infolist_next(infolist)
-            count or append(line)
-            count_match(line)
-            if after_context:
-                id, offset = 0, 0
-                while id < after_context + offset:
-                    id += 1
-                    if infolist_next(infolist):
-                        context_line = get_line(infolist)
-                        _context_line = check(context_line)
-                        if _context_line:
-                            context_line = _context_line
-                            offset = id
-                            count_match()
-                        append(context_line)
-                    else:
-                        # in the main loop infolist_next will start again an cause an infinite loop
-                        # this will avoid it
-                        infolist_next = lambda x: 0
-                separator()
-            if limit and lines.matches_count >= limit:
-                break
-    weechat.infolist_free(infolist)
+def grep_buffer_steps(lines, buffer, head, tail, after_context, before_context, count, regexp,
+        hilight, exact, invert, step=0):
+    """Generator that does the work of grep_buffer(), appending to 'lines'. With 'step' it yields
+    every 'step' lines, so the search can be split in several timer calls."""
+    if count:
+        tail = head = after_context = before_context = False
+        hilight = ''
+    elif exact:
+        before_context = after_context = False
+    #debug(' '.join(map(str, (tail, head, after_context, before_context, count, exact, hilight))))
 
+    check = make_check(regexp, hilight, exact, invert)
+    if tail:
+        # like with grep_file() if we need the last few matching lines, we start from the end and
+        # search backwards
+        steps = grep_lines_steps(buffer_lines(buffer, reverse=True, step=step), lines, check,
+                count, before_context, after_context, tail)
+    else:
+        steps = grep_lines_steps(buffer_lines(buffer, step=step), lines, check, count,
+                after_context, before_context, head)
+    for s in steps:
+        yield
     if tail:
         lines.reverse()
-    return lines
+
+### Background results ###
+# Results of background greps are sent to WeeChat as utf-8 text, one record per line:
+#   'F<lines> <matches> <stripped lines> <log name>': start of the results of a log, followed by
+#                                                   <lines> line records
+#   ' <line>': matched line, its trailing newline removed
+#   '\\<line>': matched line with newlines, NUL chars and backslashes escaped
+#   'E<error>': the search failed
+# WeeChat can't pass NUL chars to the callback, but log lines rarely have them (or newlines other
+# than the trailing one), so most lines are sent as they are. Records can be decoded as soon as
+# they arrive, unlike a pickle.
+_wire_escapes = {'\\': '\\\\', '\n': '\\n', '\x00': '\\0'}
+_wire_unescapes = {'\\\\': '\\', '\\n': '\n', '\\0': '\x00'}
+_wire_escape_re = re.compile(r'[\\\n\x00]')
+_wire_unescape_re = re.compile(r'\\[\\n0]')
+
+def wire_escape(s):
+    return _wire_escape_re.sub(lambda m: _wire_escapes[m.group()], s)
+
+def wire_unescape(s):
+    return _wire_unescape_re.sub(lambda m: _wire_unescapes[m.group()], s)
+
+def wire_line(line):
+    """Returns the record for a line that can't be sent as it is."""
+    return '\\' + wire_escape(line)
+
+def results_encode(results):
+    """Encodes a dict of log name -> linesList, or an exception, for sending it to WeeChat."""
+    if isinstance(results, Exception):
+        return ('E%s\n' % wire_escape(repr(results))).encode('utf-8')
+    out = []
+    for log_name, lines in results.items():
+        out.append('F%d %d %d %s' %(len(lines), lines.matches_count, lines.stripped_lines,
+            wire_escape(log_name)))
+        # a line can be sent as it is if its only newline is the trailing one
+        out.extend([ ' ' + line[:-1] if line[-1:] == '\n' and line.find('\n') == len(line) - 1
+                     and '\x00' not in line else wire_line(line) for line in lines ])
+    out.append('')
+    return '\n'.join(out).encode('utf-8')
+
+class resultsDecoder(object):
+    """Incremental decoder of results_encode() output, feed() it with chunks as they arrive."""
+    def __init__(self):
+        self.buffer = b''
+        self.lines = None
+        self.log_name = None
+        self.remaining = 0
+
+    def feed(self, data):
+        """Decodes 'data' and returns a list of (log_name, linesList) of the logs completed."""
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        data, _, self.buffer = (self.buffer + data).rpartition(b'\n')
+        if not data:
+            return []
+        records = data.decode('utf-8').split('\n')
+        done = []
+        i, n = 0, len(records)
+        while i < n:
+            if self.remaining:
+                # lines of the current log
+                block = records[i:i + self.remaining]
+                i += len(block)
+                self.remaining -= len(block)
+                list.extend(self.lines, [ record[1:] + '\n' if record[:1] == ' '
+                                          else wire_unescape(record[1:]) for record in block ])
+            else:
+                record = records[i]
+                i += 1
+                kind = record[:1]
+                if kind == 'F':
+                    n_lines, matches, stripped, log_name = record[1:].split(' ', 3)
+                    self.lines = linesList()
+                    self.lines.matches_count = int(matches)
+                    self.lines.stripped_lines = int(stripped)
+                    self.log_name = wire_unescape(log_name)
+                    self.remaining = int(n_lines)
+                elif kind == 'E':
+                    raise Exception(wire_unescape(record[1:]))
+                else:
+                    raise Exception('Bad record in background grep results: %r' % record[:20])
+            if not self.remaining and self.lines is not None:
+                done.append((self.log_name, self.lines))
+                self.lines = None
+        return done
+
+    def finished(self):
+        """Returns True if all the data fed was decoded."""
+        return not self.buffer and self.lines is None
 
 ### this is our main grep function
 hook_file_grep = None
+hook_buffer_grep = None
+grep_workers = {} # background workers running, log_pairs index -> hook
+grep_queue = [] # log_pairs indexes waiting for a worker
+grep_streaming = False # results are printed while searching
 def show_matching_lines():
     """
     Greps buffers in search_in_buffers or files in search_in_files and updates grep buffer with the
@@ -963,20 +1741,34 @@ def show_matching_lines():
     global pattern, matchcase, number, count, exact, hilight, invert
     global tail, head, after_context, before_context
     global search_in_files, search_in_buffers, matched_lines, home_dir
-    global time_start
+    global time_start, grep_streaming, pattern_tmpl
     matched_lines = linesDict()
     #debug('buffers:%s \nlogs:%s' %(search_in_buffers, search_in_files))
     time_start = now()
+    grep_streaming = False
 
     # buffers
     if search_in_buffers:
         regexp = make_regexp(pattern, matchcase)
+        if get_config_int('buffer_time_slice') > 0:
+            # search a few lines on each timer call, so WeeChat isn't blocked by big buffers
+            grep_stream_start("Searching for '%s' in %s buffers..." % (
+                pattern_tmpl, len(search_in_buffers)))
+            grep_buffers_start(regexp)
+            return
         for buffer in search_in_buffers:
             buffer_name = weechat.buffer_get_string(buffer, 'name')
             matched_lines[buffer_name] = grep_buffer(buffer, head, tail, after_context,
                     before_context, count, regexp, hilight, exact, invert)
 
-    # logs
+    grep_logs()
+
+def grep_logs():
+    """Greps files in search_in_files, then updates grep buffer."""
+    global pattern, matchcase, count, exact, hilight, invert
+    global tail, head, after_context, before_context
+    global search_in_files, matched_lines, pattern_tmpl
+
     if search_in_files:
         size_limit = get_config_int('size_limit', allow_empty_string=True)
         background = False
@@ -991,18 +1783,36 @@ def show_matching_lines():
 
         global grep_options, log_pairs
         grep_options = (head, tail, after_context, before_context,
-                        count, regexp, hilight, exact, invert)
+                        count, regexp, hilight, exact, invert,
+                        bool(sqlite3) and get_config_boolean('index'))
 
         log_pairs = [(strip_home(log), log) for log in search_in_files]
 
         if not background:
             # run grep normally
             for log_name, log in log_pairs:
-                matched_lines[log_name] = grep_file(log, *grep_options)
-            buffer_update()
+                lines = grep_file(log, *grep_options)
+                if grep_streaming:
+                    grep_stream_lines(log_name, lines)
+                else:
+                    matched_lines[log_name] = lines
+            if grep_streaming:
+                grep_stream_end()
+            else:
+                buffer_update()
         else:
-            global hook_file_grep, grep_stdout, grep_stderr, pattern_tmpl
-            grep_stdout = grep_stderr = b''
+            global hook_file_grep, grep_decoder, grep_stderr
+            title = "Searching for '%s' in %s worth of data..." % (
+                pattern_tmpl,
+                human_readable_size(size)
+            )
+            workers = get_config_int('background_workers') or os.cpu_count() or 1
+            if workers > 1 and len(log_pairs) > 1:
+                grep_stream_start(title)
+                grep_pool_start(workers)
+                return
+            grep_decoder = resultsDecoder()
+            grep_stderr = b''
             hook_file_grep = weechat.hook_process(
                 'func:grep_process',
                 get_config_int('timeout_secs') * 1000,
@@ -1010,10 +1820,9 @@ def show_matching_lines():
                 ''
             )
             if hook_file_grep:
-                buffer_create("Searching for '%s' in %s worth of data..." % (
-                    pattern_tmpl,
-                    human_readable_size(size)
-                ))
+                buffer_create(title)
+    elif grep_streaming:
+        grep_stream_end()
     else:
         buffer_update()
 
@@ -1027,54 +1836,252 @@ def grep_process(*args):
     except Exception as e:
         result = e
 
-    return pickle.dumps(result, 0)
+    return results_encode(result)
+
+def set_buffer_error(message):
+    error(message)
+    grep_buffer = buffer_create()
+    title = weechat.buffer_get_string(grep_buffer, 'title')
+    title = title + ' %serror' % color_title
+    weechat.buffer_set(grep_buffer, 'title', title)
 
 def grep_process_cb(data, command, return_code, out, err):
-    global grep_stdout, grep_stderr, matched_lines, hook_file_grep
+    global grep_decoder, grep_stderr, matched_lines, hook_file_grep
 
-    if isinstance(out, str):
-        out = out.encode()
-    grep_stdout += out
+    if hook_file_grep is None:
+        # search was stopped
+        return WEECHAT_RC_OK
 
     if isinstance(err, str):
         err = err.encode()
     grep_stderr += err
 
-    def set_buffer_error(message):
-        error(message)
-        grep_buffer = buffer_create()
-        title = weechat.buffer_get_string(grep_buffer, 'title')
-        title = title + ' %serror' % color_title
-        weechat.buffer_set(grep_buffer, 'title', title)
-
     if return_code == weechat.WEECHAT_HOOK_PROCESS_ERROR:
         set_buffer_error("Background grep timed out")
         hook_file_grep = None
         return WEECHAT_RC_OK
 
-    elif return_code >= 0:
+    try:
+        for log_name, lines in grep_decoder.feed(out):
+            if grep_streaming:
+                grep_stream_lines(log_name, lines)
+            else:
+                matched_lines[log_name] = lines
+        if return_code >= 0 and not grep_decoder.finished():
+            raise Exception('Background grep results are incomplete')
+    except Exception as e:
+        hook_file_grep = None
+        set_buffer_error(repr(e))
+        return WEECHAT_RC_OK
+
+    if return_code >= 0:
         hook_file_grep = None
         if grep_stderr:
             set_buffer_error(grep_stderr)
             return WEECHAT_RC_OK
+        if grep_streaming:
+            grep_stream_end()
+        else:
+            buffer_update()
 
+    return WEECHAT_RC_OK
+
+### Results while searching ###
+# When buffers are searched in steps or logs with several workers, results are printed as soon as
+# each buffer or log is done, instead of waiting for the whole search.
+def grep_stream_start(title):
+    """Prints the search header in our buffer, if not done yet."""
+    global grep_streaming, grep_printed_lines
+    global search_in_files, search_in_buffers
+    if grep_streaming:
+        buffer_create(title)
+        return
+    grep_streaming = True
+    grep_printed_lines = 0
+    n = len(search_in_files) + len(search_in_buffers)
+    if n > 1:
+        where = '%s logs' %n
+    elif search_in_buffers:
+        where = weechat.buffer_get_string(search_in_buffers[0], 'name')
+    else:
+        where = strip_home(search_in_files[0])
+    buffer = buffer_update_start(title, where=where)
+    # buffers searched in one go
+    for log, lines in matched_lines.items():
+        buffer_print_lines(buffer, log, lines)
+
+def grep_stream_lines(log_name, lines):
+    """Prints the matched lines of a log or buffer."""
+    global matched_lines, grep_printed_lines, count
+    matched_lines[log_name] = lines
+    # we can't pick the last lines of all logs, just stop printing when max_lines is reached
+    lines.strip_separator()
+    if not count:
+        max_lines = max(get_config_int('max_lines') - grep_printed_lines, 0)
+        l = len(lines)
+        if l > max_lines:
+            del lines[:l - max_lines]
+            lines.stripped_lines = l - max_lines
+        grep_printed_lines += len(lines)
+    buffer_print_lines(buffer_create(), log_name, lines)
+
+def grep_stream_progress(done, total, what):
+    global pattern_tmpl
+    weechat.buffer_set(buffer_create(), 'title', "Searching for '%s', %s of %s %s done..." % (
+        pattern_tmpl, done, total, what))
+
+def grep_stream_end():
+    """Prints the summary of the search."""
+    global matched_lines, grep_streaming
+    buffer = buffer_create()
+    if not matched_lines.get_matches_count():
+        print_line('No matches found.', buffer)
+    buffer_update_title(buffer, now())
+    grep_streaming = False
+
+### Buffers in steps ###
+def grep_buffers_start(regexp):
+    global hook_buffer_grep, grep_buffers_steps
+    grep_buffers_steps = grep_buffers_iter(regexp)
+    hook_buffer_grep = weechat.hook_timer(1, 0, 0, 'grep_buffers_timer_cb', '')
+
+def grep_buffers_stop():
+    global hook_buffer_grep
+    if hook_buffer_grep:
+        weechat.unhook(hook_buffer_grep)
+        hook_buffer_grep = None
+
+def grep_buffers_iter(regexp):
+    """Generator that greps search_in_buffers, yielding every few lines."""
+    global search_in_buffers, head, tail, after_context, before_context
+    global count, hilight, exact, invert
+    for i, buffer in enumerate(search_in_buffers):
+        buffer_name = weechat.buffer_get_string(buffer, 'name')
+        lines = linesList()
+        for step in grep_buffer_steps(lines, buffer, head, tail, after_context, before_context,
+                count, regexp, hilight, exact, invert, step=500):
+            yield
+        grep_stream_lines(buffer_name, lines)
+        grep_stream_progress(i + 1, len(search_in_buffers), 'buffers')
+
+def grep_buffers_timer_cb(data, remaining_calls):
+    global grep_buffers_steps
+    deadline = now() + get_config_int('buffer_time_slice') / 1000.0
+    try:
+        while now() < deadline:
+            next(grep_buffers_steps)
+    except StopIteration:
+        grep_buffers_stop()
         try:
-            data = pickle.loads(grep_stdout)
-            if isinstance(data, Exception):
-                raise data
-            matched_lines.update(data)
+            grep_logs()
         except Exception as e:
-            set_buffer_error(repr(e))
-            return WEECHAT_RC_OK
+            error(e)
+    except Exception as e:
+        grep_buffers_stop()
+        set_buffer_error(repr(e))
+    return WEECHAT_RC_OK
+
+### Background workers ###
+# With more than one worker, each log is grepped in its own process, at most 'background_workers'
+# at a time, and results are printed in the grep buffer as soon as each log is done.
+def grep_pool_start(workers):
+    global grep_queue, grep_output
+    grep_pool_stop()
+    grep_queue = list(range(len(log_pairs)))
+    grep_output = {}
+    for i in range(workers):
+        grep_worker_start()
+
+def grep_pool_stop():
+    global grep_queue
+    for hook in grep_workers.values():
+        weechat.unhook(hook)
+    grep_workers.clear()
+    grep_queue = []
+
+def grep_worker_start():
+    """Starts a worker for the next log in queue, returns False if there's none left."""
+    timeout = get_config_int('timeout_secs') * 1000
+    while grep_queue:
+        idx = grep_queue.pop(0)
+        hook = weechat.hook_process('func:grep_worker', timeout, 'grep_worker_cb', str(idx))
+        if hook:
+            grep_workers[idx] = hook
+            # decoder, stderr, decoded results
+            grep_output[idx] = [resultsDecoder(), b'', []]
+            return True
+        error("Couldn't start a worker for %s" % log_pairs[idx][0])
+    return False
+
+def grep_worker(data):
+    global grep_options, log_pairs
+    try:
+        result = grep_file(log_pairs[int(data)][1], *grep_options)
+    except Exception as e:
+        result = e
+    else:
+        result = {log_pairs[int(data)][0]: result}
+    return results_encode(result)
+
+def grep_worker_cb(data, command, return_code, out, err):
+    global matched_lines
+    idx = int(data)
+    if idx not in grep_workers:
+        # search was stopped or cancelled
+        return WEECHAT_RC_OK
+    output = grep_output[idx]
+    decoder, results = output[0], output[2]
+    if isinstance(err, str):
+        err = err.encode()
+    output[1] += err
+
+    if return_code == weechat.WEECHAT_HOOK_PROCESS_RUNNING:
+        try:
+            results.extend(decoder.feed(out))
+        except Exception as e:
+            # we'll report it when the worker ends
+            results.append(e)
+        return WEECHAT_RC_OK
+
+    del grep_workers[idx]
+    del grep_output[idx]
+    log_name = log_pairs[idx][0]
+    buffer = buffer_create()
+    if return_code == weechat.WEECHAT_HOOK_PROCESS_ERROR:
+        error("Background grep timed out for %s" % log_name, buffer)
+    elif output[1]:
+        error(output[1].decode('utf-8', 'replace'), buffer)
+    else:
+        try:
+            results.extend(decoder.feed(out))
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+            if not results or not decoder.finished():
+                raise Exception('Background grep results are incomplete')
+        except Exception as e:
+            error(repr(e), buffer)
         else:
-            buffer_update()
+            grep_stream_lines(log_name, results[0][1])
 
+    if head and matched_lines.get_matches_count() >= head:
+        # we have enough matches, cancel the other workers
+        grep_pool_stop()
+    else:
+        grep_worker_start()
+    if grep_workers:
+        grep_stream_progress(len(log_pairs) - len(grep_queue) - len(grep_workers),
+                len(log_pairs), 'logs')
+    else:
+        grep_stream_end()
     return WEECHAT_RC_OK
 
 def get_grep_file_status():
-    global search_in_files, matched_lines, time_start
+    global search_in_files, search_in_buffers, matched_lines, time_start
     elapsed = now() - time_start
-    if len(search_in_files) == 1:
+    if hook_buffer_grep:
+        log = '%s buffers' %len(search_in_buffers)
+    elif len(search_in_files) == 1:
         log = '%s (%s)' %(strip_home(search_in_files[0]),
                 human_readable_size(get_size(search_in_files[0])))
     else:
@@ -1086,62 +2093,14 @@ def get_grep_file_status():
 ### Grep buffer ###
 def buffer_update():
     """Updates our buffer with new lines."""
-    global pattern_tmpl, matched_lines, pattern, count, hilight, invert, exact
+    global matched_lines, count
     time_grep = now()
 
-    buffer = buffer_create()
-    if get_config_boolean('clear_buffer'):
-        weechat.buffer_clear(buffer)
     matched_lines.strip_separator() # remove first and last separators of each list
     len_total_lines = len(matched_lines)
     max_lines = get_config_int('max_lines')
-    if not count and len_total_lines > max_lines:
-        weechat.buffer_clear(buffer)
-
-    def _make_summary(log, lines, note):
-        return '%s matches "%s%s%s"%s in %s%s%s%s' \
-                %(lines.matches_count, color_summary, pattern_tmpl, color_info,
-                  invert and ' (inverted)' or '',
-                  color_summary, log, color_reset, note)
-
-    if count:
-        make_summary = lambda log, lines : _make_summary(log, lines, ' (not shown)')
-    else:
-        def make_summary(log, lines):
-            if lines.stripped_lines:
-                if lines:
-                    note = ' (last %s lines shown)' %len(lines)
-                else:
-                    note = ' (not shown)'
-            else:
-                note = ''
-            return _make_summary(log, lines, note)
-
-    global weechat_format
-    if hilight:
-        # we don't want colors if there's match highlighting
-        format_line = lambda s : '%s %s %s' %split_line(s)
-    else:
-        def format_line(s):
-            global nick_dict, weechat_format
-            date, nick, msg = split_line(s)
-            if weechat_format:
-                try:
-                    nick = nick_dict[nick]
-                except KeyError:
-                    # cache nick
-                    nick_c = color_nick(nick)
-                    nick_dict[nick] = nick_c
-                    nick = nick_c
-                return '%s%s %s%s %s' %(color_date, date, nick, color_reset, msg)
-            else:
-                #no formatting
-                return msg
+    buffer = buffer_update_start(clear=not count and len_total_lines > max_lines)
 
-    prnt(buffer, '\n')
-    print_line('Search for "%s%s%s"%s in %s%s%s.' %(color_summary, pattern_tmpl, color_info,
-        invert and ' (inverted)' or '', color_summary, matched_lines, color_reset),
-            buffer)
     # print last <max_lines> lines
     if matched_lines.get_matches_count():
         if count:
@@ -1152,44 +2111,105 @@ def buffer_update():
 
         matched_lines.get_last_lines(max_lines)
         for log, lines in matched_lines_items:
-            if lines.matches_count:
-                # matched lines
-                if not count:
-                    # print lines
-                    weechat_format = True
-                    if exact:
-                        lines.onlyUniq()
-                    for line in lines:
-                        #debug(repr(line))
-                        if line == linesList._sep:
-                            # separator
-                            prnt(buffer, context_sep)
-                        else:
-                            if '\x00' in line:
-                                # log was corrupted
-                                error("Found garbage in log '%s', maybe it's corrupted" %log)
-                                line = line.replace('\x00', '')
-                            prnt_date_tags(buffer, 0, 'no_highlight', format_line(line))
-
-                # summary
-                if count or get_config_boolean('show_summary'):
-                    summary = make_summary(log, lines)
-                    print_line(summary, buffer)
-
-            # separator
-            if not count and lines:
-                prnt(buffer, '\n')
+            buffer_print_lines(buffer, log, lines)
     else:
         print_line('No matches found.', buffer)
 
-    # set title
-    global time_start
+    buffer_update_title(buffer, time_grep, len_total_lines)
+
+    # free matched_lines so it can be removed from memory
+    del matched_lines
+
+def buffer_update_start(title=None, clear=False, where=None):
+    """Prepares our buffer for printing the results of a new search."""
+    global pattern_tmpl, invert, matched_lines
+    buffer = buffer_create(title)
+    if clear or get_config_boolean('clear_buffer'):
+        weechat.buffer_clear(buffer)
+    if where is None:
+        where = matched_lines
+    prnt(buffer, '\n')
+    print_line('Search for "%s%s%s"%s in %s%s%s.' %(color_summary, pattern_tmpl, color_info,
+        invert and ' (inverted)' or '', color_summary, where, color_reset),
+            buffer)
+    return buffer
+
+def make_summary(log, lines):
+    global pattern_tmpl, count, invert
+    if count:
+        note = ' (not shown)'
+    elif lines.stripped_lines:
+        if lines:
+            note = ' (last %s lines shown)' %len(lines)
+        else:
+            note = ' (not shown)'
+    else:
+        note = ''
+    return '%s matches "%s%s%s"%s in %s%s%s%s' \
+            %(lines.matches_count, color_summary, pattern_tmpl, color_info,
+              invert and ' (inverted)' or '',
+              color_summary, log, color_reset, note)
+
+def format_line(s):
+    global nick_dict, weechat_format, hilight
+    if hilight:
+        # we don't want colors if there's match highlighting
+        return '%s %s %s' %split_line(s)
+    date, nick, msg = split_line(s)
+    if weechat_format:
+        try:
+            nick = nick_dict[nick]
+        except KeyError:
+            # cache nick
+            nick_c = color_nick(nick)
+            nick_dict[nick] = nick_c
+            nick = nick_c
+        return '%s%s %s%s %s' %(color_date, date, nick, color_reset, msg)
+    else:
+        #no formatting
+        return msg
+
+def buffer_print_lines(buffer, log, lines):
+    """Prints the matched 'lines' of 'log' and its summary."""
+    global count, exact, weechat_format
+    if lines.matches_count:
+        # matched lines
+        if not count:
+            # print lines
+            weechat_format = True
+            if exact:
+                lines.onlyUniq()
+            for line in lines:
+                #debug(repr(line))
+                if line == linesList._sep:
+                    # separator
+                    prnt(buffer, context_sep)
+                else:
+                    if '\x00' in line:
+                        # log was corrupted
+                        error("Found garbage in log '%s', maybe it's corrupted" %log)
+                        line = line.replace('\x00', '')
+                    prnt_date_tags(buffer, 0, 'no_highlight', format_line(line))
+
+        # summary
+        if count or get_config_boolean('show_summary'):
+            summary = make_summary(log, lines)
+            print_line(summary, buffer)
+
+    # separator
+    if not count and lines:
+        prnt(buffer, '\n')
+
+def buffer_update_title(buffer, time_grep, len_total_lines=0):
+    """Sets the title of our buffer with the stats of the search."""
+    global pattern_tmpl, matched_lines, count, invert, time_start
     time_end = now()
     # total time
     time_total = time_end - time_start
     # percent of the total time used for grepping
     time_grep_pct = (time_grep - time_start)/time_total*100
     #debug('time: %.4f seconds (%.2f%%)' %(time_total, time_grep_pct))
+    max_lines = get_config_int('max_lines')
     if not count and len_total_lines > max_lines:
         note = ' (last %s lines shown)' %len(matched_lines)
     else:
@@ -1203,9 +2223,6 @@ def buffer_update():
     if get_config_boolean('go_to_buffer'):
         weechat.buffer_set(buffer, 'display', '1')
 
-    # free matched_lines so it can be removed from memory
-    del matched_lines
-
 def split_line(s):
     """Splits log's line 's' in 3 parts, date, nick and msg."""
     global weechat_format
@@ -1443,11 +2460,15 @@ def cmd_grep_parsing(args):
             tail = n
 
 def cmd_grep_stop(buffer, args):
-    global hook_file_grep, pattern, matched_lines
-    if hook_file_grep:
+    global hook_file_grep, pattern, matched_lines, grep_streaming
+    if hook_file_grep or hook_buffer_grep or grep_workers:
         if args == 'stop':
-            weechat.unhook(hook_file_grep)
+            if hook_file_grep:
+                weechat.unhook(hook_file_grep)
             hook_file_grep = None
+            grep_pool_stop()
+            grep_buffers_stop()
+            grep_streaming = False
 
             s = 'Search for \'%s\' stopped.' % pattern
             say(s, buffer)
@@ -1471,6 +2492,16 @@ def cmd_grep(data, buffer, args):
         weechat.command('', '/help %s' %SCRIPT_COMMAND)
         return WEECHAT_RC_OK
 
+    if args == 'index':
+        if not sqlite3:
+            error("Python module sqlite3 is required for the log index.")
+        elif hook_index:
+            say('Log index update already running.', buffer)
+        else:
+            say('Updating log index in background...', buffer)
+            index_start(buffer)
+        return WEECHAT_RC_OK
+
     cmd_init()
     global log_name, buffer_name, only_buffers, all
     log_name = buffer_name = ''
@@ -1557,6 +2588,14 @@ def cmd_logs(data, buffer, args):
         file_list.sort()
 
     file_sizes = map(lambda x: human_readable_size(get_size(x)), file_list)
+    if get_config_boolean('index'):
+        indexed = index_status()
+        def indexed_size(file):
+            size = get_size(file)
+            if size and file in indexed:
+                return ' (%d%% indexed)' %(min(indexed[file], size) * 100 // size)
+            return ' (not indexed)'
+        file_sizes = [ size + indexed_size(file) for file, size in zip(file_list, file_sizes) ]
     # calculate column lenght
     if file_list:
         L = file_list[:]
@@ -1636,6 +2675,85 @@ templates = {
         'domain': domain,
         }
 
+### Benchmarks ###
+# Run outside WeeChat with: python3 grep.py benchmark
+def benchmark_lines(n):
+    """Returns 'n' synthetic log lines."""
+    import random
+    random.seed(0)
+    words = ('hello', 'weechat', 'grep', 'log', 'nick', 'http://weechat.org/', 'the', 'of', 'é',
+            'C:\\path', 'some', 'more', 'words', 'server', 'channel')
+    return [ '2026-01-01 12:%02d:%02d\tnick%d\t%s\n' %(i // 60 % 60, i % 60, i % 50,
+             ' '.join(random.choice(words) for j in range(random.randint(3, 15))))
+             for i in range(n) ]
+
+def benchmark_time(function, repeat=3):
+    """Returns the best time of 'repeat' calls to 'function'."""
+    best = None
+    for i in range(repeat):
+        start = now()
+        function()
+        elapsed = now() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def benchmark_wire_format(n=200000, chunk_size=65536):
+    """Compares pickle protocol 0 with results_encode()/resultsDecoder for 'n' matched lines."""
+    lines = linesList(benchmark_lines(n))
+    lines.matches_count = n
+    results = {'irc.server.#channel.weechatlog': lines}
+
+    def chunks(data):
+        # WeeChat sends output of processes to callbacks in chunks
+        return [ data[i:i + chunk_size] for i in range(0, len(data), chunk_size) ]
+
+    def pickle_roundtrip():
+        output = b''
+        for chunk in chunks(pickle.dumps(results, 0).decode('latin-1')):
+            output += chunk.encode('latin-1')
+        return pickle.loads(output)
+
+    def wire_roundtrip():
+        decoder = resultsDecoder()
+        decoded = []
+        for chunk in chunks(results_encode(results)):
+            decoded.extend(decoder.feed(chunk))
+        return decoded
+
+    print('Background results, %s lines:' % n)
+    for name, function, size in (
+            ('pickle protocol 0', pickle_roundtrip, len(pickle.dumps(results, 0))),
+            ('line records', wire_roundtrip, len(results_encode(results)))):
+        print('  %-18s %8s  %.3f seconds' %(name, human_readable_size(size),
+            benchmark_time(function)))
+
+def benchmark_matchers(log=None, n=500000):
+    """Compares compiled regexps with patternMatcher, searching the lines of 'log' or 'n'
+    synthetic lines."""
+    if log:
+        with open(log, 'r', errors='ignore') as file_object:
+            lines = file_object.readlines()
+    else:
+        lines = benchmark_lines(n)
+    hilight = '\x19*,\x1c'
+    print('Matchers, %s lines (%s):' %(len(lines), human_readable_size(sum(map(len, lines)))))
+    for pattern, matchcase in (('weechat', True), ('weechat', False), ('WeeChat', False),
+            ('nosuchword', False), ('^2026-01-01 12:1', False), ('nick1[0-9]', False)):
+        regexp = re.compile(pattern, not matchcase and re.IGNORECASE or 0)
+        matcher = patternMatcher(pattern, matchcase)
+        for mode, mode_hilight in (('search', ''), ('hilight', hilight)):
+            times = []
+            for compiled in (regexp, matcher):
+                check = make_check(compiled, mode_hilight, False, False)
+                times.append(benchmark_time(lambda: [ check(line) for line in lines ], repeat=5))
+            print('  %-20s %-14s %-7s regexp %.3fs  matcher %.3fs  (%.1fx)' %(
+                repr(pattern), matcher.kind, mode, times[0], times[1], times[0] / times[1]))
+
+def benchmark():
+    benchmark_wire_format()
+    benchmark_matchers(sys.argv[2:3] and sys.argv[2] or None)
+
 ### Main ###
 def delete_bytecode():
     global script_path
@@ -1665,7 +2783,7 @@ if __name__ == '__main__' and import_ok and \
 
 
     weechat.hook_command(SCRIPT_COMMAND, cmd_grep.__doc__,
-            "[log <file> | buffer <name> | stop] [-a|--all] [-b|--buffer] [-c|--count] [-m|--matchcase] "
+            "[log <file> | buffer <name> | stop | index] [-a|--all] [-b|--buffer] [-c|--count] [-m|--matchcase] "
             "[-H|--hilight] [-o|--only-match] [-i|-v|--invert] [(-h|--head)|(-t|--tail) [-n|--number <n>]] "
             "[-A|--after-context <n>] [-B|--before-context <n>] [-C|--context <n> ] <expression>",
 # help
@@ -1675,6 +2793,7 @@ if __name__ == '__main__' and import_ok and \
   buffer <name>: Search in buffer <name>, if there's no buffer with <name> it will
                  try to search for a log file.
            stop: Stops a currently running search.
+          index: Updates the log index now (see option plugins.var.python.grep.index).
        -a --all: Search in all open buffers.
                  If used with 'log <file>' search in all logs that matches <file>.
     -b --buffer: Search only in buffers, not in file logs.
@@ -1716,6 +2835,7 @@ Examples:
             "buffer %(buffers_names) %(grep_arguments)|%*"
             "||log %(grep_log_files) %(grep_arguments)|%*"
             "||stop"
+            "||index"
             "||%(grep_arguments)|%*",
             'cmd_grep' ,'')
     weechat.hook_command('logs', cmd_logs.__doc__, "[-s|--size] [<filter>]",
@@ -1732,6 +2852,14 @@ Examples:
         if not weechat.config_is_set_plugin(opt):
             weechat.config_set_plugin(opt, val)
 
+    # log index
+    index_path = get_index_path()
+    hook_index_timer = None
+    index_timer_hook()
+    if get_config_boolean('index'):
+        index_start()
+    weechat.hook_config('plugins.var.python.%s.index*' % SCRIPT_NAME, 'index_config_cb', '')
+
     # colors
     color_date        = weechat.color('brown')
     color_info        = weechat.color('cyan')
@@ -1771,4 +2899,11 @@ Examples:
         def debug(*args):
             pass
 
+elif __name__ == '__main__' and not import_ok:
+    if sys.argv[1:2] == ['benchmark']:
+        benchmark()
+    else:
+        print('This script must be loaded in WeeChat, or run with "benchmark [log file]"'
+              ' arguments.')
+
 # vim:set shiftwidth=4 tabstop=4 softtabstop=4 expandtab textwidth=100:
@@ -5,7 +5,7 @@
 
 from __future__ import print_function, unicode_literals
 
-from collections import OrderedDict, namedtuple
+from collections import OrderedDict, deque, namedtuple
 from datetime import date, datetime, timedelta
 from functools import partial, wraps
 from io import StringIO
@@ -13,6 +13,7 @@ from itertools import chain, count, islice
 
 import copy
 import errno
+import heapq
 import textwrap
 import time
 import json
@@ -44,6 +45,11 @@ try:
 except NameError:  # Python 3
     basestring = unicode = str
 
+try:
+    intern = sys.intern  # Python 3
+except AttributeError:
+    pass
+
 try:
     from collections.abc import (
         ItemsView,
@@ -76,15 +82,51 @@ except ImportError:
 
 SCRIPT_NAME = "slack"
 SCRIPT_AUTHOR = "Trygve Aaberge <trygveaa@gmail.com>"
-SCRIPT_VERSION = "2.11.0"
+SCRIPT_VERSION = "2.11.8"
 SCRIPT_LICENSE = "MIT"
 SCRIPT_DESC = "Extends WeeChat for typing notification/search/etc on slack.com"
 REPO_URL = "https://github.com/wee-slack/wee-slack"
 
 TYPING_DURATION = 6
 
+# How long (in seconds) EventRouter.handle_next may spend handling queued
+# events before it yields back to WeeChat until the next timer tick.
+HANDLE_NEXT_TIME_BUDGET = 0.02
+
 RECORD_DIR = "/tmp/weeslack-debug"
 
+# Increase when the format of the files written by save_team_cache changes.
+TEAM_CACHE_VERSION = 1
+
+# Requests are sent in this order. Requests for channels shown in a window are
+# high priority, requests for loading history in the background are low.
+REQUEST_PRIORITY_HIGH = 0
+REQUEST_PRIORITY_NORMAL = 1
+REQUEST_PRIORITY_LOW = 2
+
+# Allowed requests per minute for each API method, from the rate limit tiers
+# in the Slack API documentation (Tier 1: 1, Tier 2: 20, Tier 3: 50 and
+# Tier 4: 100). Methods not listed here are treated as Tier 3. rtm.connect is
+# left out on purpose, as a reconnect shouldn't have to wait for a minute.
+SLACK_API_RATE_LIMITS = {
+    "conversations.create": 20,
+    "conversations.invite": 20,
+    "conversations.list": 20,
+    "conversations.setTopic": 20,
+    "emoji.list": 20,
+    "files.upload": 20,
+    "usergroups.list": 20,
+    "usergroups.users.list": 20,
+    "users.list": 20,
+    "users.setPresence": 20,
+    "chat.command": 60,
+    "chat.meMessage": 60,
+    "chat.postMessage": 60,
+    "users.info": 100,
+    "users.profile.get": 100,
+}
+SLACK_API_DEFAULT_RATE_LIMIT = 50
+
 SLACK_API_TRANSLATOR = {
     "channel": {
         "history": "conversations.history",
@@ -421,6 +463,18 @@ def get_thread_color(thread_id):
         return config.color_thread_suffix
 
 
+def intern_string(s):
+    """
+    Interns IDs and names we keep many references to, like the user ID of
+    every message. Python 2 can only intern byte strings, so other strings
+    are returned as is there.
+    """
+    try:
+        return intern(s)
+    except TypeError:
+        return s
+
+
 def sha1_hex(s):
     return str(hashlib.sha1(s.encode("utf-8")).hexdigest())
 
@@ -510,7 +564,7 @@ class EventRouter(object):
         It has a recorder that, when enabled, logs most events
         to the location specified in RECORD_DIR.
         """
-        self.queue = []
+        self.queue = deque()
         self.slow_queue = []
         self.slow_queue_timer = 0
         self.teams = {}
@@ -528,6 +582,30 @@ class EventRouter(object):
         self.recording_path = "/tmp"
         self.handle_next_hook = None
         self.handle_next_hook_interval = -1
+        self.request_scheduler = SlackRequestScheduler(self)
+        self.reset_stats()
+
+    def reset_stats(self):
+        """
+        Resets the counters shown by /slack debug.
+        """
+        self.stats_since = time.time()
+        self.handle_next_ticks = 0
+        self.handle_next_max_batch = 0
+        self.handle_next_max_queue = 0
+        # event type -> [count, total seconds, max seconds]
+        self.event_stats = {}
+        self.request_scheduler.reset_stats()
+
+    def record_event_time(self, function_name, elapsed):
+        stats = self.event_stats.get(function_name)
+        if stats is None:
+            self.event_stats[function_name] = [1, elapsed, elapsed]
+        else:
+            stats[0] += 1
+            stats[1] += elapsed
+            if elapsed > stats[2]:
+                stats[2] = elapsed
 
     def record(self):
         """
@@ -680,6 +758,7 @@ class EventRouter(object):
                 if name.lower() == "retry-after":
                     retry_after = int(value.strip())
                     request_metadata.retry_time = time.time() + retry_after
+                    self.request_scheduler.rate_limited(request_metadata, retry_after)
                     return "", "ratelimited"
 
         return body, ""
@@ -740,6 +819,8 @@ class EventRouter(object):
                 len(out),
             )
         )
+        if return_code != -1:
+            self.request_scheduler.finished(request_metadata)
         if return_code == 0:
             if len(out) > 0:
                 if request_metadata.response_id not in self.reply_buffer:
@@ -790,7 +871,12 @@ class EventRouter(object):
         be JSON.
         """
         dbg("RECEIVED FROM QUEUE")
-        if slow:
+        if isinstance(dataobj, SlackRequest):
+            # Requests are throttled by the request scheduler instead.
+            if slow:
+                dataobj.priority = REQUEST_PRIORITY_LOW
+            self.queue.append(dataobj)
+        elif slow:
             self.slow_queue.append(dataobj)
         else:
             self.queue.append(dataobj)
@@ -820,74 +906,100 @@ class EventRouter(object):
             dbg("from slow queue", 0)
             self.queue.append(self.slow_queue.pop())
             self.slow_queue_timer = time.time()
-        if len(self.queue) > 0:
-            j = self.queue.pop(0)
-            # Reply is a special case of a json reply from websocket.
-            if isinstance(j, SlackRequest):
-                if j.should_try():
-                    if j.retry_ready():
-                        local_process_async_slack_api_request(j, self)
-                    else:
-                        self.slow_queue.append(j)
-                else:
-                    dbg("Max retries for Slackrequest")
 
+        if self.queue:
+            self.handle_events()
+        self.request_scheduler.run()
+
+    def handle_events(self):
+        self.handle_next_ticks += 1
+        self.handle_next_max_queue = max(self.handle_next_max_queue, len(self.queue))
+        # Handle as many events as fit in the time budget, so catching up
+        # after a reconnect is bounded by CPU time and not by the timer.
+        deadline = time.time() + HANDLE_NEXT_TIME_BUDGET
+        handled = 0
+        try:
+            while self.queue:
+                self.handle_event(self.queue.popleft())
+                handled += 1
+                if time.time() >= deadline:
+                    break
+        finally:
+            self.handle_next_max_batch = max(self.handle_next_max_batch, handled)
+
+    def handle_event(self, j):
+        """
+        Handles a single event taken from the queue and records how
+        long it took, per event type.
+        """
+        start = time.time()
+        function_name = self.event_name(j)
+        try:
+            self.dispatch_event(j, function_name)
+        finally:
+            self.record_event_time(function_name, time.time() - start)
+
+    def event_name(self, j):
+        # Reply is a special case of a json reply from websocket.
+        if isinstance(j, SlackRequest):
+            return "slack_api_request"
+        elif "reply_to" in j:
+            dbg("SET FROM REPLY")
+            function_name = "reply"
+        elif "type" in j:
+            dbg("SET FROM type")
+            function_name = j["type"]
+        elif "wee_slack_process_method" in j:
+            dbg("SET FROM META")
+            function_name = j["wee_slack_process_method"]
+        else:
+            dbg("SET FROM NADA")
+            function_name = "unknown"
+        return function_name
+
+    def dispatch_event(self, j, function_name):
+        if isinstance(j, SlackRequest):
+            if j.should_try():
+                self.request_scheduler.add(j)
             else:
-                if "reply_to" in j:
-                    dbg("SET FROM REPLY")
-                    function_name = "reply"
-                elif "type" in j:
-                    dbg("SET FROM type")
-                    function_name = j["type"]
-                elif "wee_slack_process_method" in j:
-                    dbg("SET FROM META")
-                    function_name = j["wee_slack_process_method"]
-                else:
-                    dbg("SET FROM NADA")
-                    function_name = "unknown"
-
-                request = j.get("wee_slack_request_metadata")
-                if request:
-                    team = request.team
-                    channel = request.channel
-                    metadata = request.metadata
-                    callback = request.callback
-                else:
-                    team = j.get("wee_slack_metadata_team")
-                    channel = None
-                    metadata = {}
-                    callback = None
-
-                if team:
-                    if "channel" in j:
-                        channel_id = (
-                            j["channel"]["id"]
-                            if isinstance(j["channel"], dict)
-                            else j["channel"]
-                        )
-                        channel = team.channels.get(channel_id, channel)
-                    if "user" in j:
-                        user_id = (
-                            j["user"]["id"]
-                            if isinstance(j["user"], dict)
-                            else j["user"]
-                        )
-                        metadata["user"] = team.users.get(user_id)
+                dbg("Max retries for Slackrequest")
+            return
 
-                dbg("running {}".format(function_name))
-                if callable(callback):
-                    callback(j, self, team, channel, metadata)
-                elif (
-                    function_name.startswith("local_")
-                    and function_name in self.local_proc
-                ):
-                    self.local_proc[function_name](j, self, team, channel, metadata)
-                elif function_name in self.proc:
-                    self.proc[function_name](j, self, team, channel, metadata)
-                elif function_name in self.handlers:
-                    self.handlers[function_name](j, self, team, channel, metadata)
-                else:
-                    dbg("Callback not implemented for event: {}".format(function_name))
+        request = j.get("wee_slack_request_metadata")
+        if request:
+            team = request.team
+            channel = request.channel
+            metadata = request.metadata
+            callback = request.callback
+        else:
+            team = j.get("wee_slack_metadata_team")
+            channel = None
+            metadata = {}
+            callback = None
+
+        if team:
+            if "channel" in j:
+                channel_id = (
+                    j["channel"]["id"]
+                    if isinstance(j["channel"], dict)
+                    else j["channel"]
+                )
+                channel = team.channels.get(channel_id, channel)
+            if "user" in j:
+                user_id = j["user"]["id"] if isinstance(j["user"], dict) else j["user"]
+                metadata["user"] = team.users.get(user_id)
+
+        dbg("running {}".format(function_name))
+        if callable(callback):
+            callback(j, self, team, channel, metadata)
+        elif function_name.startswith("local_") and function_name in self.local_proc:
+            self.local_proc[function_name](j, self, team, channel, metadata)
+        elif function_name in self.proc:
+            self.proc[function_name](j, self, team, channel, metadata)
+        elif function_name in self.handlers:
+            self.handlers[function_name](j, self, team, channel, metadata)
+        else:
+            dbg("Callback not implemented for event: {}".format(function_name))
 
 
 def handle_next(data, remaining_calls):
@@ -957,6 +1069,7 @@ def local_process_async_slack_api_request(request, event_router):
     """
     complete
     Sends an API request to Slack. You'll need to give this a well formed SlackRequest object.
+    Returns the process hook, which is empty if the request couldn't be started.
     DEBUGGING!!! The context here cannot be very large. WeeChat will crash.
     """
     if not event_router.shutting_down:
@@ -970,13 +1083,17 @@ def local_process_async_slack_api_request(request, event_router):
         options = request.options()
         options["header"] = "1"
         context = event_router.store_context(request)
-        w.hook_process_hashtable(
+        hook = w.hook_process_hashtable(
             weechat_request,
             options,
             config.slack_timeout,
             "receive_httprequest_callback",
             context,
         )
+        if not hook:
+            event_router.delete_context(context)
+        return hook
+    return ""
 
 
 ###### New Callbacks
@@ -1029,6 +1146,20 @@ def buffer_closing_callback(data, signal, current_buffer):
     return w.WEECHAT_RC_OK
 
 
+@utf8_decode
+def buffer_cleared_cb(data, signal, current_buffer):
+    """
+    Forgets the line pointers of a buffer when its lines are removed with
+    /buffer clear.
+    """
+    channel = EVENTROUTER.weechat_controller.get_channel_from_buffer_ptr(
+        current_buffer
+    )
+    if channel:
+        channel.line_pointers = {}
+    return w.WEECHAT_RC_OK
+
+
 @utf8_decode
 def buffer_input_callback(signal, buffer_ptr, data):
     """
@@ -1109,6 +1240,10 @@ def buffer_switch_callback(data, signal, current_buffer):
         current_buffer
     )
     if new_channel:
+        if isinstance(new_channel, SlackThreadChannel):
+            new_channel.parent_channel.last_viewed = time.time()
+        elif isinstance(new_channel, SlackChannel):
+            new_channel.last_viewed = time.time()
         if not new_channel.got_history or new_channel.history_needs_update:
             new_channel.get_history()
         set_own_presence_active(new_channel.team)
@@ -1159,6 +1294,40 @@ def typing_update_cb(data, remaining_calls):
     return w.WEECHAT_RC_OK
 
 
+@utf8_decode
+def history_budget_cb(data, remaining_calls):
+    evict_history()
+    return w.WEECHAT_RC_OK
+
+
+def evict_history():
+    """
+    Drops the messages of the least recently viewed channels without a
+    buffer until all channels together have at most history_max_total
+    messages. The history is fetched again when their buffer is opened.
+    """
+    max_total = config.history_max_total
+    if max_total <= 0:
+        return
+    channels = [
+        channel
+        for team in EVENTROUTER.teams.values()
+        for channel in team.channels.values()
+        if channel.messages
+    ]
+    total = sum(len(channel.messages) for channel in channels)
+    if total <= max_total:
+        return
+    for channel in sorted(channels, key=lambda channel: channel.last_viewed):
+        if total <= max_total:
+            break
+        if channel.can_evict_history():
+            total -= len(channel.messages)
+            channel.clear_history()
+            channel.got_history = False
+            dbg("Evicted history of {}".format(channel.name), level=4)
+
+
 @utf8_decode
 def slack_never_away_cb(data, remaining_calls):
     if config.never_away:
@@ -1470,6 +1639,7 @@ class SlackRequest(object):
         token=None,
         cookies=None,
         callback=None,
+        priority=None,
     ):
         if team is None and token is None:
             raise ValueError("Both team and token can't be None")
@@ -1491,6 +1661,7 @@ class SlackRequest(object):
             else:
                 self.cookies["d"] = cookie
         self.callback = callback
+        self.priority = priority
         self.domain = "api.slack.com"
         self.reset()
 
@@ -1555,6 +1726,156 @@ class SlackRequest(object):
             return (self.start_time + (self.tries**2)) < time.time()
 
 
+class SlackRateLimitBucket(object):
+    """
+    A token bucket allowing per_minute requests per minute, where all of
+    them may be used at once. A Retry-After from Slack empties the bucket
+    and blocks it until the given time.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated = time.time()
+        self.blocked_until = 0
+
+    def ready(self, now):
+        if now < self.blocked_until:
+            return False
+        if now > self.updated:
+            elapsed = now - self.updated
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+        return self.tokens >= 1
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, until):
+        self.blocked_until = max(self.blocked_until, until)
+        self.tokens = 0
+        self.updated = self.blocked_until
+
+
+class SlackRequestScheduler(object):
+    """
+    Decides when queued SlackRequests are sent. Each team (or token, for
+    requests made before we have a team) may have max_requests_in_flight
+    requests running at once, and each API method is limited by a token
+    bucket matching its Slack rate limit tier. Of the requests that may be
+    sent, the one with the highest priority, then the oldest, goes first.
+    """
+
+    def __init__(self, eventrouter):
+        self.eventrouter = eventrouter
+        # team key -> method -> heap of (priority, sequence number, request)
+        self.pending = {}
+        # team key -> response ids of the requests running for that team
+        self.in_flight = {}
+        self.buckets = {}
+        # Off when replaying recorded events, as the responses come at once
+        self.use_rate_limits = True
+        self.sequence = count()
+        self.reset_stats()
+
+    def reset_stats(self):
+        # method -> [sent, rate limited, total seconds waited before sending]
+        self.method_stats = {}
+
+    def team_key(self, request):
+        return request.team.team_hash if request.team else request.token
+
+    def bucket(self, key, method):
+        bucket = self.buckets.get((key, method))
+        if bucket is None:
+            per_minute = SLACK_API_RATE_LIMITS.get(method, SLACK_API_DEFAULT_RATE_LIMIT)
+            bucket = self.buckets[(key, method)] = SlackRateLimitBucket(per_minute)
+        return bucket
+
+    def method_stat(self, method):
+        return self.method_stats.setdefault(method, [0, 0, 0.0])
+
+    def priority(self, request):
+        if request.priority is not None:
+            return request.priority
+        channel = request.channel
+        buffer_ptr = channel and channel.channel_buffer
+        if buffer_ptr and w.buffer_get_integer(buffer_ptr, "num_displayed") > 0:
+            return REQUEST_PRIORITY_HIGH
+        return REQUEST_PRIORITY_NORMAL
+
+    def add(self, request):
+        request.queued_time = time.time()
+        methods = self.pending.setdefault(self.team_key(request), {})
+        heapq.heappush(
+            methods.setdefault(request.request, []),
+            (self.priority(request), next(self.sequence), request),
+        )
+
+    def has_pending(self):
+        return any(self.pending.values())
+
+    def pending_count(self, key=None):
+        keys = self.pending if key is None else [key]
+        return sum(
+            len(heap) for k in keys for heap in self.pending.get(k, {}).values()
+        )
+
+    def run(self):
+        """
+        Sends as many pending requests as the in-flight limit and the rate
+        limits allow. Called on every tick of EventRouter.handle_next.
+        """
+        if self.eventrouter.shutting_down:
+            return
+        now = time.time()
+        limit = max(1, config.max_requests_in_flight)
+        failed_requests = []
+        for key, methods in self.pending.items():
+            in_flight = self.in_flight.setdefault(key, set())
+            while methods and len(in_flight) < limit:
+                ready = [
+                    (heap[0], method)
+                    for method, heap in methods.items()
+                    if heap[0][2].retry_ready()
+                    and (not self.use_rate_limits or self.bucket(key, method).ready(now))
+                ]
+                if not ready:
+                    break
+                (_, _, request), method = min(ready)
+                heapq.heappop(methods[method])
+                if not methods[method]:
+                    del methods[method]
+                if self.use_rate_limits:
+                    self.bucket(key, method).take()
+                stats = self.method_stat(method)
+                stats[0] += 1
+                stats[2] += now - request.queued_time
+                if local_process_async_slack_api_request(request, self.eventrouter):
+                    in_flight.add(request.response_id)
+                else:
+                    # No callback will come to finish it, so it takes no slot
+                    failed_requests.append(request)
+
+        for request in failed_requests:
+            self.eventrouter.retry_request(
+                request, "", w.WEECHAT_HOOK_PROCESS_ERROR, "Failed to start request"
+            )
+
+    def finished(self, request):
+        self.in_flight.get(self.team_key(request), set()).discard(request.response_id)
+
+    def rate_limited(self, request, retry_after):
+        """
+        Slack answered with 429, so hold back all requests for this method
+        until Retry-After has passed, not just the one that failed.
+        """
+        key = self.team_key(request)
+        self.bucket(key, request.request).block(time.time() + retry_after)
+        self.method_stat(request.request)[1] += 1
+
+
 class SlackSubteam(object):
     """
     Represents a slack group or subteam
@@ -1910,6 +2231,14 @@ class SlackChannelCommon(object):
         self.label_short_drop_prefix = False
         self.label_short = None
         self.buffer_rename_in_progress = False
+        # ts -> (pointer to the last buffer line printed for that message,
+        # time the line was printed)
+        self.line_pointers = {}
+
+    def index_last_line(self, ts):
+        own_lines = w.hdata_pointer(hdata.buffer, self.channel_buffer, "own_lines")
+        last_line = w.hdata_pointer(hdata.lines, own_lines, "last_line")
+        index_buffer_line(self.line_pointers, ts, last_line)
 
     def prnt_message(
         self, message, history_message=False, no_log=False, force_render=False
@@ -1973,6 +2302,7 @@ class SlackChannelCommon(object):
     def reprint_messages(self, history_message=False, no_log=True, force_render=False):
         if self.channel_buffer:
             w.buffer_clear(self.channel_buffer)
+            self.line_pointers = {}
             self.last_line_from = None
             for message in self.visible_messages.values():
                 self.prnt_message(message, history_message, no_log, force_render)
@@ -2120,7 +2450,7 @@ class SlackChannelCommon(object):
             or config.thread_messages_in_channel
         ):
             new_text = self.render(m, force=True)
-            modify_buffer_line(self.channel_buffer, ts, new_text)
+            modify_buffer_line(self.channel_buffer, ts, new_text, self.line_pointers)
         if isinstance(m, SlackThreadMessage) or m.thread_channel is not None:
             thread_channel = (
                 m.parent_message.thread_channel
@@ -2129,7 +2459,12 @@ class SlackChannelCommon(object):
             )
             if thread_channel and thread_channel.active:
                 new_text = thread_channel.render(m, force=True)
-                modify_buffer_line(thread_channel.channel_buffer, ts, new_text)
+                modify_buffer_line(
+                    thread_channel.channel_buffer,
+                    ts,
+                    new_text,
+                    thread_channel.line_pointers,
+                )
 
     def mark_read(self, ts=None, update_remote=True, force=False, post_data={}):
         if self.new_messages or force:
@@ -2151,6 +2486,7 @@ class SlackChannelCommon(object):
 
     def destroy_buffer(self, update_remote):
         self.channel_buffer = None
+        self.line_pointers = {}
         self.got_history = False
         self.active = False
 
@@ -2178,6 +2514,7 @@ class SlackChannel(SlackChannelCommon):
         self.got_members = False
         self.history_needs_update = False
         self.pending_history_requests = set()
+        self.last_viewed = 0
         self.messages = OrderedDict()
         self.visible_messages = SlackChannelVisibleMessages(self)
         self.hashed_messages = SlackChannelHashedMessages(self)
@@ -2468,7 +2805,7 @@ class SlackChannel(SlackChannelCommon):
 
     def destroy_buffer(self, update_remote):
         super(SlackChannel, self).destroy_buffer(update_remote)
-        self.messages = OrderedDict()
+        self.clear_history()
         if update_remote and not self.eventrouter.shutting_down:
             s = SlackRequest(
                 self.team,
@@ -2524,6 +2861,7 @@ class SlackChannel(SlackChannelCommon):
             if no_log:
                 w.buffer_set(self.channel_buffer, "print_hooks_enabled", "0")
             w.prnt_date_tags(self.channel_buffer, ts.major, tags, data)
+            self.index_last_line(ts)
             if no_log:
                 w.buffer_set(self.channel_buffer, "print_hooks_enabled", "1")
             if backlog or (self_msg and tagset != "join"):
@@ -2537,12 +2875,21 @@ class SlackChannel(SlackChannelCommon):
         if old_message and old_message.submessages and not message_to_store.submessages:
             message_to_store.submessages = old_message.submessages
 
+        # Most messages are newer than the ones we have, so only sort when needed
+        needs_sort = (
+            self.messages
+            and message_to_store.ts not in self.messages
+            and message_to_store.ts < next(reversed(self.messages))
+        )
         self.messages[message_to_store.ts] = message_to_store
-        self.messages = OrderedDict(sorted(self.messages.items()))
+        if needs_sort:
+            self.messages = OrderedDict(sorted(self.messages.items()))
 
-        max_history = w.config_integer(
+        max_history = config.history_max_per_channel or w.config_integer(
             w.config_get("weechat.history.max_buffer_lines_number")
         )
+        if max_history <= 0:
+            return
         messages_to_check = islice(
             self.messages.items(), max(0, len(self.messages) - max_history)
         )
@@ -2565,11 +2912,46 @@ class SlackChannel(SlackChannelCommon):
                 messages_to_delete.append(ts)
 
         for ts in messages_to_delete:
-            message_hash = self.hashed_messages.get(ts)
-            if message_hash:
-                del self.hashed_messages[ts]
-                del self.hashed_messages[message_hash]
-            del self.messages[ts]
+            self.delete_message(ts)
+
+    def delete_message(self, ts):
+        message_hash = self.hashed_messages.get(ts)
+        if message_hash:
+            del self.hashed_messages[ts]
+            del self.hashed_messages[message_hash]
+        thread_channel = self.thread_channels.get(ts)
+        if thread_channel is not None and not thread_channel.active:
+            del self.thread_channels[ts]
+        self.line_pointers.pop(ts, None)
+        del self.messages[ts]
+
+    def can_evict_history(self):
+        if self.pending_history_requests:
+            return False
+        # The lines of an open buffer need their messages for edits,
+        # reactions and replies
+        if self.channel_buffer:
+            return False
+        # Thread buffers show messages from this channel
+        return not any(
+            thread_channel.active for thread_channel in self.thread_channels.values()
+        )
+
+    def clear_history(self):
+        """
+        Forgets the messages of this channel. If the buffer is still open,
+        the caller should set got_history to False so they are fetched again
+        with get_history when the buffer is switched to.
+        """
+        self.messages = OrderedDict()
+        self.hashed_messages = SlackChannelHashedMessages(self)
+        self.thread_channels = {
+            ts: thread_channel
+            for ts, thread_channel in self.thread_channels.items()
+            if thread_channel.active
+        }
+        self.line_pointers = {}
+        self.visible_messages.first_ts_to_display = SlackTS(0)
 
     def is_visible(self):
         return w.buffer_get_integer(self.channel_buffer, "hidden") == 0
@@ -2846,6 +3228,36 @@ class SlackChannelVisibleMessages(MappingReversible):
 class SlackChannelHashedMessages(dict):
     def __init__(self, channel):
         self.channel = channel
+        # The number of short hashes starting with each prefix, so checking if
+        # a prefix is used doesn't have to look at all the hashes
+        self.prefix_counts = {}
+
+    def __setitem__(self, key, value):
+        if isinstance(key, str) and key not in self:
+            self.count_prefixes(key, 1)
+        super(SlackChannelHashedMessages, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super(SlackChannelHashedMessages, self).__delitem__(key)
+        if isinstance(key, str):
+            self.count_prefixes(key, -1)
+
+    def pop(self, key, *args):
+        if isinstance(key, str) and key in self:
+            self.count_prefixes(key, -1)
+        return super(SlackChannelHashedMessages, self).pop(key, *args)
+
+    def count_prefixes(self, short_hash, change):
+        for i in range(1, len(short_hash) + 1):
+            prefix = short_hash[:i]
+            prefix_count = self.prefix_counts.get(prefix, 0) + change
+            if prefix_count:
+                self.prefix_counts[prefix] = prefix_count
+            else:
+                del self.prefix_counts[prefix]
+
+    def is_prefix_used(self, short_hash):
+        return short_hash in self.prefix_counts
 
     def __missing__(self, key):
         if not isinstance(key, SlackTS):
@@ -2855,7 +3267,7 @@ class SlackChannelHashedMessages(dict):
         full_hash = sha1_hex(str(key))
         short_hash = full_hash[:hash_len]
 
-        while any(x.startswith(short_hash) for x in self if isinstance(x, str)):
+        while self.is_prefix_used(short_hash):
             hash_len += 1
             short_hash = full_hash[:hash_len]
 
@@ -3140,6 +3552,7 @@ class SlackThreadChannel(SlackChannelCommon):
             if no_log:
                 w.buffer_set(self.channel_buffer, "print_hooks_enabled", "0")
             w.prnt_date_tags(self.channel_buffer, ts.major, tags, data)
+            self.index_last_line(ts)
             if no_log:
                 w.buffer_set(self.channel_buffer, "print_hooks_enabled", "1")
             if backlog or self_msg:
@@ -3297,28 +3710,82 @@ class SlackThreadChannelMessages(MappingReversible):
 class SlackUser(object):
     """
     Represends an individual slack user. Also where you set their name formatting.
-    """
+    To keep memory use down with many users, only the fields we use are
+    attributes, and profile only has the fields we show. The rest of the user
+    object from the API is kept as a json string, which is parsed and kept
+    parsed the first time one of those fields is used as an attribute.
+    """
+
+    __slots__ = (
+        "identifier",
+        "name",
+        "username",
+        "real_name",
+        "profile",
+        "presence",
+        "deleted",
+        "is_bot",
+        "is_external",
+        "color_name",
+        "extra",
+    )
+    profile_fields = (
+        "display_name",
+        "real_name",
+        "status_emoji",
+        "status_text",
+        "title",
+        "email",
+        "phone",
+        "skype",
+    )
 
     def __init__(self, originating_team_id, **kwargs):
-        self.identifier = kwargs["id"]
+        self.identifier = intern_string(kwargs["id"])
+        profile = kwargs.get("profile", {})
+        self.profile = {
+            key: profile[key] for key in self.profile_fields if key in profile
+        }
         # These attributes may be missing in the response, so we have to make
         # sure they're set
-        self.profile = {}
         self.presence = kwargs.get("presence", "unknown")
         self.deleted = kwargs.get("deleted", False)
+        self.is_bot = kwargs.get("is_bot", False)
         self.is_external = (
             not kwargs.get("is_bot") and kwargs.get("team_id") != originating_team_id
         )
-        for key, value in kwargs.items():
-            setattr(self, key, value)
+        self.real_name = kwargs.get("real_name")
+        extra = {
+            key: value
+            for key, value in kwargs.items()
+            if key not in SlackUser.__slots__ and key not in ("id", "profile")
+        }
+        self.extra = json.dumps(extra, separators=(",", ":")) if extra else None
 
-        self.name = nick_from_profile(self.profile, kwargs["name"])
-        self.username = kwargs["name"]
+        self.name = intern_string(nick_from_profile(self.profile, kwargs["name"]))
+        self.username = intern_string(kwargs["name"])
         self.update_color()
 
+    def __getattr__(self, key):
+        # Special names, like __dict__ which get_size checks for, are never
+        # fields of the user object
+        if key.startswith("__"):
+            raise AttributeError(key)
+        extra = object.__getattribute__(self, "extra")
+        if isinstance(extra, str):
+            extra = json.loads(extra)
+            self.extra = extra
+        if extra and key in extra:
+            return extra[key]
+        raise AttributeError(key)
+
     def __repr__(self):
         return "Name:{} Identifier:{}".format(self.name, self.identifier)
 
+    @property
+    def id(self):
+        return self.identifier
+
     def force_color(self, color_name):
         self.color_name = color_name
 
@@ -3345,10 +3812,110 @@ class SlackBot(SlackUser):
     needs
     """
 
+    __slots__ = ()
+
     def __init__(self, originating_team_id, **kwargs):
         super(SlackBot, self).__init__(originating_team_id, **kwargs)
 
 
+class SlackMessageJson(dict):
+    """
+    The json of a message. The fields which are only needed to render the
+    message are kept as a json string after it has been rendered, and are
+    parsed again when one of them is used.
+    """
+
+    __slots__ = ("packed",)
+    packed_keys = ("attachments", "blocks", "files")
+
+    def __init__(self, *args, **kwargs):
+        super(SlackMessageJson, self).__init__(*args, **kwargs)
+        self.packed = None
+
+    def pack(self):
+        if self.packed is not None:
+            return
+        fields = {}
+        for key in self.packed_keys:
+            if dict.__contains__(self, key):
+                fields[key] = dict.pop(self, key)
+        if fields:
+            self.packed = json.dumps(fields, separators=(",", ":"))
+
+    def unpack(self):
+        if self.packed is not None:
+            packed, self.packed = self.packed, None
+            dict.update(self, json.loads(packed))
+
+    def __missing__(self, key):
+        if self.packed is not None and key in self.packed_keys:
+            self.unpack()
+            return dict.__getitem__(self, key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in self.packed_keys:
+            self.unpack()
+        return dict.__contains__(self, key)
+
+    def __setitem__(self, key, value):
+        if key in self.packed_keys:
+            self.unpack()
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if key in self.packed_keys:
+            self.unpack()
+        dict.__delitem__(self, key)
+
+    def get(self, key, default=None):
+        if key in self.packed_keys:
+            self.unpack()
+        return dict.get(self, key, default)
+
+    # Everything else which looks at all the fields unpacks them first.
+
+    def __iter__(self):
+        self.unpack()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self.unpack()
+        return dict.__len__(self)
+
+    def __repr__(self):
+        self.unpack()
+        return dict.__repr__(self)
+
+    def copy(self):
+        self.unpack()
+        return dict.copy(self)
+
+    def items(self):
+        self.unpack()
+        return dict.items(self)
+
+    def keys(self):
+        self.unpack()
+        return dict.keys(self)
+
+    def values(self):
+        self.unpack()
+        return dict.values(self)
+
+    def pop(self, *args):
+        self.unpack()
+        return dict.pop(self, *args)
+
+    def setdefault(self, *args):
+        self.unpack()
+        return dict.setdefault(self, *args)
+
+    def update(self, *args, **kwargs):
+        self.unpack()
+        dict.update(self, *args, **kwargs)
+
+
 class SlackMessage(object):
     """
     Represents a single slack message and associated context/metadata.
@@ -3358,12 +3925,28 @@ class SlackMessage(object):
     can be deleted, so we have to store sender in each one.
     """
 
+    __slots__ = (
+        "team",
+        "channel",
+        "subtype",
+        "user_identifier",
+        "message_json",
+        "submessages",
+        "ts",
+        "subscribed",
+        "last_read",
+        "last_notify",
+    )
+
     def __init__(self, subtype, message_json, channel):
         self.team = channel.team
         self.channel = channel
         self.subtype = subtype
+        self.message_json = SlackMessageJson(message_json)
         self.user_identifier = message_json.get("user")
-        self.message_json = message_json
+        if self.user_identifier:
+            self.user_identifier = intern_string(self.user_identifier)
+            self.message_json["user"] = self.user_identifier
         self.submessages = []
         self.ts = SlackTS(message_json["ts"])
         self.subscribed = message_json.get("subscribed", False)
@@ -3398,6 +3981,7 @@ class SlackMessage(object):
         if self.message_json.get("deleted"):
             text = colorize_string(config.color_deleted, "(deleted)")
             self.message_json["_rendered_text"] = text
+            self.message_json.pack()
             return text
 
         blocks = self.message_json.get("blocks", [])
@@ -3450,6 +4034,7 @@ class SlackMessage(object):
         text = text[: len(blocks_rendered)] + replace_string_with_emoji(text_to_replace)
 
         self.message_json["_rendered_text"] = text
+        self.message_json.pack()
         return text
 
     def get_sender(self, plain):
@@ -3572,6 +4157,8 @@ class SlackMessage(object):
 
 
 class SlackThreadMessage(SlackMessage):
+    __slots__ = ("parent_channel", "thread_ts")
+
     def __init__(self, parent_channel, thread_ts, message_json, *args):
         subtype = message_json.get(
             "subtype",
@@ -3600,6 +4187,8 @@ class Hdata(object):
 
 
 class SlackTS(object):
+    __slots__ = ("major", "minor")
+
     def __init__(self, ts=None):
         if isinstance(ts, int):
             self.major = ts
@@ -3817,7 +4406,9 @@ def handle_rtmconnect(login_data, eventrouter, team, channel, metadata):
 
 def handle_emojilist(emoji_json, eventrouter, team, channel, metadata):
     if emoji_json["ok"]:
-        team.emoji_completions.extend(emoji_json["emoji"].keys())
+        custom_emoji = list(emoji_json["emoji"].keys())
+        team.emoji_completions = list(EMOJI.keys()) + custom_emoji
+        save_team_cache(team.token, {"emoji": custom_emoji}, "emoji")
 
 
 def handle_conversationsinfo(channel_json, eventrouter, team, channel, metadata):
@@ -5203,18 +5794,53 @@ def hdata_line_ts(line_pointer):
     return None
 
 
-def modify_buffer_line(buffer_pointer, ts, new_text):
-    own_lines = w.hdata_pointer(hdata.buffer, buffer_pointer, "own_lines")
-    line_pointer = w.hdata_pointer(hdata.lines, own_lines, "last_line")
+def hdata_line_printed(line_pointer):
+    data = w.hdata_pointer(hdata.line, line_pointer, "data")
+    return w.hdata_time(hdata.line_data, data, "date_printed")
+
+
+def index_buffer_line(line_pointers, ts, line_pointer):
+    line_pointers[ts] = (line_pointer, hdata_line_printed(line_pointer))
+
+
+def find_buffer_line(own_lines, ts, line_pointers=None):
+    """
+    Returns a pointer to the last line with this ts, or None. If
+    line_pointers has a pointer for ts it is used if WeeChat still has the
+    line, otherwise the lines are searched from the end and the result is
+    added to line_pointers.
+
+    /buffer clear empties line_pointers, and weechat.history.max_buffer_lines_*
+    only removes lines from the start of the buffer, in the order they were
+    printed, so the line is still there if it was printed after the first
+    line of the buffer. This is checked without reading the line, which may
+    have been freed.
+    """
+    entry = line_pointers.get(ts) if line_pointers else None
+    if entry:
+        line_pointer, printed = entry
+        first_line = w.hdata_pointer(hdata.lines, own_lines, "first_line")
+        if first_line and (
+            printed > hdata_line_printed(first_line)
+            or (line_pointer == first_line and hdata_line_ts(first_line) == ts)
+        ):
+            return line_pointer
+        del line_pointers[ts]
 
-    # Find the last line with this ts
-    is_last_line = True
+    line_pointer = w.hdata_pointer(hdata.lines, own_lines, "last_line")
     while line_pointer and hdata_line_ts(line_pointer) != ts:
-        is_last_line = False
         line_pointer = w.hdata_move(hdata.line, line_pointer, -1)
+    if line_pointer and line_pointers is not None:
+        index_buffer_line(line_pointers, ts, line_pointer)
+    return line_pointer
+
 
+def modify_buffer_line(buffer_pointer, ts, new_text, line_pointers=None):
+    own_lines = w.hdata_pointer(hdata.buffer, buffer_pointer, "own_lines")
+    line_pointer = find_buffer_line(own_lines, ts, line_pointers)
     if not line_pointer:
         return w.WEECHAT_RC_OK
+    is_last_line = line_pointer == w.hdata_pointer(hdata.lines, own_lines, "last_line")
 
     if weechat_version >= 0x04000000:
         data = w.hdata_pointer(hdata.line, line_pointer, "data")
@@ -5251,6 +5877,8 @@ def modify_buffer_line(buffer_pointer, ts, new_text):
             for _ in range(extra_lines_count):
                 w.prnt_date_tags(buffer_pointer, ts.major, tags_str, " \t ")
                 pointers.append(w.hdata_pointer(hdata.lines, own_lines, "last_line"))
+            if line_pointers is not None:
+                index_buffer_line(line_pointers, ts, pointers[-1])
             if should_set_unread:
                 w.buffer_set(buffer_pointer, "unread", "")
             w.buffer_set(buffer_pointer, "print_hooks_enabled", "1")
@@ -5270,6 +5898,75 @@ def modify_buffer_line(buffer_pointer, ts, new_text):
     return w.WEECHAT_RC_OK
 
 
+def benchmark_modify_buffer_line(lines_count=100000, changes=200):
+    """
+    Prints lines_count messages in a temporary buffer and times changing
+    messages spread over the buffer, by searching for the lines and by using
+    an index of line pointers. Returns the seconds per change for both.
+    """
+    option = w.config_get("weechat.history.max_buffer_lines_number")
+    max_buffer_lines = w.config_string(option)
+    w.config_option_set(option, "0", 1)
+    buffer_pointer = w.buffer_new("slack.benchmark", "", "", "", "")
+    try:
+        w.buffer_set(buffer_pointer, "print_hooks_enabled", "0")
+        own_lines = w.hdata_pointer(hdata.buffer, buffer_pointer, "own_lines")
+        line_pointers = {}
+        timestamps = []
+        for i in range(lines_count):
+            ts = SlackTS("{}.{:06}".format(1500000000 + i, i % 1000000))
+            w.prnt_date_tags(
+                buffer_pointer, ts.major, tag(ts, "channel"), "nick\tmessage {}".format(i)
+            )
+            last_line = w.hdata_pointer(hdata.lines, own_lines, "last_line")
+            index_buffer_line(line_pointers, ts, last_line)
+            timestamps.append(ts)
+        step = max(1, lines_count // changes)
+        changed = timestamps[::step]
+
+        results = []
+        for index in (None, line_pointers):
+            start = time.time()
+            for ts in changed:
+                modify_buffer_line(buffer_pointer, ts, "nick\tchanged", index)
+            results.append((time.time() - start) / len(changed))
+        return results
+    finally:
+        w.buffer_close(buffer_pointer)
+        w.config_option_set(option, max_buffer_lines, 1)
+
+
+def benchmark_hashed_messages(timestamps_count=50000, scan_count=5000):
+    """
+    Times assigning short hashes to timestamps_count timestamps, and to the
+    first scan_count of them when checking for used prefixes by looking at
+    all the hashes, as was done before. Returns the seconds for both.
+    """
+
+    class BenchmarkChannel(object):
+        messages = {}
+
+    class ScanningHashedMessages(SlackChannelHashedMessages):
+        def is_prefix_used(self, short_hash):
+            return any(x.startswith(short_hash) for x in self if isinstance(x, str))
+
+    timestamps = [
+        SlackTS("{}.{:06}".format(1500000000 + i, i % 1000000))
+        for i in range(timestamps_count)
+    ]
+    results = []
+    for cls, n in (
+        (SlackChannelHashedMessages, timestamps_count),
+        (ScanningHashedMessages, scan_count),
+    ):
+        hashed_messages = cls(BenchmarkChannel())
+        start = time.time()
+        for ts in timestamps[:n]:
+            hashed_messages[ts]
+        results.append(time.time() - start)
+    return results
+
+
 def nick_from_profile(profile, username):
     if config.use_usernames:
         nick = username
@@ -6161,6 +6858,241 @@ def command_help(data, current_buffer, args):
     return w.WEECHAT_RC_OK
 
 
+def format_time_stats(stats, title):
+    """
+    Formats a dict of name -> [count, total seconds, max seconds], as kept
+    in EventRouter.event_stats, as a table with the slowest first.
+    """
+    max_name_length = max(len(name) for name in stats)
+    lines = [
+        "    {:<{}}{:>8}{:>12}{:>10}{:>10}".format(
+            title, max_name_length + 2, "count", "total ms", "avg ms", "max ms"
+        )
+    ]
+    for name, (event_count, total, longest) in sorted(
+        stats.items(), key=lambda item: -item[1][1]
+    ):
+        lines.append(
+            "    {:<{}}{:>8}{:>12.1f}{:>10.2f}{:>10.2f}".format(
+                name,
+                max_name_length + 2,
+                event_count,
+                total * 1000,
+                total * 1000 / event_count,
+                longest * 1000,
+            )
+        )
+    return lines
+
+
+@utf8_decode
+def command_debug(data, current_buffer, args):
+    """
+    /slack debug [-reset|-benchmark [<lines>]]
+    Show how the event queue is doing, how much time was spent handling each
+    type of event and how requests to the Slack API are throttled. Use -reset
+    to clear the counters.
+    -benchmark times changing messages (as for edits and reactions) in a
+    temporary buffer with <lines> lines (default 100000), and assigning short
+    hashes to 50000 messages.
+    """
+    if args == "-reset":
+        EVENTROUTER.reset_stats()
+        w.prnt("", "slack: debug counters cleared")
+        return w.WEECHAT_RC_OK_EAT
+    elif args.startswith("-benchmark"):
+        lines_arg = args[len("-benchmark") :].strip()
+        lines_count = int(lines_arg) if lines_arg.isdigit() else 100000
+        search_time, index_time = benchmark_modify_buffer_line(lines_count)
+        w.prnt(
+            "",
+            "slack: changing a message in a buffer with {} lines took {:.3f} ms"
+            " searching the lines, {:.3f} ms using the line index".format(
+                lines_count, search_time * 1000, index_time * 1000
+            ),
+        )
+        hashes_time, scan_time = benchmark_hashed_messages()
+        w.prnt(
+            "",
+            "slack: assigning short hashes to 50000 messages took {:.0f} ms, the"
+            " first 5000 took {:.0f} ms when looking at all hashes".format(
+                hashes_time * 1000, scan_time * 1000
+            ),
+        )
+        return w.WEECHAT_RC_OK_EAT
+
+    er = EVENTROUTER
+    w.prnt("", "\n{}".format(colorize_string("bold", "Slack event queue:")))
+    w.prnt(
+        "",
+        "    queued: {}, slow queue: {}, pending replies: {}".format(
+            len(er.queue), len(er.slow_queue), len(er.reply_buffer)
+        ),
+    )
+    w.prnt(
+        "",
+        "    ticks with events: {}, largest batch: {}, longest queue: {}"
+        " (last {:.0f} seconds, budget {:.0f} ms per tick)".format(
+            er.handle_next_ticks,
+            er.handle_next_max_batch,
+            er.handle_next_max_queue,
+            time.time() - er.stats_since,
+            HANDLE_NEXT_TIME_BUDGET * 1000,
+        ),
+    )
+    if er.event_stats:
+        w.prnt("", "\n{}".format(colorize_string("bold", "Time per event type:")))
+        for line in format_time_stats(er.event_stats, "event"):
+            w.prnt("", line)
+
+    scheduler = er.request_scheduler
+    w.prnt("", "\n{}".format(colorize_string("bold", "Slack API requests:")))
+    for team in er.teams.values():
+        key = team.team_hash
+        w.prnt(
+            "",
+            "    {}: {} running (max {}), {} waiting".format(
+                team.domain,
+                len(scheduler.in_flight.get(key, ())),
+                config.max_requests_in_flight,
+                scheduler.pending_count(key),
+            ),
+        )
+    if scheduler.method_stats:
+        max_name_length = max(len(name) for name in scheduler.method_stats)
+        w.prnt(
+            "",
+            "    {:<{}}{:>8}{:>14}{:>14}".format(
+                "method", max_name_length + 2, "sent", "rate limited", "avg wait ms"
+            ),
+        )
+        for name, (sent, limited, waited) in sorted(scheduler.method_stats.items()):
+            w.prnt(
+                "",
+                "    {:<{}}{:>8}{:>14}{:>14.1f}".format(
+                    name,
+                    max_name_length + 2,
+                    sent,
+                    limited,
+                    waited * 1000 / sent if sent else 0,
+                ),
+            )
+    return w.WEECHAT_RC_OK_EAT
+
+
+command_debug.completion = "-reset|-benchmark"
+
+
+def get_size(obj, seen):
+    """
+    Approximates the memory used by obj and everything it refers to, except
+    objects in seen (which the objects counted here are added to), modules,
+    classes, functions and the team, channel and event router objects other
+    than obj itself.
+    """
+    size = 0
+    objects = [obj]
+    while objects:
+        o = objects.pop()
+        if id(o) in seen or isinstance(o, (type, type(sys), type(get_size))):
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            # Not o.items(), as that would unpack a SlackMessageJson
+            objects.extend(dict.keys(o))
+            objects.extend(dict.values(o))
+            if isinstance(o, SlackMessageJson):
+                objects.append(o.packed)
+        elif isinstance(o, (list, tuple, set, frozenset, deque)):
+            objects.extend(o)
+        elif isinstance(o, (SlackTeam, SlackChannelCommon, EventRouter)) and o is not obj:
+            size -= sys.getsizeof(o)
+        elif hasattr(o, "__dict__"):
+            objects.append(o.__dict__)
+        else:
+            for cls in type(o).__mro__:
+                for slot in getattr(cls, "__slots__", ()):
+                    objects.append(getattr(o, slot, None))
+    return size
+
+
+def format_size(size):
+    if size >= 1024 * 1024:
+        return "{:.1f} MiB".format(size / 1024.0 / 1024)
+    return "{:.1f} KiB".format(size / 1024.0)
+
+
+@utf8_decode
+def command_memory(data, current_buffer, args):
+    """
+    /slack memory [<count>]
+    Show approximately how much memory is used for each team, and for the
+    <count> (default 10) channels using the most for messages, and how many
+    messages are kept compared to history_max_total.
+    """
+    max_channels = int(args) if args.isdigit() else 10
+    w.prnt("", "\n{}".format(colorize_string("bold", "Slack memory use:")))
+    for team in EVENTROUTER.teams.values():
+        seen = set()
+        users_size = get_size(team.users, seen) + get_size(team.bots, seen)
+        channel_sizes = []
+        for channel in team.channels.values():
+            messages_size = get_size(channel.messages, seen)
+            threads_size = sum(
+                get_size(thread_channel, seen)
+                for thread_channel in channel.thread_channels.values()
+            )
+            size = messages_size + threads_size + get_size(channel, seen)
+            channel_sizes.append((size, messages_size, len(channel.messages), channel))
+        channels_size = sum(size for size, _, _, _ in channel_sizes)
+        team_size = get_size(team, seen)
+        messages_count = sum(num_messages for _, _, num_messages, _ in channel_sizes)
+        messages_size = sum(size for _, size, _, _ in channel_sizes)
+        w.prnt(
+            "",
+            "    {}: {} ({} in {} users, {} in {} channels, {} messages with {}"
+            " per message)".format(
+                team.domain,
+                format_size(team_size + users_size + channels_size),
+                format_size(users_size),
+                len(team.users) + len(team.bots),
+                format_size(channels_size),
+                len(channel_sizes),
+                messages_count,
+                "{} bytes".format(messages_size // messages_count)
+                if messages_count
+                else "-",
+            ),
+        )
+        channel_sizes.sort(key=lambda item: item[0], reverse=True)
+        for size, messages_size, num_messages, channel in channel_sizes[:max_channels]:
+            if not num_messages:
+                break
+            w.prnt(
+                "",
+                "        {}: {}, {} messages with {} bytes per message".format(
+                    channel.formatted_name(style="long_default"),
+                    format_size(size),
+                    num_messages,
+                    messages_size // num_messages,
+                ),
+            )
+
+    total = sum(
+        len(channel.messages)
+        for team in EVENTROUTER.teams.values()
+        for channel in team.channels.values()
+    )
+    w.prnt(
+        "",
+        "    messages kept: {} (history_max_total: {})".format(
+            total, config.history_max_total or "unlimited"
+        ),
+    )
+    return w.WEECHAT_RC_OK_EAT
+
+
 @slack_buffer_required
 @utf8_decode
 def command_distracting(data, current_buffer, args):
@@ -6619,9 +7551,11 @@ def setup_hooks():
     w.hook_timer(1000, 0, 0, "buffer_list_update_callback", "")
     w.hook_timer(3000, 0, 0, "reconnect_callback", "EVENTROUTER")
     w.hook_timer(1000 * 60 * 5, 0, 0, "slack_never_away_cb", "")
+    w.hook_timer(1000 * 30, 0, 0, "history_budget_cb", "")
 
     w.hook_signal("buffer_closing", "buffer_closing_callback", "")
     w.hook_signal("buffer_renamed", "buffer_renamed_cb", "")
+    w.hook_signal("buffer_cleared", "buffer_cleared_cb", "")
     w.hook_signal("buffer_switch", "buffer_switch_callback", "")
     w.hook_signal("window_switch", "buffer_switch_callback", "")
     w.hook_signal("quit", "quit_notification_callback", "")
@@ -6777,6 +7711,13 @@ class PluginConfig(object):
             " you experience performance issues, however that causes some loss of functionality,"
             " see known issues in the readme.",
         ),
+        "cache_team_data": Setting(
+            default="true",
+            desc="Keep the users, channels, user groups and custom emoji of"
+            " each team on disk, so the team can be set up at once when"
+            " connecting. They are still fetched in the background, and the"
+            " team is updated with what changed.",
+        ),
         "channel_name_typing_indicator": Setting(
             default="true",
             desc="Change the prefix of a channel from # to > when someone is"
@@ -6847,6 +7788,19 @@ class PluginConfig(object):
             desc="The number of messages to fetch for each channel when fetching"
             " history, between 1 and 1000.",
         ),
+        "history_max_per_channel": Setting(
+            default="0",
+            desc="The number of messages to keep for each channel. Older"
+            " messages are dropped, unless a thread buffer for them is open."
+            " 0 uses weechat.history.max_buffer_lines_number.",
+        ),
+        "history_max_total": Setting(
+            default="0",
+            desc="The number of messages to keep for all channels together."
+            " When there are more, the messages of the least recently viewed"
+            " channels without an open buffer are dropped, and fetched again"
+            " when their buffer is opened. 0 means no limit.",
+        ),
         "link_previews": Setting(
             default="true", desc="Show previews of website content linked by teammates."
         ),
@@ -6860,6 +7814,11 @@ class PluginConfig(object):
             ' character for it. The default ("_") sends it as italics. Use'
             ' "*" to send bold instead.',
         ),
+        "max_requests_in_flight": Setting(
+            default="8",
+            desc="How many requests to the Slack API may run at the same time"
+            " for each team. Further requests wait until one of these finish.",
+        ),
         "muted_channels_activity": Setting(
             default="personal_highlights",
             desc="Control which activity you see from muted channels, either"
@@ -7072,7 +8031,10 @@ class PluginConfig(object):
     get_files_download_location = get_string
     get_group_name_prefix = get_string
     get_history_fetch_count = get_int
+    get_history_max_per_channel = get_int
+    get_history_max_total = get_int
     get_map_underline_to = get_string
+    get_max_requests_in_flight = get_int
     get_muted_channels_activity = get_string
     get_thread_broadcast_prefix = get_string
     get_render_bold_as = get_string
@@ -7186,8 +8148,66 @@ def get_next_page(response_json):
         return False
 
 
-def initiate_connection(token):
-    initial_data = {
+def get_team_cache_path(token, name):
+    cache_dir = (
+        w.info_get("weechat_cache_dir", "")
+        or w.info_get("weechat_data_dir", "")
+        or w.info_get("weechat_dir", "")
+    )
+    token_hash = sha1_hex(token.split(":", 1)[0])
+    return os.path.join(cache_dir, "slack", "{}.{}.json".format(token_hash, name))
+
+
+def load_team_cache(token):
+    """
+    Returns the team data saved by save_team_cache for this token, in the
+    same form as the initial_data built by initiate_connection, or None if
+    there is no (usable) cache.
+    """
+    if not config.cache_team_data:
+        return None
+    try:
+        with open(get_team_cache_path(token, "team")) as f:
+            cached_data = json.load(f)
+        if cached_data.get("version") != TEAM_CACHE_VERSION:
+            return None
+    except (IOError, OSError, ValueError):
+        return None
+    try:
+        with open(get_team_cache_path(token, "emoji")) as f:
+            cached_data["emoji"] = json.load(f)["emoji"]
+    except (IOError, OSError, ValueError, KeyError):
+        cached_data["emoji"] = []
+    return cached_data
+
+
+def save_team_cache(token, data, name="team"):
+    if not config.cache_team_data:
+        return
+    path = get_team_cache_path(token, name)
+    try:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), 0o700)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(dict(data, version=TEAM_CACHE_VERSION), f, separators=(",", ":"))
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        dbg("Couldn't save team cache {}: {}".format(path, format_exc_only()), 5)
+
+
+def get_team_cache_data(initial_data):
+    return {
+        "channels": initial_data["channels"],
+        "members": initial_data["members"],
+        "usergroups": initial_data["usergroups"],
+        "prefs": initial_data["prefs"],
+        "presence": {"manual_away": initial_data["presence"]["manual_away"]},
+    }
+
+
+def new_initial_data():
+    return {
         "channels": [],
         "members": [],
         "usergroups": [],
@@ -7201,6 +8221,13 @@ def initiate_connection(token):
         "errors": [],
     }
 
+
+def request_team_data(token, initial_data, on_update, team=None, priority=None):
+    """
+    Requests the data needed to set up a team, and adds it to initial_data.
+    on_update is called each time one of the kinds of data is complete.
+    """
+
     def handle_initial(data_type):
         def handle(response_json, eventrouter, team, channel, metadata):
             if not response_json["ok"]:
@@ -7215,14 +8242,14 @@ def initiate_connection(token):
                         "{}: {}".format(data_type, response_json["error"])
                     )
                 initial_data["remaining"][data_type] -= 1
-                create_team(token, initial_data)
+                on_update()
                 return
 
             initial_data[data_type].extend(response_json[data_type])
 
             if not get_next_page(response_json):
                 initial_data["remaining"][data_type] -= 1
-                create_team(token, initial_data)
+                on_update()
 
         return handle
 
@@ -7230,78 +8257,214 @@ def initiate_connection(token):
         if not response_json["ok"]:
             initial_data["errors"].append("prefs: {}".format(response_json["error"]))
             initial_data["remaining"]["prefs"] -= 1
-            create_team(token, initial_data)
+            on_update()
             return
 
         initial_data["prefs"] = response_json["prefs"]
         initial_data["remaining"]["prefs"] -= 1
-        create_team(token, initial_data)
+        on_update()
 
     def handle_getPresence(response_json, eventrouter, team, channel, metadata):
         if not response_json["ok"]:
             initial_data["errors"].append("presence: {}".format(response_json["error"]))
             initial_data["remaining"]["presence"] -= 1
-            create_team(token, initial_data)
+            on_update()
             return
 
         initial_data["presence"] = response_json
         initial_data["remaining"]["presence"] -= 1
+        on_update()
+
+    requests = [
+        (
+            "conversations.list",
+            {
+                "exclude_archived": True,
+                "types": "public_channel,private_channel,im",
+                "limit": 1000,
+            },
+            handle_initial("channels"),
+        ),
+        (
+            "conversations.list",
+            {
+                "exclude_archived": True,
+                "types": "mpim",
+                "limit": 1000,
+            },
+            handle_initial("channels"),
+        ),
+        ("users.list", {"limit": 1000}, handle_initial("members")),
+        ("usergroups.list", {"include_users": True}, handle_initial("usergroups")),
+        ("users.prefs.get", None, handle_prefs),
+        ("users.getPresence", None, handle_getPresence),
+    ]
+    for request, post_data, callback in requests:
+        s = SlackRequest(
+            team,
+            request,
+            post_data,
+            token=token,
+            callback=callback,
+            priority=priority,
+        )
+        EVENTROUTER.receive(s)
+
+
+def initiate_connection(token):
+    initial_data = new_initial_data()
+    cached_data = load_team_cache(token)
+    if cached_data:
+        initial_data.update(cached_data, remaining={}, cached=True)
         create_team(token, initial_data)
+    else:
+        request_team_data(
+            token, initial_data, lambda: create_team(token, initial_data)
+        )
 
-    s = SlackRequest(
-        None,
-        "conversations.list",
-        {
-            "exclude_archived": True,
-            "types": "public_channel,private_channel,im",
-            "limit": 1000,
-        },
-        token=token,
-        callback=handle_initial("channels"),
-    )
-    EVENTROUTER.receive(s)
-    s = SlackRequest(
-        None,
-        "conversations.list",
-        {
-            "exclude_archived": True,
-            "types": "mpim",
-            "limit": 1000,
-        },
-        token=token,
-        callback=handle_initial("channels"),
-    )
-    EVENTROUTER.receive(s)
-    s = SlackRequest(
-        None,
-        "users.list",
-        {"limit": 1000},
-        token=token,
-        callback=handle_initial("members"),
-    )
-    EVENTROUTER.receive(s)
-    s = SlackRequest(
-        None,
-        "usergroups.list",
-        {"include_users": True},
-        token=token,
-        callback=handle_initial("usergroups"),
+
+def refresh_team_data(team, cached_data):
+    """
+    Fetches the team data again after the team was set up from the cache,
+    updates the team with what changed since and saves the new data.
+    """
+    fresh_data = new_initial_data()
+
+    def on_update():
+        if any(fresh_data["remaining"].values()):
+            return
+        if fresh_data["errors"]:
+            dbg(
+                "Couldn't refresh cached data for team {}: {}".format(
+                    team.domain, ", ".join(fresh_data["errors"])
+                ),
+                level=5,
+            )
+            return
+        if EVENTROUTER.teams.get(team.team_hash) is not team:
+            return
+        update_team_data(team, cached_data, fresh_data)
+        save_team_cache(team.token, get_team_cache_data(fresh_data))
+
+    request_team_data(
+        team.token, fresh_data, on_update, team=team, priority=REQUEST_PRIORITY_LOW
     )
-    EVENTROUTER.receive(s)
-    s = SlackRequest(
-        None,
-        "users.prefs.get",
-        token=token,
-        callback=handle_prefs,
+
+
+def update_team_data(team, old_data, new_data):
+    """
+    Applies the difference between two sets of team data (as fetched by
+    request_team_data) to a team. Users and channels are compared using the
+    updated timestamp Slack sets on them, and channels also by membership and
+    archived state, which don't change it. Users and channels missing from the
+    new data (deleted, archived or left) are removed.
+    """
+    old_members = {
+        member["id"]: member.get("updated") for member in old_data["members"]
+    }
+    new_member_ids = {member["id"] for member in new_data["members"]}
+    removed_users = 0
+    for member_id in old_members:
+        if member_id in new_member_ids:
+            continue
+        if team.users.pop(member_id, None) or team.bots.pop(member_id, None):
+            removed_users += 1
+
+    changed_users = 0
+    for member in new_data["members"]:
+        member_id = member["id"]
+        if member_id in old_members and old_members[member_id] == member.get("updated"):
+            continue
+        changed_users += 1
+        if member.get("is_bot"):
+            team.bots[member_id] = SlackBot(team.identifier, **member)
+            continue
+        old_user = team.users.get(member_id)
+        user = SlackUser(team.identifier, **member)
+        if old_user:
+            user.presence = old_user.presence
+            user.color_name = old_user.color_name
+        team.users[member_id] = user
+        dmchannel = team.find_channel_by_members(
+            {team.myidentifier, member_id}, channel_type="im"
+        )
+        if dmchannel:
+            dmchannel.set_topic(create_user_status_string(user.profile))
+
+    old_channels = {channel["id"]: channel for channel in old_data["channels"]}
+    new_channel_ids = {channel_info["id"] for channel_info in new_data["channels"]}
+    removed_channels = 0
+    for channel_id in old_channels:
+        if channel_id in new_channel_ids:
+            continue
+        channel = team.channels.pop(channel_id, None)
+        if channel is None:
+            continue
+        removed_channels += 1
+        weechat_controller = team.eventrouter.weechat_controller
+        for thread_channel in channel.thread_channels.values():
+            weechat_controller.unregister_buffer(
+                thread_channel.channel_buffer, False, True
+            )
+        weechat_controller.unregister_buffer(channel.channel_buffer, False, True)
+
+    def channel_state(channel_info):
+        return (
+            channel_info.get("updated"),
+            channel_info.get("is_member"),
+            channel_info.get("is_archived"),
+        )
+
+    changed_channels = 0
+    for channel_info in new_data["channels"]:
+        old_info = old_channels.get(channel_info["id"], {})
+        if channel_state(old_info) == channel_state(channel_info):
+            continue
+        changed_channels += 1
+        channel = team.channels.get(channel_info["id"])
+        if channel is None:
+            channel = create_channel_from_info(
+                team.eventrouter, channel_info, team, team.myidentifier, team.users
+            )
+            team.channels[channel_info["id"]] = channel
+            channel.check_should_open()
+            continue
+        if (
+            channel.type not in ("im", "mpim")
+            and "name" in channel_info
+            and channel_info["name"] != old_info.get("name")
+        ):
+            channel.set_name(channel_info["name"])
+        for key in ("is_member", "is_archived"):
+            if key in channel_info:
+                setattr(channel, key, channel_info[key])
+        if channel_info.get("is_member") and not old_info.get("is_member"):
+            channel.check_should_open()
+
+    team.subteams = {
+        usergroup["id"]: SlackSubteam(
+            team.identifier,
+            is_member=team.myidentifier in usergroup.get("users", []),
+            **usergroup
+        )
+        for usergroup in new_data["usergroups"]
+    }
+    team.set_muted_channels(new_data["prefs"].get("muted_channels", ""))
+    team.set_highlight_words(get_global_keywords(new_data["prefs"]))
+    team.my_manual_presence = (
+        "away" if new_data["presence"]["manual_away"] else "active"
     )
-    EVENTROUTER.receive(s)
-    s = SlackRequest(
-        None,
-        "users.getPresence",
-        token=token,
-        callback=handle_getPresence,
+    dbg(
+        "Refreshed cached data for team {}: {} users and {} channels changed, "
+        "{} users and {} channels removed".format(
+            team.domain,
+            changed_users,
+            changed_channels,
+            removed_users,
+            removed_channels,
+        ),
+        level=5,
     )
-    EVENTROUTER.receive(s)
 
 
 def create_channel_from_info(eventrouter, channel_info, team, myidentifier, users):
@@ -7321,6 +8484,27 @@ def create_channel_from_info(eventrouter, channel_info, team, myidentifier, user
         return SlackChannel(eventrouter, team=team, **channel_info)
 
 
+def get_global_keywords(prefs):
+    try:
+        all_notifications_prefs = json.loads(prefs.get("all_notifications_prefs"))
+        global_keywords = all_notifications_prefs.get("global", {}).get(
+            "global_keywords"
+        )
+    except json.decoder.JSONDecodeError:
+        global_keywords = None
+
+    if global_keywords is None:
+        print_error("global_keywords not found in users.prefs.get", warning=True)
+        dbg(
+            "global_keywords not found in users.prefs.get. Response of users.prefs.get: {}".format(
+                json.dumps(prefs)
+            ),
+            level=5,
+        )
+        global_keywords = ""
+    return global_keywords
+
+
 def create_team(token, initial_data):
     if not any(initial_data["remaining"].values()):
         if initial_data["errors"]:
@@ -7376,27 +8560,7 @@ def create_team(token, initial_data):
                 "away" if initial_data["presence"]["manual_away"] else "active"
             )
 
-            try:
-                all_notifications_prefs = json.loads(
-                    initial_data["prefs"].get("all_notifications_prefs")
-                )
-                global_keywords = all_notifications_prefs.get("global", {}).get(
-                    "global_keywords"
-                )
-            except json.decoder.JSONDecodeError:
-                global_keywords = None
-
-            if global_keywords is None:
-                print_error(
-                    "global_keywords not found in users.prefs.get", warning=True
-                )
-                dbg(
-                    "global_keywords not found in users.prefs.get. Response of users.prefs.get: {}".format(
-                        json.dumps(initial_data["prefs"])
-                    ),
-                    level=5,
-                )
-                global_keywords = ""
+            global_keywords = get_global_keywords(initial_data["prefs"])
 
             team_info = {
                 "id": team_id,
@@ -7425,7 +8589,13 @@ def create_team(token, initial_data):
                     highlight_words=global_keywords,
                 )
                 eventrouter.register_team(team)
+                if team.emoji_completions:
+                    team.emoji_completions.extend(initial_data.get("emoji", []))
                 team.connect()
+                if initial_data.get("cached"):
+                    refresh_team_data(team, initial_data)
+                else:
+                    save_team_cache(token, get_team_cache_data(initial_data))
             else:
                 team = eventrouter.teams.get(team_hash)
                 if team.myidentifier != myidentifier:
@@ -7456,6 +8626,291 @@ def create_team(token, initial_data):
         EVENTROUTER.receive(s)
 
 
+class ReplayWeechat(object):
+    """
+    Stands in for the weechat module when replaying recorded events outside
+    of WeeChat with replay_main. Plugin options and buffer pointers are kept,
+    HTTP requests are collected so they can be answered with the recorded
+    responses, and everything else does nothing.
+    """
+
+    WEECHAT_RC_OK = 0
+    WEECHAT_RC_OK_EAT = 1
+    WEECHAT_RC_ERROR = -1
+    WEECHAT_LIST_POS_SORT = "sort"
+    WEECHAT_LIST_POS_BEGINNING = "beginning"
+
+    def __init__(self):
+        self.plugin_options = {}
+        self.buffer_numbers = count(1)
+        self.http_requests = []
+
+    def __getattr__(self, name):
+        if "integer" in name:
+            return lambda *args, **kwargs: 0
+        return lambda *args, **kwargs: ""
+
+    def config_get_plugin(self, option):
+        return self.plugin_options.get(option, "")
+
+    def config_is_set_plugin(self, option):
+        return option in self.plugin_options
+
+    def config_set_plugin(self, option, value):
+        self.plugin_options[option] = value
+        return 1
+
+    def config_string_to_boolean(self, value):
+        return int(value in ("on", "yes", "y", "true", "t", "1"))
+
+    def buffer_new(self, *args):
+        return "0x{:x}".format(next(self.buffer_numbers))
+
+    def string_eval_expression(self, expression, *args):
+        return expression
+
+    def hook_process_hashtable(self, command, options, timeout, callback, data):
+        if callback == "receive_httprequest_callback":
+            self.http_requests.append(data)
+        return "0x1"
+
+
+def load_recorded_events(directory):
+    """
+    Reads the events written by EventRouter.record_event for one team.
+    Returns the websocket events in the order they were received, and the
+    HTTP responses in a deque per request (as in request_normalized).
+
+    The responses to the requests setting up the team are sent before the
+    team is known, so they are recorded in unknown_team next to the team
+    directory, and are read from there too.
+    """
+    directories = [directory]
+    unknown_team = os.path.join(
+        os.path.dirname(os.path.abspath(directory)), "unknown_team"
+    )
+    if os.path.isdir(unknown_team) and unknown_team != os.path.abspath(directory):
+        directories.append(unknown_team)
+
+    files = []
+    for team_directory in directories:
+        for subdir in ("websocket", "http"):
+            path = os.path.join(team_directory, subdir)
+            if not os.path.isdir(path):
+                continue
+            for name in os.listdir(path):
+                if name.endswith(".json"):
+                    recorded_time = float(name.split("-", 1)[0])
+                    files.append((recorded_time, subdir, os.path.join(path, name)))
+
+    websocket_events = []
+    http_responses = {}
+    for _, subdir, path in sorted(files):
+        with open(path) as f:
+            message_json = json.load(f)
+        if subdir == "websocket":
+            websocket_events.append(message_json)
+        else:
+            method = message_json.get("wee_slack_process_method", "unknown")
+            http_responses.setdefault(method, deque()).append(message_json)
+    return websocket_events, http_responses
+
+
+def replay_answer_requests(http_responses):
+    """
+    Answers the HTTP requests sent since the last call with the next recorded
+    response for the same request. Returns how many had no response left.
+    """
+    unanswered = 0
+    while w.http_requests:
+        data = w.http_requests.pop(0)
+        request = EVENTROUTER.retrieve_context(data)
+        responses = http_responses.get(request.request_normalized)
+        if not responses:
+            unanswered += 1
+            EVENTROUTER.request_scheduler.finished(request)
+            EVENTROUTER.delete_context(data)
+            continue
+        response_json = dict(responses.popleft())
+        if "url" in response_json and request.request == "rtm.connect":
+            # Don't connect to the recorded websocket
+            response_json["url"] = ""
+        EVENTROUTER.receive_httprequest_callback(
+            data,
+            "",
+            0,
+            "HTTP/1.1 200 OK\r\n\r\n{}".format(json.dumps(response_json)),
+            "",
+        )
+    return unanswered
+
+
+def replay_run_until_idle(http_responses):
+    """
+    Handles queued events and answers requests until there is nothing left
+    to do. Returns the number of unanswered requests and failed events.
+    Requests still in the scheduler after that can't be sent yet, as they
+    wait for their retry delay, and are counted by replay_main.
+    """
+    unanswered = 0
+    errors = 0
+    while True:
+        # There is no timer to release the slow queue, so drain it directly
+        EVENTROUTER.queue.extend(EVENTROUTER.slow_queue)
+        del EVENTROUTER.slow_queue[:]
+        try:
+            EVENTROUTER.handle_next()
+        except Exception:
+            errors += 1
+            traceback.print_exc()
+        if w.http_requests:
+            unanswered += replay_answer_requests(http_responses)
+        elif EVENTROUTER.queue or EVENTROUTER.slow_queue:
+            continue
+        elif EVENTROUTER.request_scheduler.has_pending():
+            # An event that failed stops handle_next before it sends requests
+            EVENTROUTER.request_scheduler.run()
+            if not w.http_requests:
+                return unanswered, errors
+        else:
+            return unanswered, errors
+
+
+def replay_time_function(name, stats):
+    function = globals()[name]
+
+    @wraps(function)
+    def timed(*args, **kwargs):
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            function_stats = stats.setdefault(name, [0, 0, 0])
+            function_stats[0] += 1
+            function_stats[1] += elapsed
+            function_stats[2] = max(function_stats[2], elapsed)
+
+    globals()[name] = timed
+
+
+def replay_main(args):
+    """
+    python slack.py [<directory>]
+
+    Replays a session recorded with the record_events option outside of
+    WeeChat, as fast as possible, and prints how many events per second
+    were handled, the time spent per event type and rendering function, and
+    the peak memory use. <directory> is the recording of one team, by
+    default the only team in RECORD_DIR. The team is set up from the
+    recorded responses, so the recording has to include the connection
+    (record_events has to be on when the script is loaded).
+    """
+    global w, weechat_version, EVENTROUTER, config, hdata, slack_debug
+    global EMOJI, EMOJI_WITH_SKIN_TONES_REVERSE, typing_timer, hide_distractions
+    global receive_httprequest_callback
+
+    if args and args[0] in ("-h", "--help"):
+        print(textwrap.dedent(replay_main.__doc__).strip())
+        return 0
+    if args:
+        directory = args[0]
+    else:
+        teams = [
+            name
+            for name in (os.listdir(RECORD_DIR) if os.path.isdir(RECORD_DIR) else [])
+            if name != "unknown_team"
+            and os.path.isdir(os.path.join(RECORD_DIR, name))
+        ]
+        if len(teams) != 1:
+            print("Give the directory of the recorded team to replay.")
+            return 1
+        directory = os.path.join(RECORD_DIR, teams[0])
+
+    websocket_events, http_responses = load_recorded_events(directory)
+    responses_count = sum(len(responses) for responses in http_responses.values())
+
+    w = ReplayWeechat()
+    w.plugin_options["cache_team_data"] = "false"
+    weechat_version = 0x4000000
+    slack_debug = None
+    config = PluginConfig()
+    hdata = Hdata(w)
+    EMOJI, EMOJI_WITH_SKIN_TONES_REVERSE = load_emoji()
+    typing_timer = time.time()
+    hide_distractions = False
+    EVENTROUTER = EventRouter()
+    EVENTROUTER.request_scheduler.use_rate_limits = False
+    receive_httprequest_callback = EVENTROUTER.receive_httprequest_callback
+
+    render_stats = {}
+    for name in (
+        "render_formatting",
+        "linkify_text",
+        "unfurl_blocks",
+        "unfurl_refs",
+        "unhtmlescape",
+    ):
+        replay_time_function(name, render_stats)
+
+    start = time.time()
+    initiate_connection("xoxp-replay")
+    unanswered, errors = replay_run_until_idle(http_responses)
+    setup_time = time.time() - start
+    if not EVENTROUTER.teams:
+        print("No team could be set up from the recorded responses.")
+        return 1
+    team = list(EVENTROUTER.teams.values())[0]
+
+    start = time.time()
+    for message_json in websocket_events:
+        message_json["wee_slack_metadata_team"] = team
+        EVENTROUTER.receive(message_json)
+        event_unanswered, event_errors = replay_run_until_idle(http_responses)
+        unanswered += event_unanswered
+        errors += event_errors
+    replay_time = time.time() - start
+
+    print(
+        "Replayed {} websocket events and {} responses for {} in {:.2f} s"
+        " ({:.0f} events/s), after {:.2f} s setting up the team.".format(
+            len(websocket_events),
+            responses_count - sum(len(r) for r in http_responses.values()),
+            team.domain,
+            replay_time,
+            len(websocket_events) / replay_time if replay_time else 0,
+            setup_time,
+        )
+    )
+    print("Requests without a recorded response: {}".format(unanswered))
+    queued = 0
+    if EVENTROUTER.request_scheduler.has_pending():
+        queued = EVENTROUTER.request_scheduler.pending_count()
+    print("Requests never sent: {}".format(queued))
+    print("Events that failed: {}".format(errors))
+    try:
+        import resource
+
+        # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != "darwin":
+            max_rss *= 1024
+        print("Peak memory: {}".format(format_size(max_rss)))
+    except ImportError:
+        pass
+    if EVENTROUTER.event_stats:
+        print("\nTime per event type:")
+        print("\n".join(format_time_stats(EVENTROUTER.event_stats, "event")))
+    if render_stats:
+        print("\nTime per rendering function (including nested calls):")
+        print("\n".join(format_time_stats(render_stats, "function")))
+    return 1 if errors or queued else 0
+
+
+if __name__ == "__main__" and "weechat" not in globals():
+    # Not running in WeeChat, so replay recorded events
+    sys.exit(replay_main(sys.argv[1:]))
+
 if __name__ == "__main__":
     w = WeechatWrapper(weechat)
 
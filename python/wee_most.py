@@ -11,10 +11,11 @@ import socket
 import subprocess
 import tempfile
 import time
+import urllib.parse
 import urllib.request
 import weechat
 
-from collections import namedtuple
+from collections import deque, namedtuple
 from functools import wraps
 from ssl import SSLWantReadError
 from websocket import (create_connection, WebSocketConnectionClosedException,
@@ -265,6 +266,13 @@ class Config:
             "Location for storing downloaded files",
             "", 0, 0, download_dir, download_dir, 0, "", "", "", "", "", ""), "type": "string" }
 
+        # network
+        self.sections["network"] = weechat.config_new_section(self.file, "network", 0, 0, "", "", "", "", "", "", "", "", "", "")
+        self.options["network.max_concurrent_requests"] = { "pointer": weechat.config_new_option(self.file,
+            self.sections["network"], "max_concurrent_requests", "integer",
+            "Maximum number of HTTP requests running at the same time for each server",
+            "", 1, 64, "4", "4", 0, "", "", "", "", "", ""), "type": "integer" }
+
         # server (user can add options)
         self.sections["server"] = weechat.config_new_section(self.file, "server", 1, 0, "", "", "", "", "", "", "create_server_option_cb", "", "", "")
         self.options["server.autoconnect"] = { "pointer": weechat.config_new_option(self.file,
@@ -414,6 +422,12 @@ commands = [
         description = "delete a post",
         completion = "",
     ),
+    Command(
+        name = "stats",
+        args = "[-reset]",
+        description = "show requests and reconnection sync statistics",
+        completion = "-reset",
+    ),
 ]
 
 def mattermost_channel_buffer_required(f):
@@ -568,6 +582,36 @@ def command_delete(args, buffer):
 
     return weechat.WEECHAT_RC_OK
 
+def command_stats(args, buffer):
+    if args not in ["", "-reset"]:
+        write_command_error("stats {}".format(args), "Error with subcommand arguments")
+        return weechat.WEECHAT_RC_ERROR
+
+    if args == "-reset":
+        EVENTROUTER.reset_stats()
+        weechat.prnt("", "wee_most: requests statistics cleared")
+        return weechat.WEECHAT_RC_OK
+
+    weechat.prnt("", "wee_most: requests in the last {:.0f} seconds".format(time.time() - EVENTROUTER.stats_since))
+
+    for server_id, server in servers.items():
+        running = EVENTROUTER.running_count.get(server_id, 0)
+        pending = len(EVENTROUTER.pending_requests.get(server_id, []))
+        weechat.prnt("", "  {}: {} running, {} waiting".format(server_id, running, pending))
+
+        sync_stats = server.sync_stats
+        if server.reconnection_count:
+            unsynced = sum(1 for channel in server.get_channels() if channel.needs_sync)
+            weechat.prnt("", "  {}: {} reconnections, last one synced {} channels ({} left) with {} requests and {} posts".format(
+                server_id, server.reconnection_count, sync_stats["channels"], unsynced, sync_stats["requests"], sync_stats["posts"]))
+
+    stats = sorted(EVENTROUTER.endpoint_stats.items(), key=lambda item: -item[1][2])
+    for endpoint, (count, errors, total, longest, size) in stats:
+        weechat.prnt("", "  {}: {} requests, {} errors, {:.0f} ms average, {:.0f} ms max, {} KiB".format(
+            endpoint, count, errors, total * 1000 / count, longest * 1000, size // 1024))
+
+    return weechat.WEECHAT_RC_OK
+
 def write_command_error(args, message):
     weechat.prnt("", weechat.prefix("error") + message + ' "/mattermost ' + args + '" (help on command: /help mattermost)')
 
@@ -649,6 +693,7 @@ class Post:
         self.message = kwargs["message"]
         self.type = kwargs["type"]
         self.created_at = kwargs["create_at"]
+        self.updated_at = kwargs.get("update_at", self.created_at)
         self.edited = kwargs["edit_at"] != 0
         self.thread_root = False
 
@@ -932,12 +977,21 @@ def format_markdown_links(text):
 
     return new_text
 
+class Hdata:
+    def __init__(self):
+        self.buffer = weechat.hdata_get("buffer")
+        self.line = weechat.hdata_get("line")
+        self.line_data = weechat.hdata_get("line_data")
+        self.lines = weechat.hdata_get("lines")
+        self.nick_group = weechat.hdata_get("nick_group")
+        self.window = weechat.hdata_get("window")
+
 def get_line_data_tags(line_data):
     tags = []
 
-    tags_count = weechat.hdata_integer(weechat.hdata_get("line_data"), line_data, "tags_count")
+    tags_count = weechat.hdata_integer(hdata.line_data, line_data, "tags_count")
     for i in range(tags_count):
-        tag = weechat.hdata_string(weechat.hdata_get("line_data"), line_data, "{}|tags_array".format(i))
+        tag = weechat.hdata_string(hdata.line_data, line_data, "{}|tags_array".format(i))
         tags.append(tag)
 
     return tags
@@ -951,30 +1005,30 @@ def is_post_line_data(line_data, post_id):
             return True
 
 def find_buffer_last_post_line_data(buffer, post_id):
-    lines = weechat.hdata_pointer(weechat.hdata_get("buffer"), buffer, "lines")
-    line = weechat.hdata_pointer(weechat.hdata_get("lines"), lines, "last_line")
+    lines = weechat.hdata_pointer(hdata.buffer, buffer, "lines")
+    line = weechat.hdata_pointer(hdata.lines, lines, "last_line")
 
-    line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
+    line_data = weechat.hdata_pointer(hdata.line, line, "data")
     while True:
         if is_post_line_data(line_data, post_id):
             return line_data
-        line = weechat.hdata_pointer(weechat.hdata_get("line"), line, "prev_line")
+        line = weechat.hdata_pointer(hdata.line, line, "prev_line")
         if "" == line:
             return None
-        line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
+        line_data = weechat.hdata_pointer(hdata.line, line, "data")
 
 def find_buffer_first_post_line_data(buffer, post_id):
-    lines = weechat.hdata_pointer(weechat.hdata_get("buffer"), buffer, "lines")
-    line = weechat.hdata_pointer(weechat.hdata_get("lines"), lines, "first_line")
+    lines = weechat.hdata_pointer(hdata.buffer, buffer, "lines")
+    line = weechat.hdata_pointer(hdata.lines, lines, "first_line")
 
-    line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
+    line_data = weechat.hdata_pointer(hdata.line, line, "data")
     while True:
         if is_post_line_data(line_data, post_id):
             return line_data
-        line = weechat.hdata_pointer(weechat.hdata_get("line"), line, "next_line")
+        line = weechat.hdata_pointer(hdata.line, line, "next_line")
         if "" == line:
             return None
-        line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
+        line_data = weechat.hdata_pointer(hdata.line, line, "data")
 
 CHANNEL_TYPES = {
     "D": "direct",
@@ -1000,12 +1054,19 @@ class ChannelBase:
         self.name = self._format_name(kwargs["display_name"], kwargs["name"])
         self.buffer = None
         self.posts = {}
+        # post id -> pointers of the lines the post is printed on
+        self.post_lines = {}
         self.users = {}
         self._is_loading = False
         self._is_muted = None
         self.last_post_id = None
+        self.last_post_time = 0 # latest update time of the posts received
         self.last_read_post_id = None
         self.last_viewed_at = 0
+        self.needs_sync = False
+        self.syncing = False
+        # post id -> post received while loading, written once loaded
+        self.pending_posts = {}
 
         self._create_buffer()
 
@@ -1050,6 +1111,31 @@ class ChannelBase:
             self.id, self.server, 0, "hydrate_channel_users_cb", "{}|{}|0".format(self.server.id, self.id)
         )
 
+    # fetch what changed since the last post received, after a reconnection
+    def sync(self):
+        # the sync starts once the current loading is done
+        if self._is_loading:
+            self.needs_sync = True
+            return
+
+        self.needs_sync = False
+        self.syncing = True
+        self.set_loading(True)
+
+        self.server.sync_stats["channels"] += 1
+        self.server.sync_stats["requests"] += 1
+
+        if self.last_post_time:
+            EVENTROUTER.enqueue_request(
+                "run_get_channel_posts_since",
+                self.last_post_time, self.id, self.server, "sync_channel_posts_cb", self.buffer
+            )
+        else:
+            EVENTROUTER.enqueue_request(
+                "run_get_channel_posts_after",
+                self.last_post_id, self.id, self.server, "hydrate_channel_posts_cb", self.buffer
+            )
+
     def update_properties(self, channel_data):
         self.name = self._format_name(channel_data["display_name"], channel_data["name"])
         self.title = channel_data["header"]
@@ -1064,25 +1150,13 @@ class ChannelBase:
         if not post.files:
             return
 
-        lines = weechat.hdata_pointer(weechat.hdata_get("buffer"), self.buffer, "lines")
-        line = weechat.hdata_pointer(weechat.hdata_get("lines"), lines, "last_line")
-        line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
-
-        # find last line of this post
-        while line and not is_post_line_data(line_data, post_id):
-            line = weechat.hdata_pointer(weechat.hdata_get("line"), line, "prev_line")
-            line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
-
-        for file_id in reversed(post.files.keys()):
+        # files are on the last lines of the post
+        pointers = self._get_lines_pointers(post_id)
+        for line, file_id in zip(reversed(pointers), reversed(post.files.keys())):
+            line_data = weechat.hdata_pointer(hdata.line, line, "data")
             tags = get_line_data_tags(line_data)
             tags.append("file_id_{}".format(file_id))
-            weechat.hdata_update(weechat.hdata_get("line_data"), line_data, {"tags_array": ",".join(tags)})
-
-            line = weechat.hdata_pointer(weechat.hdata_get("line"), line, "prev_line")
-            line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
-
-            if not line or not is_post_line_data(line_data, post.id): # safeguard
-                break
+            weechat.hdata_update(hdata.line_data, line_data, {"tags_array": ",".join(tags)})
 
     def _prefix_thread_message(self, message, post_id, root):
         prefix_format = config.get_value("format", "thread_prefix_root") if root else config.get_value("format", "thread_prefix")
@@ -1112,6 +1186,8 @@ class ChannelBase:
         del self.posts[post_id]
 
         pointers = self._get_lines_pointers(post_id)
+        # the lines lose their tags, so they can't be found anymore
+        self.post_lines.pop(post_id, None)
         if not pointers:
             return
 
@@ -1119,12 +1195,19 @@ class ChannelBase:
         lines[0] = colorize(config.get_value("look", "deleted_suffix"), config.get_value("color", "deleted"))
 
         for pointer, line in zip(pointers, lines):
-            line_data = weechat.hdata_pointer(weechat.hdata_get("line"), pointer, "data")
-            weechat.hdata_update(weechat.hdata_get("line_data"), line_data, {"message": line, "tags_array":""})
+            line_data = weechat.hdata_pointer(hdata.line, pointer, "data")
+            weechat.hdata_update(hdata.line_data, line_data, {"message": line, "tags_array":""})
 
     def edit_post(self, post):
         post.edited = True
         self.posts[post.id] = post
+        self.last_post_time = max(self.last_post_time, post.updated_at)
+        self.update_post(post)
+
+    def replace_post(self, post):
+        post.thread_root = self.posts[post.id].thread_root
+        self.posts[post.id] = post
+        self.last_post_time = max(self.last_post_time, post.updated_at)
         self.update_post(post)
 
     def update_post(self, post):
@@ -1142,29 +1225,69 @@ class ChannelBase:
         lines = message.split("\n")
 
         for pointer, line in zip(pointers, lines):
-            line_data = weechat.hdata_pointer(weechat.hdata_get("line"), pointer, "data")
-            weechat.hdata_update(weechat.hdata_get("line_data"), line_data, {"message": line})
+            line_data = weechat.hdata_pointer(hdata.line, pointer, "data")
+            weechat.hdata_update(hdata.line_data, line_data, {"message": line})
 
     def _get_lines_pointers(self, post_id):
-        lines = weechat.hdata_pointer(weechat.hdata_get("buffer"), self.buffer, "lines")
-        line = weechat.hdata_pointer(weechat.hdata_get("lines"), lines, "last_line")
-        line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
+        lines = weechat.hdata_pointer(hdata.buffer, self.buffer, "lines")
+
+        cached = self.post_lines.get(post_id)
+        if cached:
+            pointers, printed = cached
+            # lines are only removed from the start of the buffer, in the order
+            # they were printed, or all at once, which resets the index, so the
+            # post lines are still there if printed after the first buffer line
+            first_line = weechat.hdata_pointer(hdata.lines, lines, "first_line")
+            first_line_data = weechat.hdata_pointer(hdata.line, first_line, "data")
+            first_printed = weechat.hdata_time(hdata.line_data, first_line_data, "date_printed")
+            if first_line and (printed > first_printed
+                    or (pointers[0] == first_line and is_post_line_data(first_line_data, post_id))):
+                return pointers
+            del self.post_lines[post_id]
+
+        line = weechat.hdata_pointer(hdata.lines, lines, "last_line")
+        line_data = weechat.hdata_pointer(hdata.line, line, "data")
 
         # find last line of this post
         while line and not is_post_line_data(line_data, post_id):
-            line = weechat.hdata_pointer(weechat.hdata_get("line"), line, "prev_line")
-            line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
+            line = weechat.hdata_pointer(hdata.line, line, "prev_line")
+            line_data = weechat.hdata_pointer(hdata.line, line, "data")
 
         # find all lines of this post
         pointers = []
         while line and is_post_line_data(line_data, post_id):
             pointers.append(line)
-            line = weechat.hdata_pointer(weechat.hdata_get("line"), line, "prev_line")
-            line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
+            line = weechat.hdata_pointer(hdata.line, line, "prev_line")
+            line_data = weechat.hdata_pointer(hdata.line, line, "data")
         pointers.reverse()
 
+        self._store_post_lines(post_id, pointers)
+
         return pointers
 
+    def _index_post_lines(self, post_id):
+        lines = weechat.hdata_pointer(hdata.buffer, self.buffer, "lines")
+        line = weechat.hdata_pointer(hdata.lines, lines, "last_line")
+
+        # the post has just been printed, so its lines are the last ones
+        pointers = []
+        while line and is_post_line_data(weechat.hdata_pointer(hdata.line, line, "data"), post_id):
+            pointers.append(line)
+            line = weechat.hdata_pointer(hdata.line, line, "prev_line")
+        pointers.reverse()
+
+        self._store_post_lines(post_id, pointers)
+
+    def _store_post_lines(self, post_id, pointers):
+        if not pointers:
+            return
+        line_data = weechat.hdata_pointer(hdata.line, pointers[0], "data")
+        printed = weechat.hdata_time(hdata.line_data, line_data, "date_printed")
+        self.post_lines[post_id] = (pointers, printed)
+
+    def clear_post_lines(self):
+        self.post_lines = {}
+
     def write_post(self, post):
         self.posts[post.id] = post
 
@@ -1202,9 +1325,11 @@ class ChannelBase:
 
         weechat.prnt_date_tags(self.buffer, date, tags, prefix + message)
 
+        self._index_post_lines(post.id)
         self._update_file_tags(post.id)
 
         self.last_post_id = post.id
+        self.last_post_time = max(self.last_post_time, post.updated_at)
 
     def mark_as_read(self):
         if self.last_post_id and self.last_post_id == self.last_read_post_id: # prevent spamming on buffer switch
@@ -1257,17 +1382,17 @@ class ChannelBase:
         weechat.nicklist_add_nick(self.buffer, group, user.nick, color, "", color, 1)
 
     def remove_empty_nick_groups(self):
-        root = weechat.hdata_pointer(weechat.hdata_get("buffer"), self.buffer, "nicklist_root")
-        group = weechat.hdata_pointer(weechat.hdata_get("nick_group"), root, "children")
+        root = weechat.hdata_pointer(hdata.buffer, self.buffer, "nicklist_root")
+        group = weechat.hdata_pointer(hdata.nick_group, root, "children")
 
         while group:
-            if not weechat.hdata_pointer(weechat.hdata_get("nick_group"), group, "last_nick"):
+            if not weechat.hdata_pointer(hdata.nick_group, group, "last_nick"):
                 # tried deleting or marking group as not visible via hdata_update but it doesn't seem to work
-                name = weechat.hdata_string(weechat.hdata_get("nick_group"), group, "name")
+                name = weechat.hdata_string(hdata.nick_group, group, "name")
                 g = weechat.nicklist_search_group(self.buffer, "", name)
                 weechat.nicklist_remove_group(self.buffer, g)
 
-            group = weechat.hdata_pointer(weechat.hdata_get("nick_group"), group, "next_group")
+            group = weechat.hdata_pointer(hdata.nick_group, group, "next_group")
 
     def set_loading(self, loading):
         self._is_loading = loading
@@ -1276,6 +1401,27 @@ class ChannelBase:
     def is_loading(self):
         return self._is_loading
 
+    def finish_loading(self):
+        self.set_loading(False)
+        self.syncing = False
+
+        if self.needs_sync:
+            self.sync()
+            return
+
+        pending_posts = self.pending_posts
+        self.pending_posts = {}
+
+        # the fetched posts may already include them
+        for post in pending_posts.values():
+            if post.id not in self.posts:
+                self.write_post(post)
+
+    def fail_sync(self):
+        self.set_loading(False)
+        self.syncing = False
+        self.needs_sync = True
+
     def mute(self):
         self._is_muted = True
         self._update_buffer_name()
@@ -1319,6 +1465,7 @@ class ChannelBase:
     def unload(self):
         weechat.buffer_close(self.buffer)
         self.buffer = None
+        self.clear_post_lines()
 
 class DirectMessagesChannel(ChannelBase):
     def __init__(self, server, **kwargs):
@@ -1396,17 +1543,21 @@ def channel_input_cb(data, buffer, input_data):
 
 def hydrate_channel_posts_cb(buffer, command, rc, out, err):
     server = get_server_from_buffer(buffer)
+    channel = server.get_channel_from_buffer(buffer)
 
     if rc != 0:
         server.print_error("An error occurred while hydrating channel")
+        if channel.syncing:
+            channel.fail_sync()
         return weechat.WEECHAT_RC_ERROR
 
-    channel = server.get_channel_from_buffer(buffer)
-
     response = json.loads(out)
 
+    if channel.syncing:
+        server.sync_stats["posts"] += len(response["order"])
+
     if not response["order"]:
-        channel.set_loading(False)
+        channel.finish_loading()
         return weechat.WEECHAT_RC_OK
 
     for post_id in reversed(response["order"]):
@@ -1414,12 +1565,50 @@ def hydrate_channel_posts_cb(buffer, command, rc, out, err):
         channel.write_post(builded_post)
 
     if "" != response["next_post_id"]:
+        if channel.syncing:
+            server.sync_stats["requests"] += 1
         EVENTROUTER.enqueue_request(
             "run_get_channel_posts_after",
             builded_post.id, channel.id, server, "hydrate_channel_posts_cb", buffer
         )
     else:
-        channel.set_loading(False)
+        channel.finish_loading()
+
+    return weechat.WEECHAT_RC_OK
+
+def sync_channel_posts_cb(buffer, command, rc, out, err):
+    server = get_server_from_buffer(buffer)
+    channel = server.get_channel_from_buffer(buffer)
+
+    if rc != 0:
+        server.print_error("An error occurred while syncing channel")
+        channel.fail_sync()
+        return weechat.WEECHAT_RC_ERROR
+
+    response = json.loads(out)
+
+    server.sync_stats["posts"] += len(response["order"])
+
+    # new, edited and deleted posts, oldest first
+    for post_data in sorted(response["posts"].values(), key=lambda post_data: post_data["create_at"]):
+        if post_data["channel_id"] != channel.id:
+            continue
+
+        if post_data["delete_at"]:
+            if post_data["id"] in channel.posts:
+                channel.remove_post(post_data["id"])
+            continue
+
+        post = Post(server, **post_data)
+        if post.id in channel.posts:
+            channel.replace_post(post)
+        else:
+            channel.write_post(post)
+
+    channel.finish_loading()
+
+    if channel.buffer == weechat.current_buffer():
+        channel.mark_as_read()
 
     return weechat.WEECHAT_RC_OK
 
@@ -1576,6 +1765,8 @@ def create_channel_from_channel_data(channel_data, server):
 def buffer_switch_cb(data, signal, buffer):
     for server in servers.values():
         channel = server.get_channel_from_buffer(buffer)
+        if channel and channel.needs_sync:
+            channel.sync()
         if channel and channel.users:
             channel.mark_as_read()
             EVENTROUTER.enqueue_request(
@@ -1642,6 +1833,15 @@ def chat_line_event_cb(data, signal, hashtable):
 
     return weechat.WEECHAT_RC_OK
 
+def buffer_cleared_cb(data, signal, buffer):
+    for server in servers.values():
+        channel = server.get_channel_from_buffer(buffer)
+        if channel:
+            channel.clear_post_lines()
+            break
+
+    return weechat.WEECHAT_RC_OK
+
 def handle_multiline_message_cb(data, modifier, buffer, string):
     for server in servers.values():
         if server.get_channel_from_buffer(buffer):
@@ -1697,6 +1897,8 @@ class Server:
         self.reconnection_loop_hook = ""
         self.closed_channels = {}
         self.custom_emojis = []
+        self.reconnection_count = 0
+        self.reset_sync_stats()
 
         self._create_buffer()
 
@@ -1729,6 +1931,22 @@ class Server:
     def print_error(self, message):
         weechat.prnt(self.buffer, weechat.prefix("error") + message)
 
+    def reset_sync_stats(self):
+        # counters of the last reconnection
+        self.sync_stats = {
+            "channels": 0,
+            "requests": 0,
+            "posts": 0,
+        }
+
+    def get_channels(self):
+        channels = list(self.channels.values())
+
+        for team in self.teams.values():
+            channels.extend(team.channels.values())
+
+        return channels
+
     def get_channel(self, channel_id):
         if channel_id in self.channels:
             return self.channels[channel_id]
@@ -1822,6 +2040,8 @@ class Server:
     def unload(self):
         self.print("Unloading server")
 
+        EVENTROUTER.cancel_requests(self.id)
+
         if self.worker:
             close_worker(self.worker)
         if self.reconnection_loop_hook:
@@ -1997,6 +2217,13 @@ def connect_server_preferences_cb(server_id, command, rc, out, err):
         if pref["category"] in ["direct_channel_show", "group_channel_show"] and pref["value"] == "false":
             server.closed_channels[pref["name"]] = None # will contain channel id if encountered later
 
+    # requests run concurrently, so users (then teams and channels) are only
+    # fetched once we know which channels are closed
+    EVENTROUTER.enqueue_request(
+        "run_get_users",
+        server, 0, "connect_server_users_cb", "{}|0".format(server.id)
+    )
+
     return weechat.WEECHAT_RC_OK
 
 def connect_server_teams_cb(server_id, command, rc, out, err):
@@ -2083,11 +2310,6 @@ def connect_server_cb(server_id, command, rc, out, err):
         server, 0, "update_custom_emojis", "{}|0".format(server.id)
     )
 
-    EVENTROUTER.enqueue_request(
-        "run_get_users",
-        server, 0, "connect_server_users_cb", "{}|0".format(server.id)
-    )
-
     EVENTROUTER.enqueue_request(
         "run_get_preferences",
         server, "connect_server_preferences_cb", server.id
@@ -2148,109 +2370,182 @@ def singularity_cb(buffer, command, rc, out, err):
 
     return weechat.WEECHAT_RC_OK
 
-def build_buffer_cb_data(url, cb, cb_data):
-    return "{}|{}|{}".format(url, cb, cb_data)
+Request = namedtuple("Request", ["server_id", "url", "options", "cb", "cb_data"])
+
+# ids in Mattermost API paths are made of 26 lowercase alphanumeric characters
+ENDPOINT_ID_RE = re.compile("/[a-z0-9]{26}(?=/|$)")
+
+def get_request_endpoint(url):
+    path = urllib.parse.urlsplit(url).path
+    return ENDPOINT_ID_RE.sub("/{id}", path)
 
 class EventRouter:
     def __init__(self):
-        self.enqueued_requests = []
-        self.response_buffers = {}
+        self.functions = {}
+        self.pending_requests = {}
+        self.running_requests = {}
+        self.running_count = {}
+        self.request_counter = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats_since = time.time()
+        # endpoint -> [count, errors, total seconds, max seconds, bytes]
+        self.endpoint_stats = {}
+
+    # request methods and callbacks are given by name,
+    # they are looked up once in the module functions
+    def get_function(self, name):
+        function = self.functions.get(name)
+        if function is None:
+            function = globals()[name]
+            self.functions[name] = function
+        return function
 
     def enqueue_request(self, method, *params):
-        self.enqueued_requests.append([method, params])
+        self.get_function(method)(*params)
 
-    def handle_next(self):
-        if not self.enqueued_requests:
-            return
+    def run_request(self, server, url, options, cb, cb_data, first=False):
+        request = Request(server.id, url, options, cb, cb_data)
+        pending = self.pending_requests.setdefault(server.id, deque())
+
+        # requests for user actions go before the ones loading channels
+        if first:
+            pending.appendleft(request)
+        else:
+            pending.append(request)
+
+        self.start_requests(server.id)
+
+    def start_requests(self, server_id):
+        pending = self.pending_requests.get(server_id)
+        max_running = config.get_value("network", "max_concurrent_requests")
+
+        failed_requests = []
+        while pending and self.running_count.get(server_id, 0) < max_running:
+            request = pending.popleft()
+
+            self.request_counter += 1
+            request_id = str(self.request_counter)
+            self.running_requests[request_id] = (request, time.time(), [])
+            self.running_count[server_id] = self.running_count.get(server_id, 0) + 1
+
+            hook = weechat.hook_process_hashtable(
+                "url:" + request.url,
+                request.options,
+                REQUEST_TIMEOUT_MS,
+                "buffered_response_cb",
+                request_id
+            )
+
+            # no callback will come for this request, free its slot
+            if not hook:
+                del self.running_requests[request_id]
+                self.running_count[server_id] -= 1
+                self._record_request(request, weechat.WEECHAT_HOOK_PROCESS_ERROR, 0, 0)
+                failed_requests.append(request)
+
+        # callbacks may run new requests, so they are called once the loop is done
+        for request in failed_requests:
+            self.get_function(request.cb)(request.cb_data, "url:" + request.url,
+                weechat.WEECHAT_HOOK_PROCESS_ERROR, "", "Failed to start request")
 
-        request = self.enqueued_requests.pop(0)
-        eval(request[0])(*request[1])
+    def cancel_requests(self, server_id):
+        self.pending_requests.pop(server_id, None)
 
     def buffered_response_cb(self, data, command, rc, out, err):
-        arg_search = re.search("([^\|]*)\|([^\|]*)\|(.*)", data)
-        response_buffer_name = arg_search.group(1)
-        real_cb = arg_search.group(2)
-        real_data = arg_search.group(3)
+        if data not in self.running_requests:
+            return weechat.WEECHAT_RC_OK
 
-        if not response_buffer_name in self.response_buffers:
-            self.response_buffers[response_buffer_name] = ""
+        request, start_time, chunks = self.running_requests[data]
+        chunks.append(out)
 
         if rc == weechat.WEECHAT_HOOK_PROCESS_RUNNING:
-            self.response_buffers[response_buffer_name] += out
             return weechat.WEECHAT_RC_OK
 
-        response = self.response_buffers[response_buffer_name] + out
-        del self.response_buffers[response_buffer_name]
+        del self.running_requests[data]
+        self.running_count[request.server_id] -= 1
 
-        return eval(real_cb)(real_data, command, rc, response, err)
+        response = "".join(chunks)
+        self._record_request(request, rc, time.time() - start_time, len(response))
 
-def handle_queued_request_cb(data, remaining_calls):
-    EVENTROUTER.handle_next()
-    return weechat.WEECHAT_RC_OK
+        self.start_requests(request.server_id)
+
+        return self.get_function(request.cb)(request.cb_data, command, rc, response, err)
+
+    def _record_request(self, request, rc, duration, size):
+        endpoint = get_request_endpoint(request.url)
+        stats = self.endpoint_stats.setdefault(endpoint, [0, 0, 0, 0, 0])
+        stats[0] += 1
+        if rc != 0:
+            stats[1] += 1
+        stats[2] += duration
+        stats[3] = max(stats[3], duration)
+        stats[4] += size
 
 def run_get_user_teams(server, cb, cb_data):
     url = server.url + "/api/v4/users/me/teams"
-    weechat.hook_process_hashtable(
-        "url:" + url,
+    EVENTROUTER.run_request(
+        server,
+        url,
         {
             "failonerror": "1",
             "httpheader": "Authorization: Bearer " + server.token,
         },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        cb,
+        cb_data
     )
 
 def run_get_team(team_id, server, cb, cb_data):
     url = server.url + "/api/v4/teams/{}".format(team_id)
-    weechat.hook_process_hashtable(
-        "url:" + url,
+    EVENTROUTER.run_request(
+        server,
+        url,
         {
             "failonerror": "1",
             "httpheader": "Authorization: Bearer " + server.token,
         },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        cb,
+        cb_data
     )
 
 def run_get_users(server, page, cb, cb_data):
     url = server.url + "/api/v4/users?per_page=200&page={}".format(str(page))
-    weechat.hook_process_hashtable(
-        "url:" + url,
+    EVENTROUTER.run_request(
+        server,
+        url,
         {
             "failonerror": "1",
             "httpheader": "Authorization: Bearer " + server.token,
         },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        cb,
+        cb_data
     )
 
 def run_get_user(server, user_id, cb, cb_data):
     url = server.url + "/api/v4/users/{}".format(user_id)
-    weechat.hook_process_hashtable(
-        "url:" + url,
+    EVENTROUTER.run_request(
+        server,
+        url,
         {
             "failonerror": "1",
             "httpheader": "Authorization: Bearer " + server.token,
         },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        cb,
+        cb_data
     )
 
 def run_get_custom_emojis(server, page, cb, cb_data):
     url = server.url + "/api/v4/emoji?per_page=150&page={}".format(str(page))
-    weechat.hook_process_hashtable(
-        "url:" + url,
+    EVENTROUTER.run_request(
+        server,
+        url,
         {
             "failonerror": "1",
             "httpheader": "Authorization: Bearer " + server.token,
         },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        cb,
+        cb_data
     )
 
 # Logging out synchronously for usage in shutdown function
@@ -2281,42 +2576,42 @@ def run_user_login(server, cb, cb_data):
             return weechat.WEECHAT_RC_ERROR
         params["token"] = token
 
-    weechat.hook_process_hashtable(
-        "url:" + url,
+    EVENTROUTER.run_request(
+        server,
+        url,
         {
             "failonerror": "1",
             "postfields": json.dumps(params),
             "header": "1",
         },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        cb,
+        cb_data
     )
 
 def run_get_channel(channel_id, server, cb, cb_data):
     url = server.url + "/api/v4/channels/{}".format(channel_id)
-    weechat.hook_process_hashtable(
-        "url:" + url,
+    EVENTROUTER.run_request(
+        server,
+        url,
         {
             "failonerror": "1",
             "httpheader": "Authorization: Bearer " + server.token,
         },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        cb,
+        cb_data
     )
 
 def run_get_user_team_channels(team_id, server, cb, cb_data):
     url = server.url + "/api/v4/users/me/teams/{}/channels".format(team_id)
-    weechat.hook_process_hashtable(
-        "url:" + url,
+    EVENTROUTER.run_request(
+        server,
+        url,
         {
             "failonerror": "1",
             "httpheader": "Authorization: Bearer " + server.token,
         },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        cb,
+        cb_data
     )
 
 def run_post_post(post, server, cb, cb_data):
@@ -2329,16 +2624,17 @@ def run_post_post(post, server, cb, cb_data):
     if "root_id" in post:
         params["root_id"] = post["root_id"]
 
-    weechat.hook_process_hashtable(
-        "url:" + url,
+    EVENTROUTER.run_request(
+        server,
+        url,
         {
             "failonerror": "1",
             "httpheader": "Authorization: Bearer " + server.token,
             "postfields": json.dumps(params),
         },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        cb,
+        cb_data,
+        first=True
     )
 
 def run_post_command(team_id, channel_id, command, server, cb, cb_data):
@@ -2349,29 +2645,30 @@ def run_post_command(team_id, channel_id, command, server, cb, cb_data):
         "command": command,
     }
 
-    weechat.hook_process_hashtable(
-        "url:" + url,
+    EVENTROUTER.run_request(
+        server,
+        url,
         {
             "failonerror": "1",
             "httpheader": "Authorization: Bearer " + server.token,
             "postfields": json.dumps(params),
         },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        cb,
+        cb_data,
+        first=True
     )
 
 def run_get_channel_posts_around_oldest_unread(channel_id, server, cb, cb_data):
     url = server.url + "/api/v4/users/me/channels/{}/posts/unread".format(channel_id)
-    weechat.hook_process_hashtable(
-        "url:" + url,
+    EVENTROUTER.run_request(
+        server,
+        url,
         {
             "failonerror": "1",
             "httpheader": "Authorization: Bearer " + server.token,
         },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        cb,
+        cb_data
     )
 
 def run_get_channel_posts_after(post_id, channel_id, server, cb, cb_data):
@@ -2380,55 +2677,69 @@ def run_get_channel_posts_after(post_id, channel_id, server, cb, cb_data):
     else:
         url = server.url + "/api/v4/channels/{}/posts".format(channel_id)
 
-    weechat.hook_process_hashtable(
-        "url:" + url,
+    EVENTROUTER.run_request(
+        server,
+        url,
         {
             "failonerror": "1",
             "httpheader": "Authorization: Bearer " + server.token,
         },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        cb,
+        cb_data
+    )
+
+def run_get_channel_posts_since(since, channel_id, server, cb, cb_data):
+    url = server.url + "/api/v4/channels/{}/posts?since={}".format(channel_id, since)
+    EVENTROUTER.run_request(
+        server,
+        url,
+        {
+            "failonerror": "1",
+            "httpheader": "Authorization: Bearer " + server.token,
+        },
+        cb,
+        cb_data,
+        first=True
     )
 
 def run_get_channel_members(channel_id, server, page, cb, cb_data):
     url = server.url + "/api/v4/channels/{}/members?per_page=200&page={}".format(channel_id, str(page))
-    weechat.hook_process_hashtable(
-        "url:" + url,
+    EVENTROUTER.run_request(
+        server,
+        url,
         {
             "failonerror": "1",
             "httpheader": "Authorization: Bearer " + server.token,
         },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        cb,
+        cb_data
     )
 
 def run_get_user_channel_members(server, page, cb, cb_data):
     url = server.url + "/api/v4/users/me/channel_members?pageSize=100&page={}".format(str(page))
-    weechat.hook_process_hashtable(
-        "url:" + url,
+    EVENTROUTER.run_request(
+        server,
+        url,
         {
             "failonerror": "1",
             "httpheader": "Authorization: Bearer " + server.token,
         },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        cb,
+        cb_data
     )
 
 def run_post_users_status_ids(user_ids, server, cb, cb_data):
     url = server.url + "/api/v4/users/status/ids"
-    weechat.hook_process_hashtable(
-        "url:" + url,
+    EVENTROUTER.run_request(
+        server,
+        url,
         {
             "postfields": json.dumps(user_ids),
             "failonerror": "1",
             "httpheader": "Authorization: Bearer " + server.token,
         },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        cb,
+        cb_data
     )
 
 def run_post_channel_view(channel_id, server, cb, cb_data):
@@ -2437,16 +2748,17 @@ def run_post_channel_view(channel_id, server, cb, cb_data):
         "channel_id": channel_id,
     }
 
-    weechat.hook_process_hashtable(
-        "url:" + url,
+    EVENTROUTER.run_request(
+        server,
+        url,
         {
             "postfields": json.dumps(params),
             "failonerror": "1",
             "httpheader": "Authorization: Bearer " + server.token,
         },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        cb,
+        cb_data,
+        first=True
     )
 
 def run_post_reaction(emoji_name, post_id, server, cb, cb_data):
@@ -2458,75 +2770,79 @@ def run_post_reaction(emoji_name, post_id, server, cb, cb_data):
         "create_at": int(time.time() * 1000),
     }
 
-    weechat.hook_process_hashtable(
-        "url:" + url,
+    EVENTROUTER.run_request(
+        server,
+        url,
         {
             "postfields": json.dumps(params),
             "failonerror": "1",
             "httpheader": "Authorization: Bearer " + server.token,
         },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        cb,
+        cb_data,
+        first=True
     )
 
 def run_delete_reaction(emoji_name, post_id, server, cb, cb_data):
     url = server.url + "/api/v4/users/me/posts/{}/reactions/{}".format(post_id, emoji_name)
 
-    weechat.hook_process_hashtable(
-        "url:" + url,
+    EVENTROUTER.run_request(
+        server,
+        url,
         {
             "customrequest": "DELETE",
             "failonerror": "1",
             "httpheader": "Authorization: Bearer " + server.token,
         },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        cb,
+        cb_data,
+        first=True
     )
 
 def run_delete_post(post_id, server, cb, cb_data):
     url = server.url + "/api/v4/posts/{}".format(post_id)
 
-    weechat.hook_process_hashtable(
-        "url:" + url,
+    EVENTROUTER.run_request(
+        server,
+        url,
         {
             "customrequest": "DELETE",
             "failonerror": "1",
             "httpheader": "Authorization: Bearer " + server.token,
         },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        cb,
+        cb_data,
+        first=True
     )
 
 def run_get_file(file_id, file_out_path, server, cb, cb_data):
     url = server.url + "/api/v4/files/{}".format(file_id)
 
-    weechat.hook_process_hashtable(
-        "url:" + url,
+    EVENTROUTER.run_request(
+        server,
+        url,
         {
             "failonerror": "1",
             "file_out": file_out_path,
             "httpheader": "Authorization: Bearer " + server.token,
         },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        cb,
+        cb_data,
+        first=True
     )
 
 def run_get_preferences(server, cb, cb_data):
     url = server.url + "/api/v4/users/me/preferences"
 
-    weechat.hook_process_hashtable(
-        "url:" + url,
+    EVENTROUTER.run_request(
+        server,
+        url,
         {
             "failonerror": "1",
             "httpheader": "Authorization: Bearer " + server.token,
         },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        cb,
+        cb_data
     )
 
 class Worker:
@@ -2551,24 +2867,29 @@ class Worker:
 
         self.hook_ping = weechat.hook_timer(5 * 1000, 0, 0, "ws_ping_cb", server.id)
 
-def rehydrate_server_buffer(server, buffer):
-    channel = server.get_channel_from_buffer(buffer)
-    if not channel:
-        return
-    channel.set_loading(True)
+def get_visible_buffers():
+    buffers = set()
 
-    EVENTROUTER.enqueue_request(
-        "run_get_channel_posts_after",
-        channel.last_post_id, channel.id, server, "hydrate_channel_posts_cb", buffer
-    )
+    window = weechat.hdata_get_list(hdata.window, "gui_windows")
+    while window:
+        buffers.add(weechat.hdata_pointer(hdata.window, window, "buffer"))
+        window = weechat.hdata_pointer(hdata.window, window, "next_window")
 
+    return buffers
+
+# only the channels displayed in a window are synced right away,
+# the others are synced when switched to or when they get a new post
 def rehydrate_server_buffers(server):
     server.print("Syncing...")
-    for channel in server.channels.values():
-        rehydrate_server_buffer(server, channel.buffer)
-    for team in server.teams.values():
-        for channel in team.channels.values():
-            rehydrate_server_buffer(server, channel.buffer)
+    server.reset_sync_stats()
+    server.reconnection_count += 1
+
+    visible_buffers = get_visible_buffers()
+
+    for channel in server.get_channels():
+        channel.needs_sync = True
+        if channel.buffer in visible_buffers:
+            channel.sync()
 
 def reconnection_loop_cb(server_id, remaining_calls):
     server = servers[server_id]
@@ -2622,10 +2943,18 @@ def handle_posted_message(server, data, broadcast):
         return
 
     channel = server.get_channel(broadcast["channel_id"])
-    if not channel or channel.is_loading():
+    if not channel:
         return
 
     post = Post(server, **post)
+
+    # written after the posts being fetched, so they stay in order
+    if channel.is_loading() or channel.needs_sync:
+        channel.pending_posts[post.id] = post
+        if not channel.is_loading():
+            channel.sync()
+        return
+
     channel.write_post(post)
 
     if channel.buffer == weechat.current_buffer():
@@ -2658,12 +2987,16 @@ def handle_post_edited_message(server, data, broadcast):
     post = Post(server, **post_data)
     if server.get_post(post.id) is not None:
         post.channel.edit_post(post)
+    elif post.channel and post.id in post.channel.pending_posts:
+        post.channel.pending_posts[post.id] = post
 
 def handle_post_deleted_message(server, data, broadcast):
     post_data = json.loads(data["post"])
     post = Post(server, **post_data)
     if server.get_post(post.id) is not None:
         post.channel.remove_post(post.id)
+    elif post.channel:
+        post.channel.pending_posts.pop(post.id, None)
 
 def handle_channel_created_message(server, data, broadcast):
     connect_server_team_channel(broadcast["channel_id"], server)
@@ -2829,7 +3162,7 @@ mentions = ["@here", "@channel", "@all"]
 WEECHAT_SCRIPT_NAME = "wee_most"
 WEECHAT_SCRIPT_DESCRIPTION = "Mattermost integration"
 WEECHAT_SCRIPT_AUTHOR = "Damien Tardy-Panis <damien.dev@tardypad.me>"
-WEECHAT_SCRIPT_VERSION = "0.3.0"
+WEECHAT_SCRIPT_VERSION = "0.3.3"
 WEECHAT_SCRIPT_LICENSE = "GPL3"
 
 weechat.register(
@@ -2842,6 +3175,8 @@ weechat.register(
     ""
 )
 
+hdata = Hdata()
+
 load_default_emojis()
 config.setup()
 config.read()
@@ -2870,7 +3205,7 @@ weechat.hook_completion("mentions", "complete @-mentions for Mattermost", "menti
 
 weechat.hook_modifier("input_text_for_buffer", "handle_multiline_message_cb", "")
 weechat.hook_signal("buffer_switch", "buffer_switch_cb", "")
-weechat.hook_timer(int(0.2 * 1000), 0, 0, "handle_queued_request_cb", "")
+weechat.hook_signal("buffer_cleared", "buffer_cleared_cb", "")
 weechat.hook_timer(60 * 1000, 0, 0, "get_buffer_user_status_cb", "")
 weechat.hook_timer(60 * 1000, 0, 0, "get_direct_message_channels_user_status_cb", "")
 weechat.hook_config("irc.look.server_buffer", "config_server_buffer_cb", "")